@@ -0,0 +1,228 @@
+"""
+Synthetic load benchmark of the exporter collection. Each scenario runs in its own process
+collecting the metrics file queries from fake connectors, and reports the latency
+percentiles of the collection (the exporter code) and the whole scrape (collection and
+exposition), the peak RSS of the process, the memory allocated per scrape and the memory
+retained after it (the cached metrics)
+
+Usage:
+    python benchmarks/benchmark.py [-m metrics.json] [-n 20] [--scenario default ...]
+
+:since: 2026-10-18
+"""
+
+import argparse
+import collections
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SCENARIO = collections.namedtuple(
+    'Scenario', 'tenants rows extra_columns latency workers query_workers')
+
+SCENARIOS = collections.OrderedDict([
+    ('small', SCENARIO(
+        tenants=1, rows=10, extra_columns=0, latency=0, workers=1, query_workers=1)),
+    ('default', SCENARIO(
+        tenants=4, rows=100, extra_columns=0, latency=0, workers=1, query_workers=1)),
+    ('wide', SCENARIO(
+        tenants=4, rows=100, extra_columns=20, latency=0, workers=1, query_workers=1)),
+    ('large', SCENARIO(
+        tenants=1, rows=1000, extra_columns=0, latency=0, workers=1, query_workers=1)),
+    ('latency', SCENARIO(
+        tenants=4, rows=100, extra_columns=0, latency=0.002, workers=1, query_workers=1)),
+    ('latency_concurrent', SCENARIO(
+        tenants=4, rows=100, extra_columns=0, latency=0.002, workers=4, query_workers=1)),
+    ('latency_query_workers', SCENARIO(
+        tenants=4, rows=100, extra_columns=0, latency=0.002, workers=4, query_workers=4)),
+])
+
+DEFAULT_METRICS_FILE = os.path.join(os.path.dirname(__file__), '..', 'metrics.json')
+
+
+def parse_arguments():
+    """
+    Parse command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-m", "--metrics", default=DEFAULT_METRICS_FILE, help="Path to metrics file")
+    parser.add_argument(
+        "-n", "--scrapes", type=int, default=20, help="Measured scrapes per scenario")
+    parser.add_argument(
+        "--scenario", action="append", choices=list(SCENARIOS),
+        help="Scenario to run (all of them by default). It can be used multiple times")
+    parser.add_argument("--tenants", type=int, help="Run a custom scenario with N tenants")
+    parser.add_argument("--rows", type=int, default=100, help="Rows per query (custom scenario)")
+    parser.add_argument(
+        "--extra-columns", type=int, default=0,
+        help="Columns not used by the metrics per query (custom scenario)")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds per query (custom scenario)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Collection workers (custom scenario)")
+    parser.add_argument(
+        "--query-workers", type=int, default=1,
+        help="Concurrent queries per database (custom scenario)")
+    parser.add_argument(
+        "--fresh-strings", action="store_true",
+        help="Return new strings in every query, as the database drivers do")
+    parser.add_argument(
+        "--label-values-size", type=int,
+        help="Maximum number of interned label values (0 disables the interning)")
+    parser.add_argument("--json", action="store_true", help="Print the results as json")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentile(values, percent):
+    """
+    Get the percentile of the values (nearest rank)
+    """
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def run_scenario(metrics_file, scenario, scrapes, fresh_strings=False, label_values_size=None):
+    """
+    Run the scenario in the current process
+
+    Returns:
+        dict: Scenario results
+    """
+    from prometheus_client import CollectorRegistry, generate_latest
+    from hanadb_exporter import prometheus_exporter
+    from hanadb_exporter import prometheus_metrics
+    from fake_connector import FakeHdbConnector
+
+    metrics_config = prometheus_metrics.PrometheusMetrics(metrics_file)
+    connectors = [
+        FakeHdbConnector(
+            metrics_config, database_name='TENANT{}'.format(index), rows=scenario.rows,
+            extra_columns=scenario.extra_columns, latency=scenario.latency,
+            fresh_strings=fresh_strings)
+        for index in range(scenario.tenants)]
+    options = {}
+    if label_values_size is not None:
+        options['label_values_size'] = label_values_size
+    collector = prometheus_exporter.SapHanaCollectors(
+        connectors, metrics_file, workers=scenario.workers, query_workers=scenario.query_workers,
+        **options)
+    registry = CollectorRegistry()
+    registry.register(collector)
+
+    # Warm up: the result columns are resolved and the self monitoring metrics created
+    payload = generate_latest(registry)
+
+    collect_latencies = []
+    for _ in range(scrapes):
+        start = time.perf_counter()
+        list(collector.collect())
+        collect_latencies.append(time.perf_counter() - start)
+
+    latencies = []
+    for _ in range(scrapes):
+        start = time.perf_counter()
+        generate_latest(registry)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    allocated = []
+    retained = []
+    for _ in range(min(scrapes, 3)):
+        tracemalloc.clear_traces()
+        generate_latest(registry)
+        current, peak = tracemalloc.get_traced_memory()
+        allocated.append(peak)
+        # Only the blocks allocated in this scrape are traced, so the current size is the memory
+        # kept until the next scrape
+        retained.append(current)
+    tracemalloc.stop()
+
+    return {
+        'scenario': scenario._asdict(),
+        'queries': sum(connector.queries for connector in connectors),
+        'payload_bytes': len(payload),
+        'collect_p50_ms': percentile(collect_latencies, 50) * 1000,
+        'collect_p99_ms': percentile(collect_latencies, 99) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        # ru_maxrss is given in kilobytes in Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'allocated_kb_per_scrape': percentile(allocated, 50) / 1024.0,
+        'retained_kb_per_scrape': percentile(retained, 50) / 1024.0
+    }
+
+
+def run_isolated(name, scenario, args):
+    """
+    Run the scenario in a new process, so the peak RSS is not shared between scenarios
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run', json.dumps(scenario._asdict()),
+        '-m', args.metrics, '-n', str(args.scrapes)]
+    if args.fresh_strings:
+        command.append('--fresh-strings')
+    if args.label_values_size is not None:
+        command.extend(['--label-values-size', str(args.label_values_size)])
+    output = subprocess.check_output(command)
+    result = json.loads(output.decode().splitlines()[-1])
+    result['name'] = name
+    return result
+
+
+def print_results(results):
+    """
+    Print the results table
+    """
+    header = '{:<20} {:>7} {:>5} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8} {:>10} {:>10} ' \
+        '{:>10}'
+    row = '{:<20} {:>7} {:>5} {:>7} ' \
+        '{:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>8.1f} {:>10.1f} {:>10.1f} {:>10}'
+    print(header.format(
+        'scenario', 'tenants', 'rows', 'workers', 'coll p50', 'coll p99', 'p50 ms', 'p90 ms',
+        'p99 ms', 'rss MB', 'alloc KB', 'retain KB', 'payload B'))
+    for result in results:
+        print(row.format(
+            result['name'], result['scenario']['tenants'], result['scenario']['rows'],
+            result['scenario']['workers'], result['collect_p50_ms'], result['collect_p99_ms'],
+            result['p50_ms'], result['p90_ms'], result['p99_ms'], result['peak_rss_mb'],
+            result['allocated_kb_per_scrape'], result['retained_kb_per_scrape'],
+            result['payload_bytes']))
+
+
+def run():
+    """
+    Main execution
+    """
+    args = parse_arguments()
+    if args.run:
+        scenario = SCENARIO(**json.loads(args.run))
+        print(json.dumps(run_scenario(
+            args.metrics, scenario, args.scrapes, args.fresh_strings, args.label_values_size)))
+        return
+
+    if args.tenants:
+        scenarios = [('custom', SCENARIO(
+            tenants=args.tenants, rows=args.rows, extra_columns=args.extra_columns,
+            latency=args.latency, workers=args.workers, query_workers=args.query_workers))]
+    else:
+        scenarios = [(name, SCENARIOS[name]) for name in args.scenario or SCENARIOS]
+
+    results = [run_isolated(name, scenario, args) for name, scenario in scenarios]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    run()
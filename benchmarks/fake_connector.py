@@ -0,0 +1,121 @@
+"""
+Fake hdb_connector returning synthetic query results, used to benchmark the exporter without
+a HANA database
+
+:since: 2026-10-18
+"""
+
+import collections
+import time
+
+QUERYRESULT = collections.namedtuple('QueryResult', 'records metadata')
+
+METADATA_QUERY_TABLE = 'M_SYSTEM_OVERVIEW'
+TENANT_DATA_QUERY_TABLE = 'M_SERVICES'
+
+
+class FakeHdbConnector(object):
+    """
+    hdb_connector replacement implementing the interface used by SapHanaCollector and
+    DatabaseManager. The results of the metrics file queries have the columns used by their
+    metrics (plus the extra ones) and the given number of rows
+    """
+
+    def __init__(self, metrics_config, database_name='SYSTEMDB', rows=100, extra_columns=0,
+                 latency=0, tenants=0, hana_version='2.00.040.00.1553674765',
+                 fresh_strings=False):
+        """
+        Args:
+            metrics_config (prometheus_metrics.PrometheusMetrics): Loaded metrics file
+            database_name (str, opt): Name of the database returned in the metadata
+            rows (int, opt): Number of rows of each query result
+            extra_columns (int, opt): Number of columns added to each query result that are
+                not used by the metrics
+            latency (float, opt): Seconds to wait in each query
+            tenants (int, opt): Number of tenants returned by the tenants query
+            hana_version (str, opt): Hana version returned in the metadata
+            fresh_strings (bool, opt): Return new string objects in every query, as the
+                database drivers do when they decode the fetched records
+        """
+        self._database_name = database_name
+        self._latency = latency
+        self._tenants = tenants
+        self._hana_version = hana_version
+        self._fresh_strings = fresh_strings
+        self._results = {
+            query.query: self._build_result(query, rows, extra_columns)
+            for query in metrics_config.queries}
+        self._connected = True
+        self.queries = 0
+
+    @staticmethod
+    def _build_result(query, rows, extra_columns):
+        """
+        Build a synthetic result with the columns used by the query metrics
+        """
+        label_columns = []
+        value_columns = []
+        for metric in query.metrics:
+            for label in metric.labels:
+                if label.upper() not in label_columns:
+                    label_columns.append(label.upper())
+            if metric.value.upper() not in value_columns:
+                value_columns.append(metric.value.upper())
+        extra = ['EXTRA_{}'.format(index) for index in range(extra_columns)]
+        columns = label_columns + value_columns + extra
+        records = [
+            tuple('{}_{}'.format(column.lower(), row) for column in label_columns) +
+            tuple(float(row * (index + 1)) for index in range(len(value_columns))) +
+            tuple('extra' for _ in extra)
+            for row in range(rows)]
+        return QUERYRESULT(records, [(column, None) for column in columns])
+
+    def connect(self, host, port=30015, **kwargs):
+        """
+        Connect to the fake database
+        """
+        self._connected = True
+
+    def query(self, sql_statement):
+        """
+        Return the synthetic result of the query after the configured latency
+        """
+        if self._latency:
+            time.sleep(self._latency)
+        self.queries += 1
+        result = self._results.get(sql_statement)
+        if result is not None and self._fresh_strings:
+            return QUERYRESULT([
+                tuple(value.encode('utf-8').decode('utf-8') if isinstance(value, str) else value
+                      for value in record)
+                for record in result.records], result.metadata)
+        if result is not None:
+            return result
+        if METADATA_QUERY_TABLE in sql_statement:
+            return QUERYRESULT(
+                [('PRD', '00', self._database_name, self._hana_version)],
+                [('SID', None), ('INSNR', None), ('DATABASE_NAME', None), ('VERSION', None)])
+        if TENANT_DATA_QUERY_TABLE in sql_statement:
+            return QUERYRESULT(
+                [('SYSTEMDB', 30013)] +
+                [('TENANT{}'.format(index), 30041 + index * 3) for index in range(self._tenants)],
+                [('DATABASE_NAME', None), ('SQL_PORT', None)])
+        return QUERYRESULT([], [])
+
+    def disconnect(self):
+        """
+        Disconnect from the fake database
+        """
+        self._connected = False
+
+    def isconnected(self):
+        """
+        Check the connection status
+        """
+        return self._connected
+
+    def reconnect(self):
+        """
+        Reconnect to the fake database
+        """
+        self._connected = True
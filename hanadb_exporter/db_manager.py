@@ -9,7 +9,10 @@ SAP HANA database manager
 """
 
 import logging
+import threading
+import collections
 import time
+from concurrent import futures
 
 from shaptools import hdb_connector
 from hanadb_exporter import utils
@@ -21,6 +24,8 @@ except ImportError:
     CERTIFI_INSTALLED = False
 
 RECONNECTION_INTERVAL = 15
+# Query used to validate the idle connections
+HEALTH_CHECK_QUERY = 'SELECT 1 FROM DUMMY'
 
 
 class UserKeyNotSupportedError(ValueError):
@@ -29,51 +34,487 @@ class UserKeyNotSupportedError(ValueError):
     """
 
 
+def _fetch_batches(cursor, batch_size):
+    """
+    Fetch the records of the executed cursor in batches
+    """
+    try:
+        while True:
+            records = cursor.fetchmany(batch_size)
+            if not records:
+                return
+            yield records
+    except Exception as err: # pylint:disable=W0703
+        raise hdb_connector.connectors.base_connector.QueryError(
+            'query failed: {}'.format(err)) # pylint:disable=C0209
+
+
+class ConnectionPool(utils.PooledConnector):
+    """
+    Pool of connections to a database. It implements the connector methods used by the
+    collectors, running each query in an idle connection of the pool. The idle connections are
+    validated in background and the broken ones are reconnected, so the collection uses the
+    connections without checking them first
+    """
+
+    # pylint:disable=R0902
+    def __init__(self, connector, connect, size=1, health_check_interval=30):
+        """
+        Args:
+            connector (hdb_connector.HdbConnector): Connected connector, the first connection of
+                the pool
+            connect (callable): Function returning a new connected connector
+            size (int, opt): Number of connections of the pool
+            health_check_interval (float, opt): Seconds between validations of the idle
+                connections. 0 disables the validation
+        """
+        self._logger = logging.getLogger(__name__)
+        self._connect = connect
+        self._size = size
+        self._health_check_interval = health_check_interval
+        self._connections = [connector]
+        self._idle = collections.deque([connector])
+        # Borrowed connections and the statement they run: {connection: sql_statement}
+        self._busy = {}
+        self._condition = threading.Condition()
+        self._healthy = True
+        self._stop_event = threading.Event()
+        self._health_check_thread = None
+
+    @property
+    def size(self):
+        """
+        Get the number of open connections of the pool
+        """
+        return len(self._connections)
+
+    def _acquire(self, connection=None, sql_statement=None):
+        """
+        Borrow an idle connection. It waits until one is available
+
+        Args:
+            connection (hdb_connector.HdbConnector, opt): Borrow this connection if it is idle.
+                It doesn't wait if the connection is busy
+            sql_statement (str, opt): Statement run in the borrowed connection
+
+        Returns:
+            hdb_connector.HdbConnector: Borrowed connection. None if the requested connection
+                is busy
+        """
+        with self._condition:
+            if connection is not None:
+                if connection not in self._idle:
+                    return None
+                self._idle.remove(connection)
+            else:
+                while not self._idle:
+                    self._condition.wait()
+                connection = self._idle.pop()
+            self._busy[connection] = sql_statement
+            return connection
+
+    def _release(self, connection):
+        """
+        Give back a borrowed connection
+        """
+        with self._condition:
+            self._busy.pop(connection, None)
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def _validate(self, connection):
+        """
+        Validate the connection, reconnecting it if it is broken
+
+        Returns:
+            bool: True if the connection is usable
+        """
+        try:
+            connection.query(HEALTH_CHECK_QUERY)
+            return True
+        except hdb_connector.connectors.base_connector.QueryError as err:
+            self._logger.warning('Connection validation failed, reconnecting: %s', str(err))
+        try:
+            connection.reconnect()
+            return True
+        except hdb_connector.connectors.base_connector.ConnectionError as err:
+            self._logger.error('Reconnection failed: %s', str(err))
+            return False
+
+    def _query_failed(self, connection):
+        """
+        Flag the pool as not connected if the failed query broke the connection. The connection
+        is not reconnected here: the background validation (or reconnect) does it, so the
+        collection doesn't wait for a lost database
+        """
+        if not connection.isconnected():
+            self._logger.warning('Pool connection lost, it is reconnected in background')
+            self._healthy = False
+
+    def check(self):
+        """
+        Validate the idle connections. The busy ones are skipped as they are in use
+
+        Returns:
+            bool: True if any connection is usable
+        """
+        healthy = False
+        for connection in list(self._connections):
+            connection = self._acquire(connection)
+            if connection is None:
+                healthy = True
+                continue
+            try:
+                healthy = self._validate(connection) or healthy
+            finally:
+                self._release(connection)
+        self._healthy = healthy
+        return healthy
+
+    def _run(self):
+        """
+        Validation loop
+        """
+        while not self._stop_event.wait(self._health_check_interval):
+            self.check()
+
+    def start(self):
+        """
+        Open the rest of the connections of the pool and start the background validation
+        """
+        for _ in range(self._size - len(self._connections)):
+            try:
+                connection = self._connect()
+            except hdb_connector.connectors.base_connector.ConnectionError as err:
+                self._logger.warning('Could not open a pool connection: %s', str(err))
+                break
+            with self._condition:
+                self._connections.append(connection)
+                self._idle.append(connection)
+                self._condition.notify()
+        if self._health_check_interval > 0:
+            self._stop_event.clear()
+            self._health_check_thread = threading.Thread(
+                target=self._run, name='hanadb_pool_health_check', daemon=True)
+            self._health_check_thread.start()
+
+    def stop(self):
+        """
+        Stop the background validation and close the connections
+        """
+        self._stop_event.set()
+        if self._health_check_thread is not None:
+            self._health_check_thread.join()
+            self._health_check_thread = None
+        for connection in self._connections:
+            connection.disconnect()
+
+    def query(self, sql_statement):
+        """
+        Run the query in an idle connection
+
+        Args:
+            sql_statement (str): SQL query
+        """
+        connection = self._acquire(sql_statement=sql_statement)
+        try:
+            return connection.query(sql_statement)
+        except hdb_connector.connectors.base_connector.QueryError:
+            # The connection is checked only when the query fails, to find broken connections
+            self._query_failed(connection)
+            raise
+        finally:
+            self._release(connection)
+
+    def _fetch_batches(self, connection, cursor, batch_size):
+        """
+        Fetch the records of the executed cursor in batches. The failed fetches are checked as
+        the failed queries
+        """
+        try:
+            yield from _fetch_batches(cursor, batch_size)
+        except (hdb_connector.connectors.base_connector.QueryError,
+                hdb_connector.connectors.base_connector.ConnectionError):
+            self._query_failed(connection)
+            raise
+
+    def _execute(self, connection, sql_statement, batch_size):
+        """
+        Execute the query in a new cursor of the DB-API connection of the connector. The
+        connectors without it return all the records in a single batch
+        """
+        cursor_factory = getattr(utils.dbapi_connection(connection), 'cursor', None)
+        if cursor_factory is None:
+            return utils.stream_query(connection, sql_statement, batch_size)
+        cursor = None
+        try:
+            cursor = cursor_factory()
+            cursor.execute(sql_statement)
+        except Exception as err: # pylint:disable=W0703
+            if cursor is not None:
+                cursor.close()
+            raise hdb_connector.connectors.base_connector.QueryError(
+                'query failed: {}'.format(err)) # pylint:disable=C0209
+        return utils.QueryStream(
+            cursor.description, self._fetch_batches(connection, cursor, batch_size),
+            cursor.close)
+
+    def stream_query(self, sql_statement, batch_size):
+        """
+        Run the query in an idle connection, fetching its records in batches. The connection is
+        borrowed until the returned stream is closed
+
+        Args:
+            sql_statement (str): SQL query
+            batch_size (int): Number of records fetched at once
+
+        Returns:
+            utils.QueryStream: Query result
+        """
+        connection = self._acquire(sql_statement=sql_statement)
+        try:
+            stream = self._execute(connection, sql_statement, batch_size)
+        except (hdb_connector.connectors.base_connector.QueryError,
+                hdb_connector.connectors.base_connector.ConnectionError):
+            self._query_failed(connection)
+            self._release(connection)
+            raise
+        except Exception:
+            self._release(connection)
+            raise
+        stream.on_close(lambda: self._release(connection))
+        return stream
+
+    def cancel_query(self, sql_statement=None):
+        """
+        Cancel the queries running in the pool connections
+
+        Args:
+            sql_statement (str, opt): Cancel only the connections running this statement
+
+        Returns:
+            bool: True if the running queries are cancelled
+        """
+        with self._condition:
+            busy = [
+                connection for connection, statement in self._busy.items()
+                if sql_statement is None or statement == sql_statement]
+        # Every connection is cancelled, even after a failed cancellation
+        cancelled = [utils.cancel_query(connection) for connection in busy]
+        return all(cancelled)
+
+    def isconnected(self):
+        """
+        Check if the pool has usable connections. It uses the result of the latest validation,
+        without querying the database
+        """
+        return self._healthy
+
+    def reconnect(self):
+        """
+        Validate the connections now, reconnecting the broken ones
+        """
+        if not self.check():
+            raise hdb_connector.connectors.base_connector.ConnectionError(
+                'none of the pool connections could be reconnected')
+
+
 class DatabaseManager(object):
     """
     Manage the connection to a multi container HANA system
     """
 
+    # pylint:disable=R0902
     TENANT_DATA_QUERY =\
 """SELECT DATABASE_NAME,SQL_PORT FROM SYS_DATABASES.M_SERVICES
 WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
 
+    # Filter of the tenants query to skip the stopped tenants
+    ACTIVE_TENANTS_FILTER =\
+"""
+AND DATABASE_NAME IN (SELECT DATABASE_NAME FROM M_DATABASES WHERE ACTIVE_STATUS='YES')"""
+
     def __init__(self):
         self._logger = logging.getLogger(__name__)
         self._system_db_connector = hdb_connector.HdbConnector()
+        self._system_db_pool = None
         self._db_connectors = []
+        # Connected tenants: {database: (port, pool)}
+        self._tenants = collections.OrderedDict()
+        self._host = None
+        self._connection_data = None
+        self._pool_size = 1
+        self._health_check_interval = 30
+        self._check_tenant_status = False
+        self._connect_workers = 1
+        self._tenant_timeout = None
+        self._discovery_thread = None
+        self._stop_event = threading.Event()
 
     def _get_tenants_port(self):
         """
         Get tenants port
         """
-        data = self._system_db_connector.query(self.TENANT_DATA_QUERY)
+        query = self.TENANT_DATA_QUERY
+        if self._check_tenant_status:
+            query += self.ACTIVE_TENANTS_FILTER
+        # Once connected, the system database is queried through its pool, so the discovery
+        # doesn't share a connection with a running collection
+        connector = self._system_db_pool or self._system_db_connector
+        data = connector.query(query)
         formatted_data = utils.format_query_result(data)
         for tenant_data in formatted_data:
             if tenant_data['DATABASE_NAME'] != 'SYSTEMDB':
                 yield tenant_data['DATABASE_NAME'], int(tenant_data['SQL_PORT'])
 
-    def _connect_tenants(self, host, connection_data):
+    def _create_pool(self, connector, host, port, connection_data):
         """
-        Connect to the tenants
+        Create the connection pool of a database
 
         Args:
+            connector (hdb_connector.HdbConnector): Connected connector to the database
             host (str): Host of the HANA database
+            port (int): Port of the database
             connection_data (dict): Data retrieved from _get_connection_data
         """
-        for database, tenant_port in self._get_tenants_port():
+        connection_data = dict(connection_data)
+        def connect():
+            """
+            Open a new connection to the database
+            """
             conn = hdb_connector.HdbConnector()
-            # If userkey is used database name must be added to connect to tenants
-            if connection_data.get('userkey'):
-                connection_data['databaseName'] = database
+            conn.connect(host, port, **connection_data)
+            return conn
+
+        pool = ConnectionPool(
+            connector, connect, size=self._pool_size,
+            health_check_interval=self._health_check_interval)
+        pool.start()
+        return pool
+
+    def _connect_tenant(self, host, database, tenant_port, connection_data):
+        """
+        Connect to a tenant
+
+        Args:
+            host (str): Host of the HANA database
+            database (str): Name of the tenant database
+            tenant_port (int): Port of the tenant database
+            connection_data (dict): Data retrieved from _get_connection_data
+
+        Returns:
+            ConnectionPool: Connections to the tenant. None if the connection failed
+        """
+        conn = hdb_connector.HdbConnector()
+        # If userkey is used database name must be added to connect to tenants
+        if connection_data.get('userkey'):
+            connection_data['databaseName'] = database
+        # Only dbapi supports a connection timeout (in milliseconds)
+        if self._tenant_timeout and hdb_connector.API == 'dbapi':
+            connection_data['connectTimeout'] = int(self._tenant_timeout * 1000)
+        try:
+            conn.connect(
+                host, tenant_port, **connection_data)
+            pool = self._create_pool(conn, host, tenant_port, connection_data)
+            self._logger.info('Connected succesfully to TENANT database %s', database)
+            return pool
+        except hdb_connector.connectors.base_connector.ConnectionError as err:
+            self._logger.warning(
+                'Could not connect to TENANT database %s with error: %s', database, str(err))
+            return None
+
+    def _connect_tenants(self, host, connection_data):
+        """
+        Connect to the tenants. The connections are established concurrently
+
+        Args:
+            host (str): Host of the HANA database
+            connection_data (dict): Data retrieved from _get_connection_data
+        """
+        start = time.perf_counter()
+        tenants = list(self._get_tenants_port())
+        with futures.ThreadPoolExecutor(
+                max_workers=self._connect_workers, thread_name_prefix='hanadb_connect') as executor:
+            # Each tenant gets its own copy of the connection data, as it is updated per tenant
+            connections = [
+                (database, tenant_port, executor.submit(
+                    self._connect_tenant, host, database, tenant_port, dict(connection_data)))
+                for database, tenant_port in tenants]
+        for database, tenant_port, future in connections:
+            pool = future.result()
+            if pool is not None:
+                self._tenants[database] = (tenant_port, pool)
+                self._db_connectors.append(pool)
+        self._logger.info(
+            'Connected to %d of %d TENANT databases in %.3f seconds',
+            len(self._tenants), len(tenants), time.perf_counter() - start)
+
+    def _discover_tenants(self):
+        """
+        Discover the tenants again. The new tenants are connected and the dropped or stopped ones
+        are removed from the connectors
+
+        Returns:
+            list: Pools of the removed tenants. They must be stopped once they are not used
+        """
+        tenants = collections.OrderedDict(self._get_tenants_port())
+        removed = []
+        for database, (tenant_port, pool) in list(self._tenants.items()):
+            if tenants.get(database) != tenant_port:
+                self._logger.info(
+                    'TENANT database %s is not available anymore, disconnecting...', database)
+                del self._tenants[database]
+                removed.append(pool)
+        added = []
+        for database, tenant_port in tenants.items():
+            if database in self._tenants:
+                continue
+            pool = self._connect_tenant(
+                self._host, database, tenant_port, dict(self._connection_data))
+            if pool is not None:
+                self._tenants[database] = (tenant_port, pool)
+                added.append(pool)
+        self._db_connectors = [
+            connector for connector in self._db_connectors if connector not in removed] + added
+        return removed
+
+    def _discovery_loop(self, interval, callback):
+        """
+        Tenant discovery loop
+        """
+        while not self._stop_event.wait(interval):
+            removed = []
             try:
-                conn.connect(
-                    host, tenant_port, **connection_data)
-                self._db_connectors.append(conn)
-                self._logger.info('Connected succesfully to TENANT database %s', database)
-            except hdb_connector.connectors.base_connector.ConnectionError as err:
-                self._logger.warn(
-                    'Could not connect to TENANT database %s with error: %s', database, str(err))
+                removed = self._discover_tenants()
+                callback(self.get_connectors())
+            except Exception as err: # pylint:disable=W0703
+                self._logger.error('Tenant discovery failed: %s', str(err))
+            finally:
+                for pool in removed:
+                    pool.stop()
+
+    def start_discovery(self, interval, callback):
+        """
+        Discover the tenants periodically in background
+
+        Args:
+            interval (float): Seconds between two discoveries
+            callback (callable): Function called with the current connectors after each discovery
+        """
+        self._stop_event.clear()
+        self._discovery_thread = threading.Thread(
+            target=self._discovery_loop, args=(interval, callback),
+            name='hanadb_tenant_discovery', daemon=True)
+        self._discovery_thread.start()
+
+    def stop_discovery(self):
+        """
+        Stop the tenant discovery
+        """
+        self._stop_event.set()
+        if self._discovery_thread is not None:
+            self._discovery_thread.join()
+            self._discovery_thread = None
 
     def _get_connection_data(self, userkey, user, password, **kwargs):
         """
@@ -85,7 +526,7 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
                     'userkey usage is not supported with pyhdb connector, hdbcli must be installed')
             self._logger.info('stored user key %s will be used to connect to the database', userkey)
             if user or password:
-                self._logger.warn(
+                self._logger.warning(
                     'userkey will be used to create the connection. user/password are omitted')
         elif user and password:
             self._logger.info('user/password combination will be used to connect to the database')
@@ -100,7 +541,8 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
         if ssl and CERTIFI_INSTALLED:
             trust_store = certifi.where()
         elif ssl:
-            self._logger.warn('certifi package is not installed. Using the default ssl pem key...')
+            self._logger.warning(
+                'certifi package is not installed. Using the default ssl pem key...')
 
         return {
             'userkey': userkey,
@@ -124,10 +566,21 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
             user (str): System database user name (SYSTEM usually)
             password (str): System database user password
             multi_tenant (bool): Connect to all tenants checking the data in the System database
-            timeout (int, opt): Timeout in seconds to connect to the System database
+            timeout (int, opt): Timeout in seconds to connect to the System database. It is also
+                the connection timeout of each tenant (only supported by dbapi)
             ssl (bool, opt): Enable SSL connection
             ssl_validate_cert (bool, opt): Validate SSL certificate. Required in HANA cloud
+            pool_size (int, opt): Number of connections opened to each database
+            health_check_interval (float, opt): Seconds between validations of the idle
+                connections (0 disables the validation)
+            check_tenant_status (bool, opt): Skip the tenants that are not active in M_DATABASES
+            connect_workers (int, opt): Maximum number of tenants connected concurrently
         """
+        self._pool_size = kwargs.get('pool_size', 1)
+        self._health_check_interval = kwargs.get('health_check_interval', 30)
+        self._check_tenant_status = kwargs.get('check_tenant_status', False)
+        self._connect_workers = kwargs.get('connect_workers', 4)
+        self._tenant_timeout = kwargs.get('timeout', 600)
         connection_data = self._get_connection_data(
             kwargs.get('userkey', None),
             kwargs.get('user', ''),
@@ -136,6 +589,7 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
             ssl_validate_cert=kwargs.get('ssl_validate_cert', False)
         )
 
+        start = time.perf_counter()
         current_time = time.time()
         timeout = current_time + kwargs.get('timeout', 600)
         while current_time <= timeout:
@@ -144,7 +598,9 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
                 # pyhdb only uses 'user' and `password`
                 # dbapi uses 'user', 'password', 'userkey' and other optional params
                 self._system_db_connector.connect(host, port, **connection_data)
-                self._db_connectors.append(self._system_db_connector)
+                self._system_db_pool = self._create_pool(
+                    self._system_db_connector, host, port, connection_data)
+                self._db_connectors.append(self._system_db_pool)
                 break
             except hdb_connector.connectors.base_connector.ConnectionError as err:
                 self._logger.error(
@@ -158,12 +614,16 @@ WHERE COORDINATOR_TYPE='MASTER' AND SQL_PORT<>0"""
         else:
             raise hdb_connector.connectors.base_connector.ConnectionError(
                 'timeout reached connecting the System database')
+        self._logger.info(
+            'Connected to the System database in %.3f seconds', time.perf_counter() - start)
 
+        self._host = host
+        self._connection_data = dict(connection_data)
         if kwargs.get('multi_tenant', True):
             self._connect_tenants(host, connection_data)
 
     def get_connectors(self):
         """
-        Get the connectors
+        Get the connectors (a connection pool per database)
         """
         return self._db_connectors
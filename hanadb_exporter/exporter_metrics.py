@@ -0,0 +1,154 @@
+"""
+SAP HANA database prometheus data exporter self monitoring metrics
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.de
+
+:since: 2026-10-18
+"""
+
+import collections
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+QUERY_TIMEOUTS = Counter(
+    'hanadb_exporter_query_timeouts',
+    'Queries cancelled because they exceeded their timeout',
+    ['query', 'database_name'])
+
+QUERY_DURATION = Histogram(
+    'hanadb_exporter_query_duration_seconds',
+    'Duration of the query collection stages: fetch (run the query and get the records), '
+    'format (resolve the result columns) and build (create the metrics)',
+    ['query', 'database_name', 'stage'], buckets=DURATION_BUCKETS)
+
+QUERY_ROWS = Gauge(
+    'hanadb_exporter_query_rows',
+    'Records returned by the last execution of the query',
+    ['query', 'database_name'])
+
+QUERY_ERRORS = Counter(
+    'hanadb_exporter_query_errors',
+    'Queries failed in the database',
+    ['query', 'database_name'])
+
+QUERY_SKIPS = Counter(
+    'hanadb_exporter_query_skips',
+    'Queries not executed or without metrics: cached (the collection interval has not '
+    'expired), empty (no record returned), deadline (the scrape deadline was reached) or '
+    'suspended (the query keeps failing and its circuit breaker is open)',
+    ['query', 'database_name', 'reason'])
+
+QUERY_RESULTS = Counter(
+    'hanadb_exporter_query_results',
+    'Query results compared with the result of the previous execution: unchanged (same '
+    'fingerprint, the previous metrics are reused) or changed (the metrics are built again)',
+    ['query', 'database_name', 'fingerprint'])
+
+QUERY_CIRCUIT_OPEN = Gauge(
+    'hanadb_exporter_query_circuit_open',
+    'Whether the query is suspended after failing repeatedly (1) or not (0)',
+    ['query', 'database_name'])
+
+QUERY_STALE = Gauge(
+    'hanadb_exporter_query_stale',
+    'Whether the metrics of the query come from a previous execution because the scrape '
+    'deadline was reached before running it (1) or not (0)',
+    ['query', 'database_name'])
+
+RECONNECT_DURATION = Histogram(
+    'hanadb_exporter_reconnect_duration_seconds',
+    'Duration of the background reconnection attempts (and metadata retrieval) of a database '
+    'whose connection is lost',
+    ['database_name'], buckets=DURATION_BUCKETS)
+
+DATABASE_UP = Gauge(
+    'hanadb_up',
+    'Whether the database was connected (1) or not (0) in its last collection',
+    ['database_name'])
+
+LAST_SUCCESS = Gauge(
+    'hanadb_exporter_last_success_timestamp_seconds',
+    'Timestamp of the last collection of the database with any successful query',
+    ['database_name'])
+
+QUERYMETRICS = collections.namedtuple(
+    'QueryMetrics',
+    'fetch_duration format_duration build_duration rows errors cached empty deadline stale '
+    'suspended circuit_open unchanged changed')
+
+
+def query_metrics(query_id, database_name):
+    """
+    Get the self monitoring metrics of a query with their labels already set, so they are
+    updated without looking up the labels on every scrape
+
+    Args:
+        query_id (str): Query id
+        database_name (str): Name of the database where the query runs
+
+    Returns:
+        QUERYMETRICS: Labelled metrics of the query
+    """
+    return QUERYMETRICS(
+        fetch_duration=QUERY_DURATION.labels(query_id, database_name, 'fetch'),
+        format_duration=QUERY_DURATION.labels(query_id, database_name, 'format'),
+        build_duration=QUERY_DURATION.labels(query_id, database_name, 'build'),
+        rows=QUERY_ROWS.labels(query_id, database_name),
+        errors=QUERY_ERRORS.labels(query_id, database_name),
+        cached=QUERY_SKIPS.labels(query_id, database_name, 'cached'),
+        empty=QUERY_SKIPS.labels(query_id, database_name, 'empty'),
+        deadline=QUERY_SKIPS.labels(query_id, database_name, 'deadline'),
+        stale=QUERY_STALE.labels(query_id, database_name),
+        suspended=QUERY_SKIPS.labels(query_id, database_name, 'suspended'),
+        circuit_open=QUERY_CIRCUIT_OPEN.labels(query_id, database_name),
+        unchanged=QUERY_RESULTS.labels(query_id, database_name, 'unchanged'),
+        changed=QUERY_RESULTS.labels(query_id, database_name, 'changed'))
+
+
+def _remove(metric, *labelvalues):
+    """
+    Remove the child of the metric with the given label values, if it exists
+    """
+    try:
+        metric.remove(*labelvalues)
+    except KeyError:
+        pass
+
+
+def remove_database_metrics(database_name, query_ids):
+    """
+    Remove the self monitoring series of a database, so a database removed from the collection
+    is not exported anymore
+
+    Args:
+        database_name (str): Name of the database
+        query_ids (list): Ids of the queries collected in the database
+    """
+    for metric in (DATABASE_UP, LAST_SUCCESS, RECONNECT_DURATION):
+        _remove(metric, database_name)
+    for query_id in query_ids:
+        remove_query_metrics(query_id, database_name)
+
+
+def remove_query_metrics(query_id, database_name):
+    """
+    Remove the self monitoring series of a query, so a query removed from the metrics file is
+    not exported anymore
+
+    Args:
+        query_id (str): Id of the query
+        database_name (str): Name of the database
+    """
+    for metric in (QUERY_TIMEOUTS, QUERY_ROWS, QUERY_ERRORS, QUERY_CIRCUIT_OPEN, QUERY_STALE):
+        _remove(metric, query_id, database_name)
+    for stage in ('fetch', 'format', 'build'):
+        _remove(QUERY_DURATION, query_id, database_name, stage)
+    for reason in ('cached', 'empty', 'deadline', 'suspended'):
+        _remove(QUERY_SKIPS, query_id, database_name, reason)
+    for fingerprint in ('unchanged', 'changed'):
+        _remove(QUERY_RESULTS, query_id, database_name, fingerprint)
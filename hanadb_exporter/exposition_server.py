@@ -0,0 +1,431 @@
+"""
+SAP HANA database prometheus data exporter asyncio exposition server
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.de
+
+:since: 2026-10-18
+"""
+
+import asyncio
+import collections
+import gzip
+import logging
+import signal
+import threading
+import time
+import zlib
+from concurrent import futures
+from urllib import parse
+
+from prometheus_client import exposition
+
+from hanadb_exporter import utils
+
+try:
+    current_task = asyncio.current_task
+    all_tasks = asyncio.all_tasks
+except AttributeError: # Python 3.6
+    current_task = asyncio.Task.current_task # pylint:disable=E1101
+    all_tasks = asyncio.Task.all_tasks # pylint:disable=E1101
+
+# Seconds an idle keep-alive connection is kept open
+KEEPALIVE_TIMEOUT = 60
+# Maximum number of headers accepted in a request
+MAX_HEADERS = 100
+
+# Content type prefix of the OpenMetrics format. Its payloads finish with the EOF marker
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text'
+OPENMETRICS_EOF = b'# EOF\n'
+
+HTTPREQUEST = collections.namedtuple('HttpRequest', 'method path version headers')
+
+# Cached payload. compressor is the gzip compressor state after compressing the body (None if
+# the body is not compressed)
+PAYLOAD = collections.namedtuple('Payload', 'body compressor')
+
+STATUS_MESSAGES = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error'
+}
+
+
+class BadRequestError(ValueError):
+    """
+    Malformed HTTP request
+    """
+
+
+class CollectorView(object): # pylint:disable=R0903,R0205
+    """
+    Registry compatible object collecting the metrics of the given function
+    """
+
+    def __init__(self, collect):
+        """
+        Args:
+            collect (callable): Function yielding the metric families
+        """
+        self.collect = collect
+
+
+class PayloadCache(object): # pylint:disable=R0903,R0205
+    """
+    Rendered payloads of the current collection cycle. The registry is rendered once per cycle,
+    format and encoding, and the live metrics (that change on every request) are rendered and
+    appended on each request
+    """
+
+    def __init__(self, registry, generation, live=None):
+        """
+        Args:
+            registry (prometheus_client.CollectorRegistry): Registry with the cached metrics
+            generation (callable): Function returning the current collection cycle. The cached
+                payloads are rendered again when the returned value changes
+            live (obj, opt): Registry compatible object with the metrics rendered on every
+                request
+        """
+        self._registry = registry
+        self._generation = generation
+        self._live = live
+        self._lock = threading.Lock()
+        self._current = None
+        self._payloads = {}
+
+    def _render(self, encoder, openmetrics, compress):
+        """
+        Render the registry
+        """
+        output = encoder(self._registry)
+        if openmetrics and output.endswith(OPENMETRICS_EOF):
+            # The EOF marker is added after the live metrics
+            output = output[:-len(OPENMETRICS_EOF)]
+        if not compress:
+            return PAYLOAD(output, None)
+        # The gzip stream is flushed but not finished, so the live metrics are appended
+        # compressing them with a copy of the compressor
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        body = compressor.compress(output) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return PAYLOAD(body, compressor)
+
+    def get(self, encoder, content_type, compress):
+        """
+        Get the payload
+
+        Args:
+            encoder (callable): Encoder of the requested format
+            content_type (str): Content type of the requested format
+            compress (bool): Compress the payload with gzip
+        """
+        openmetrics = content_type.startswith(OPENMETRICS_CONTENT_TYPE)
+        key = (content_type, compress)
+        with self._lock:
+            generation = self._generation()
+            if generation != self._current:
+                self._current = generation
+                self._payloads = {}
+            payload = self._payloads.get(key)
+            if payload is None:
+                payload = self._render(encoder, openmetrics, compress)
+                self._payloads[key] = payload
+
+        tail = encoder(self._live) if self._live is not None else b''
+        if openmetrics and not tail.endswith(OPENMETRICS_EOF):
+            tail += OPENMETRICS_EOF
+        if compress:
+            compressor = payload.compressor.copy()
+            tail = compressor.compress(tail) + compressor.flush()
+        return payload.body + tail
+
+
+class ExpositionServer(object): # pylint:disable=R0205
+    """
+    HTTP server exposing the metrics of a registry. The connections are handled in an asyncio
+    event loop and the metrics are collected in a dedicated executor, so slow clients do not use
+    any thread and slow collections only use the executor ones
+    """
+
+    # pylint:disable=R0902,R0913,R0917
+    def __init__(
+            self, registry, max_requests=4, payload_cache=None, scrape_timeout=None,
+            scrape_timeout_offset=0.5, encoder_wrapper=None):
+        """
+        Args:
+            registry (prometheus_client.CollectorRegistry): Registry with the exposed metrics
+            max_requests (int, opt): Maximum number of requests rendered concurrently. The rest of
+                the requests wait until one of them finishes
+            payload_cache (PayloadCache, opt): Cache used to serve the requests of all the
+                metrics. If it is not set, the registry is rendered on every request
+            scrape_timeout (float, opt): Scrape timeout in seconds used when the request does
+                not have the X-Prometheus-Scrape-Timeout-Seconds header. The scrapes do not
+                have a deadline if it is not set
+            scrape_timeout_offset (float, opt): Seconds subtracted to the scrape timeout to
+                have time to encode and send the response
+            encoder_wrapper (callable, opt): Function getting the negotiated encoder and content
+                type, and returning the encoder used instead (like
+                prometheus_exporter.direct_encoder)
+        """
+        self._logger = logging.getLogger(__name__)
+        self._registry = registry
+        self._payload_cache = payload_cache
+        self._max_requests = max_requests
+        self._scrape_timeout = scrape_timeout
+        self._scrape_timeout_offset = scrape_timeout_offset
+        self._encoder_wrapper = encoder_wrapper
+        self._executor = None
+        self._loop = None
+        self._stop_event = None
+        self._semaphore = None
+        # Tasks handling the open connections
+        self._connections = set()
+        self.port = None
+        self.started = threading.Event()
+
+    def set_payload_cache(self, payload_cache):
+        """
+        Set the cache used to serve the requests of all the metrics. It can be set while the
+        server is running
+
+        Args:
+            payload_cache (PayloadCache): Payload cache. None to render the registry on every
+                request
+        """
+        self._payload_cache = payload_cache
+
+    @staticmethod
+    async def _read_request(reader):
+        """
+        Read the request line and headers of the next request in the connection
+
+        Returns:
+            HTTPREQUEST: Read request. None if the client has closed the connection
+        """
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError as err:
+            raise BadRequestError('malformed request line') from err
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) == MAX_HEADERS:
+                raise BadRequestError('too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        # The body is not used, but it is read to keep the connection usable
+        content_length = headers.get('content-length', '0')
+        if not content_length.isdigit():
+            raise BadRequestError('invalid content length')
+        if int(content_length):
+            await reader.readexactly(int(content_length))
+        return HTTPREQUEST(method, path, version, headers)
+
+    @staticmethod
+    def _keep_alive(request):
+        """
+        Check if the connection is kept open after the request
+        """
+        connection = request.headers.get('connection', '').lower()
+        if request.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def _scrape_deadline(self, request):
+        """
+        Get the deadline of the request scrape from the X-Prometheus-Scrape-Timeout-Seconds
+        header (or the configured scrape timeout)
+
+        Returns:
+            float: time.monotonic value when the scrape must be finished. None if the scrape
+                does not have a deadline
+        """
+        timeout = self._scrape_timeout
+        header = request.headers.get('x-prometheus-scrape-timeout-seconds')
+        if header is not None:
+            try:
+                timeout = float(header)
+            except ValueError:
+                self._logger.debug('invalid scrape timeout header: %s', header)
+        if timeout is None:
+            return None
+        return time.monotonic() + max(timeout - self._scrape_timeout_offset, 0)
+
+    def _render(self, accept, names, compress, deadline=None):
+        """
+        Collect and encode the metrics. It runs in the executor
+
+        Args:
+            accept (str): Accept header of the request
+            names (list): Names of the metrics to expose. All of them if it is empty
+            compress (bool): Compress the output with gzip
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+        """
+        encoder, content_type = exposition.choose_encoder(accept)
+        if self._encoder_wrapper is not None:
+            encoder = self._encoder_wrapper(encoder, content_type)
+        if self._payload_cache is not None and not names:
+            return self._payload_cache.get(encoder, content_type, compress), content_type
+        registry = self._registry.restricted_registry(names) if names else self._registry
+        with utils.scrape_deadline(deadline):
+            output = encoder(registry)
+        if compress:
+            output = gzip.compress(output)
+        return output, content_type
+
+    async def _write_response(self, writer, request, status, body, headers):
+        """
+        Write the response of the request
+        """
+        lines = ['HTTP/1.1 {} {}'.format(status, STATUS_MESSAGES[status])] # pylint:disable=C0209
+        headers['Content-Length'] = str(len(body))
+        lines.extend(
+            '{}: {}'.format(name, value) # pylint:disable=C0209
+            for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if request is None or request.method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+    async def _handle_request(self, writer, request):
+        """
+        Handle a request
+
+        Returns:
+            bool: True if the connection is kept open
+        """
+        keep_alive = self._keep_alive(request)
+        headers = {'Connection': 'keep-alive' if keep_alive else 'close'}
+        url = parse.urlsplit(request.path)
+        if request.method not in ('GET', 'HEAD'):
+            headers['Allow'] = 'GET, HEAD'
+            await self._write_response(writer, request, 405, b'', headers)
+            return keep_alive
+        if url.path == '/favicon.ico':
+            await self._write_response(writer, request, 404, b'', headers)
+            return keep_alive
+
+        names = parse.parse_qs(url.query).get('name[]', [])
+        compress = 'gzip' in request.headers.get('accept-encoding', '')
+        # The deadline counts the time waiting for the other requests
+        deadline = self._scrape_deadline(request)
+        async with self._semaphore:
+            try:
+                body, content_type = await self._loop.run_in_executor(
+                    self._executor, self._render,
+                    request.headers.get('accept'), names, compress, deadline)
+            except Exception as err: # pylint:disable=W0703
+                self._logger.error('Error rendering the metrics: %s', str(err))
+                await self._write_response(
+                    writer, request, 500, b'error rendering the metrics', headers)
+                return keep_alive
+        headers['Content-Type'] = content_type
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        await self._write_response(writer, request, 200, body, headers)
+        return keep_alive
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Handle the requests of a connection until it is closed
+        """
+        task = current_task()
+        self._connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(reader), KEEPALIVE_TIMEOUT)
+                except BadRequestError as err:
+                    await self._write_response(
+                        writer, None, 400, str(err).encode(), {'Connection': 'close'})
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._handle_request(writer, request)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # The server is stopping. The task finishes normally, as the stream callback of
+            # some python versions fails getting the exception of a cancelled task
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _serve(self, address, port, on_started=None):
+        """
+        Serve until the server is stopped
+        """
+        self._stop_event = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self._max_requests)
+        server = await asyncio.start_server(self._handle_connection, address, port)
+        self.port = server.sockets[0].getsockname()[1]
+        # Signal handlers can only be set in the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._loop.add_signal_handler(signum, self._stop_event.set)
+        self._logger.info('serving metrics in %s:%s', address, self.port)
+        self.started.set()
+        if on_started is not None:
+            on_started()
+
+        await self._stop_event.wait()
+        self._logger.info('stopping the exposition server')
+        server.close()
+        # The open connections (idle or waiting for a rendered payload) are cancelled and
+        # waited for, so no task is left pending when the loop is closed
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await server.wait_closed()
+
+    def _cancel_tasks(self):
+        """
+        Cancel and wait for the tasks left in the loop, like the connections accepted while the
+        server was stopping, whose handlers started after the open connections were cancelled
+        """
+        tasks = [task for task in all_tasks(self._loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    def serve(self, address, port, on_started=None):
+        """
+        Serve the metrics until SIGTERM (or SIGINT) is received or stop is called
+
+        Args:
+            address (str): Listen address
+            port (int): Listen port
+            on_started (callable, opt): Function called once the server is listening (like
+                utils.systemd_ready)
+        """
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self._max_requests, thread_name_prefix='hanadb_exposition')
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve(address, port, on_started))
+        finally:
+            self._cancel_tasks()
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+            self._executor.shutdown(wait=False)
+            self.started.clear()
+
+    def stop(self):
+        """
+        Stop the server. It can be called from any thread
+        """
+        if self._loop is not None and not self._loop.is_closed() and \
+                self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
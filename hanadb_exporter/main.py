@@ -10,21 +10,23 @@ SAP HANA database prometheus data exporter app
 
 import sys
 import os
+import signal
 import traceback
 import logging
 from logging.config import fileConfig
-import time
 import json
 import argparse
+import threading
+import time
 
 from prometheus_client.core import REGISTRY
-from prometheus_client import start_http_server
 
 from hanadb_exporter import __version__
 from hanadb_exporter import prometheus_exporter
 from hanadb_exporter import db_manager
+from hanadb_exporter import exposition_server
+from hanadb_exporter import exporter_metrics
 from hanadb_exporter import utils
-from hanadb_exporter import secrets_manager
 
 LOGGER = logging.getLogger(__name__)
 # in new systems /etc/ folder is not used in favor of /usr/etc
@@ -105,76 +107,243 @@ def lookup_etc_folder(config_files_path):
     raise ValueError(
         'configuration file does not exist in {}'.format(",".join(config_files_path)))
 
+def get_aws_credentials(secret_name):
+    """
+    Get the database credentials stored in AWS secrets manager. The module (and its boto3 and
+    requests dependencies) is only imported when it is used
+    """
+    start = time.perf_counter()
+    from hanadb_exporter import secrets_manager # pylint:disable=C0415
+    LOGGER.info('secrets manager loaded in %.3f seconds', time.perf_counter() - start)
+    return secrets_manager.get_db_credentials(secret_name)
+
+
+def setup_collector(dbs, config, metrics):
+    """
+    Create the collector of the connected databases and register it
+
+    Args:
+        dbs (db_manager.DatabaseManager): Started database manager
+        config (dict): Exporter configuration
+        metrics (str): Path to the metrics file
+
+    Returns:
+        tuple: Registered collector and the payload cache used to serve it (None if the
+            payloads are not cached)
+    """
+    connectors = dbs.get_connectors()
+    collector = prometheus_exporter.SapHanaCollectors(
+        connectors=connectors, metrics_file=metrics,
+        workers=config.get('collection_workers', 1),
+        timeout=config.get('collection_timeout', prometheus_exporter.COLLECTION_TIMEOUT),
+        query_timeout=config.get('query_timeout', None),
+        startup_workers=config.get('startup_workers', 4),
+        query_workers=config.get('query_workers', 1),
+        failure_threshold=config.get('query_failure_threshold', 0),
+        check_privileges=config.get('check_privileges', False),
+        batch_size=config.get('query_batch_size', 0),
+        direct_exposition=config.get('direct_exposition', False),
+        reuse_results=config.get('reuse_unchanged_results', False),
+        label_values_size=config.get(
+            'label_values_cache_size', prometheus_exporter.LABEL_VALUES_SIZE))
+    discovery_interval = config.get('tenant_discovery_interval', 300)
+    if config.get('multi_tenant', True) and discovery_interval > 0:
+        LOGGER.info('tenants are discovered every %s seconds', discovery_interval)
+        dbs.start_discovery(discovery_interval, collector.sync)
+    payload_cache = None
+    if config.get('collection_interval', 0) > 0:
+        LOGGER.info(
+            'metrics are collected in background every %s seconds',
+            config['collection_interval'])
+        collector = prometheus_exporter.SnapshotCollector(
+            collector, config['collection_interval'])
+        collector.start()
+        # The payloads are rendered once per collection cycle. Only the snapshot age is
+        # rendered on every scrape
+        REGISTRY.register(exposition_server.CollectorView(collector.collect_snapshot))
+        payload_cache = exposition_server.PayloadCache(
+            REGISTRY, lambda: collector.generation,
+            live=exposition_server.CollectorView(collector.collect_age))
+    else:
+        REGISTRY.register(collector)
+    LOGGER.info('exporter successfully registered')
+    return collector, payload_cache
+
+
+def start_in_background( # pylint:disable=R0913,R0917
+        dbs, connection, config, metrics, server, state):
+    """
+    Connect to the databases and register the collector while the metrics are already served.
+    If the databases cannot be connected the server is stopped
+
+    Args:
+        dbs (db_manager.DatabaseManager): Database manager
+        connection (tuple): Host, port and keyword arguments of DatabaseManager.start
+        config (dict): Exporter configuration
+        metrics (str): Path to the metrics file
+        server (exposition_server.ExpositionServer): Server exposing the metrics
+        state (dict): Filled with the started collector or the error
+    """
+    start = time.perf_counter()
+    host, port, kwargs = connection
+    try:
+        dbs.start(host, port, **kwargs)
+        # The system database placeholder is removed before the collector reports the
+        # connected databases, so it is never exported if the connection is not to SYSTEMDB
+        exporter_metrics.remove_database_metrics('SYSTEMDB', [])
+        state['collector'], payload_cache = setup_collector(dbs, config, metrics)
+    except Exception as err: # pylint:disable=W0703
+        LOGGER.error('exporter could not be started: %s', str(err))
+        state['error'] = err
+        server.stop()
+        return
+    server.set_payload_cache(payload_cache)
+    LOGGER.info('databases connected in background in %.3f seconds', time.perf_counter() - start)
+
+
+def reload_metrics(state, metrics):
+    """
+    Reload the metrics file in the running collector, keeping the database connections. It is
+    run when the exporter gets SIGHUP
+
+    Args:
+        state (dict): State with the started collector
+        metrics (str): Path to the metrics file
+    """
+    collector = state.get('collector')
+    if collector is None:
+        LOGGER.warning('metrics file not reloaded, the databases are not connected yet')
+        return
+    LOGGER.info('reloading metrics file %s', metrics)
+    collector.reload(metrics)
+
+
+def get_config(args):
+    """
+    Get the exporter configuration from the configuration file or identifier
+
+    Args:
+        args (argparse.Namespace): Command line arguments
+
+    Returns:
+        dict: Exporter configuration
+    """
+    if args.config is not None:
+        return parse_config(args.config)
+    if args.identifier is not None:
+        file_name = args.identifier + '.json'
+        # determine if file is /etc or /usr/etc
+        config_file = lookup_etc_folder([dirname + file_name for dirname in CONFIG_FILES_DIR])
+        return parse_config(config_file)
+    raise ValueError('configuration file or identifier must be used')
+
+
+def get_connection(config):
+    """
+    Get the connection to the databases from the configuration
+
+    Args:
+        config (dict): Exporter configuration
+
+    Returns:
+        tuple: Host, port and keyword arguments of DatabaseManager.start
+    """
+    hana_config = config['hana']
+    user = hana_config.get('user', '')
+    password = hana_config.get('password', '')
+    userkey = hana_config.get('userkey', None)
+    aws_secret_name = hana_config.get('aws_secret_name', '')
+
+    if aws_secret_name:
+        LOGGER.info(
+            'AWS secret name is going to be used to read the database username and password')
+        db_credentials = get_aws_credentials(aws_secret_name)
+        user = db_credentials["username"]
+        password = db_credentials["password"]
+
+    return (hana_config['host'], hana_config.get('port', 30013), {
+        'user': user,
+        'password': password,
+        'userkey': userkey,
+        'multi_tenant': config.get('multi_tenant', True),
+        'timeout': config.get('timeout', 30),
+        'ssl': hana_config.get('ssl', False),
+        'ssl_validate_cert': hana_config.get('ssl_validate_cert', False),
+        'pool_size': config.get('connection_pool_size', 1),
+        'health_check_interval': config.get('health_check_interval', 30),
+        'check_tenant_status': config.get('check_tenant_status', False),
+        'connect_workers': config.get('startup_workers', 4)})
+
+
 # Start up the server to expose the metrics.
 def run():
     """
     Main execution
     """
+    start = time.perf_counter()
     args = parse_arguments()
     if args.version:
         # pylint:disable=C0325
         print("hanadb_exporter %s" % (__version__))
         return
-    if args.config is not None:
-        config = parse_config(args.config)
-    elif args.identifier is not None:
-        file_name = args.identifier + '.json'
-        # determine if file is /etc or /usr/etc
-        config_file = lookup_etc_folder([dirname + file_name for dirname in CONFIG_FILES_DIR])
-        config = parse_config(config_file)
-
-    else:
-        raise ValueError('configuration file or identifier must be used')
+    config = get_config(args)
 
     if config.get('logging', None):
         setup_logging(config)
     else:
         logging.basicConfig(level=args.verbosity or logging.INFO)
 
-    if args.metrics:
-        metrics = args.metrics
-    else:
-        metrics = lookup_etc_folder(METRICS_FILES)
+    metrics = args.metrics or lookup_etc_folder(METRICS_FILES)
 
+    fast_start = config.get('fast_start', False)
     try:
-        hana_config = config['hana']
         dbs = db_manager.DatabaseManager()
-        user = hana_config.get('user', '')
-        password = hana_config.get('password', '')
-        userkey = hana_config.get('userkey', None)
-        aws_secret_name = hana_config.get('aws_secret_name', '')
-
-        if aws_secret_name:
-            LOGGER.info(
-                'AWS secret name is going to be used to read the database username and password')
-            db_credentials = secrets_manager.get_db_credentials(aws_secret_name)
-            user = db_credentials["username"]
-            password = db_credentials["password"]
-
-        dbs.start(
-            hana_config['host'], hana_config.get('port', 30013),
-            user=user,
-            password=password,
-            userkey=userkey,
-            multi_tenant=config.get('multi_tenant', True),
-            timeout=config.get('timeout', 30),
-            ssl=hana_config.get('ssl', False),
-            ssl_validate_cert=hana_config.get('ssl_validate_cert', False))
+        connection = get_connection(config)
+        if not fast_start:
+            dbs.start(connection[0], connection[1], **connection[2])
     except KeyError as err:
-        raise KeyError('Configuration file {} is malformed: {} not found'.format(args.config, err))
+        raise KeyError(
+            'Configuration file {} is malformed: {} not found'.format(args.config, err)) from err
 
-    if args.daemon:
-        utils.systemd_ready()
+    state = {}
+    encoder_wrapper = None
+    if config.get('direct_exposition', False):
+        encoder_wrapper = prometheus_exporter.direct_encoder
+    if fast_start:
+        server = exposition_server.ExpositionServer(
+            REGISTRY, max_requests=config.get('exposition_concurrency', 4), payload_cache=None,
+            scrape_timeout=config.get('scrape_timeout', None), encoder_wrapper=encoder_wrapper)
+        # The system database is reported as down until the connection is established
+        exporter_metrics.DATABASE_UP.labels('SYSTEMDB').set(0)
+        LOGGER.info('fast start enabled, connecting to the databases in background')
+        threading.Thread(
+            target=start_in_background, args=(dbs, connection, config, metrics, server, state),
+            name='hanadb_startup', daemon=True).start()
+    else:
+        state['collector'], payload_cache = setup_collector(dbs, config, metrics)
+        server = exposition_server.ExpositionServer(
+            REGISTRY, max_requests=config.get('exposition_concurrency', 4),
+            payload_cache=payload_cache, scrape_timeout=config.get('scrape_timeout', None),
+            encoder_wrapper=encoder_wrapper)
 
-    connectors = dbs.get_connectors()
-    collector = prometheus_exporter.SapHanaCollectors(connectors=connectors, metrics_file=metrics)
-    REGISTRY.register(collector)
-    LOGGER.info('exporter successfully registered')
+    if hasattr(signal, 'SIGHUP'):
+        # The reload runs in its own thread, as it waits for the running collection
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload_metrics, args=(state, metrics), name='hanadb_reload',
+            daemon=True).start())
 
+    LOGGER.info('exporter started in %.3f seconds', time.perf_counter() - start)
     LOGGER.info('starting to serve metrics')
-    start_http_server(config.get('exposition_port', 9668), config.get('listen_address', '0.0.0.0'))
-    while True:
-        time.sleep(1)
+    # systemd is notified once the metrics port is listening
+    server.serve(
+        config.get('listen_address', '0.0.0.0'), config.get('exposition_port', 9668),
+        on_started=utils.systemd_ready if args.daemon else None)
+    if config.get('collection_interval', 0) > 0 and 'collector' in state:
+        state['collector'].stop()
+    dbs.stop_discovery()
+    LOGGER.info('exporter stopped')
+    if 'error' in state:
+        raise state['error']
 
 if __name__ == "__main__": # pragma: no cover
     run()
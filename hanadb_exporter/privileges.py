@@ -0,0 +1,132 @@
+"""
+SAP HANA database user privileges check
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.de
+
+:since: 2026-10-18
+"""
+
+import re
+
+PRIVILEGES_QUERY = \
+"""SELECT OBJECT_TYPE, SCHEMA_NAME, OBJECT_NAME, PRIVILEGE
+FROM SYS.EFFECTIVE_PRIVILEGES
+WHERE USER_NAME = CURRENT_USER;"""
+
+# Objects read by a query: FROM or JOIN followed by a (optionally schema qualified) name
+IDENTIFIER = r'(?:"[^"]+"|[\w/$#]+)'
+OBJECT_PATTERN = re.compile(
+    r'\b(?:FROM|JOIN)\s+({0})(?:\s*\.\s*({0}))?'.format(IDENTIFIER), # pylint:disable=C0209
+    re.IGNORECASE)
+# FROM used as argument separator of a function, like EXTRACT(YEAR FROM column)
+FUNCTION_PATTERN = re.compile(r'\b(?:EXTRACT|TRIM|SUBSTRING)\s*\([^()]*$', re.IGNORECASE)
+# Names defined in the WITH clause of a query
+CTE_PATTERN = re.compile(
+    r'(?:\bWITH|,)\s*({})\s+AS\s*\('.format(IDENTIFIER), re.IGNORECASE) # pylint:disable=C0209
+
+# Objects readable by any user
+PUBLIC_OBJECTS = {('SYS', 'DUMMY')}
+# System privileges granting the read of the SYS catalog and monitoring views
+CATALOG_PRIVILEGES = ('CATALOG READ', 'DATA ADMIN')
+
+
+def _normalize(identifier):
+    """
+    Get the name of an identifier. Unquoted identifiers are case insensitive (uppercase)
+    """
+    if identifier.startswith('"'):
+        return identifier[1:-1]
+    return identifier.upper()
+
+
+def referenced_objects(sql_statement):
+    """
+    Get the objects read by a query. The objects without schema are public synonyms of the SYS
+    schema ones
+
+    Args:
+        sql_statement (str): Query
+
+    Returns:
+        list: Tuples (schema, object name) in order of appearance
+    """
+    ctes = set(_normalize(name) for name in CTE_PATTERN.findall(sql_statement))
+    objects = []
+    for match in OBJECT_PATTERN.finditer(sql_statement):
+        if FUNCTION_PATTERN.search(sql_statement, 0, match.start()):
+            continue
+        first, second = match.groups()
+        if second:
+            schema, name = _normalize(first), _normalize(second)
+        elif _normalize(first) in ctes:
+            continue
+        else:
+            schema, name = 'SYS', _normalize(first)
+        if (schema, name) not in objects:
+            objects.append((schema, name))
+    return objects
+
+
+class Privileges(object): # pylint:disable=R0205
+    """
+    Effective privileges of the connected user
+    """
+
+    def __init__(self, records):
+        """
+        Args:
+            records (list): Records of PRIVILEGES_QUERY
+        """
+        self._system = set()
+        self._schemas = set()
+        self._objects = set()
+        for object_type, schema, name, privilege in records:
+            if object_type == 'SYSTEMPRIVILEGE':
+                self._system.add(privilege)
+            elif privilege != 'SELECT':
+                continue
+            elif object_type == 'SCHEMA':
+                self._schemas.add(schema or name)
+            else:
+                self._objects.add((schema, name))
+
+    @classmethod
+    def retrieve(cls, connector):
+        """
+        Retrieve the effective privileges of the connected user
+
+        Args:
+            connector (obj): Connected hdb_connector instance
+        """
+        return cls(connector.query(PRIVILEGES_QUERY).records)
+
+    def can_read(self, schema, name):
+        """
+        Check if the user can read the object
+
+        Args:
+            schema (str): Schema of the object
+            name (str): Object name
+        """
+        if (schema, name) in PUBLIC_OBJECTS:
+            return True
+        if schema == 'SYS' and self._system.intersection(CATALOG_PRIVILEGES):
+            return True
+        return schema in self._schemas or (schema, name) in self._objects
+
+    def missing_objects(self, sql_statement):
+        """
+        Get the objects read by the query that the user cannot read
+
+        Args:
+            sql_statement (str): Query
+
+        Returns:
+            list: Names (schema.object) of the objects
+        """
+        return [
+            '{}.{}'.format(schema, name) # pylint:disable=C0209
+            for schema, name in referenced_objects(sql_statement)
+            if not self.can_read(schema, name)]
@@ -8,33 +8,572 @@ SAP HANA database prometheus data exporter
 :since: 2019-05-09
 """
 
+# The collectors and their query pipeline are kept in the same module
+# pylint:disable=C0302
+
+import functools
 import logging
+import random
+import re
+import threading
+import time
+from concurrent import futures
 
 from prometheus_client import core
+from prometheus_client import exposition
+from prometheus_client import parser
+from prometheus_client import utils as client_utils
 from shaptools import hdb_connector
+from hanadb_exporter import exposition_server
 from hanadb_exporter import prometheus_metrics
+from hanadb_exporter import exporter_metrics
+from hanadb_exporter import privileges
 from hanadb_exporter import utils
 
+# Seconds to wait for the concurrent collection of the databases by default
+COLLECTION_TIMEOUT = 60
+# Seconds to wait for a timed out query to finish once it is cancelled
+CANCEL_TIMEOUT = 5
+# Seconds to wait after the first failed reconnection. It is doubled after each failure
+RECONNECT_BACKOFF_BASE = 1
+# Maximum seconds to wait between two reconnection attempts
+RECONNECT_BACKOFF_MAX = 60
+# Seconds a failing query is suspended the first time. It is doubled after each new failure
+QUERY_BACKOFF_BASE = 60
+# Maximum seconds a failing query is suspended
+QUERY_BACKOFF_MAX = 3600
+# Maximum number of label values interned by default
+LABEL_VALUES_SIZE = 100000
+# Label values of the sample rendered to find where the label values go in the exposition lines
+PROBE_LABEL = '\x00{}\x00'
+PROBE_LABEL_PATTERN = re.compile('\x00(\\d+)\x00')
+# Value of the rendered sample, which ends the exposition line
+PROBE_VALUE = ' 0.0\n'
+
+
+class QueryTimeoutError(Exception):
+    """
+    Query exceeded its timeout
+    """
+
+
+class ScrapeDeadlineError(QueryTimeoutError):
+    """
+    Query still running when the scrape deadline was reached
+    """
+
+
+def _encode(encoder, families):
+    """
+    Encode the metric families without the OpenMetrics EOF marker
+    """
+    output = encoder(exposition_server.CollectorView(lambda: families))
+    if output.endswith(exposition_server.OPENMETRICS_EOF):
+        output = output[:-len(exposition_server.OPENMETRICS_EOF)]
+    return output
+
+
+def _escape_label(value):
+    """
+    Escape a label value as the text format does
+    """
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class GaugeTemplate(object): # pylint:disable=R0205
+    """
+    Exposition lines of a gauge, rendered once with the prometheus_client encoders. The samples
+    are written formatting their escaped label values and value in the rendered line
+    """
+
+    def __init__(self, name, documentation, labels, unit, constant_labels=()):
+        """
+        Args:
+            name (str): Metric name
+            documentation (str): Metric description
+            labels (list): Label names
+            unit (str): Metric unit
+            constant_labels (tuple): Values of the first labels, the same in all the samples
+        """
+        self._family = (name, documentation, labels, unit)
+        probe = core.GaugeMetricFamily(name, documentation, None, labels, unit)
+        self.name = probe.name
+        self.documentation = documentation
+        self.unit = unit
+        # Headers by content type. None if the encoder does not render the lines of the template
+        self._headers = {}
+        header, self._probe_line = self._render(exposition.generate_latest)
+        self._headers[exposition.CONTENT_TYPE_LATEST] = header
+        if not self._probe_line.endswith(PROBE_VALUE):
+            raise ValueError(
+                'unexpected exposition line: {}'.format(self._probe_line)) # pylint:disable=C0209
+
+        pieces = PROBE_LABEL_PATTERN.split(self._probe_line[:-len(PROBE_VALUE)])
+        line_format = pieces[0].replace('{', '{{').replace('}', '}}')
+        for index, literal in zip(pieces[1::2], pieces[2::2]):
+            index = int(index)
+            if index < len(constant_labels):
+                value = _escape_label(constant_labels[index]).replace('{', '{{').replace('}', '}}')
+            else:
+                value = '{{{}}}'.format(index - len(constant_labels)) # pylint:disable=C0209
+            line_format += value + literal.replace('{', '{{').replace('}', '}}')
+        self._format = line_format.format
+
+    def _render(self, encoder):
+        """
+        Render the header and the line of a probe sample with the encoder
+        """
+        name, documentation, labels, unit = self._family
+        empty = core.GaugeMetricFamily(name, documentation, None, labels, unit)
+        probe = core.GaugeMetricFamily(name, documentation, None, labels, unit)
+        probe.add_metric([PROBE_LABEL.format(index) for index in range(len(labels))], 0)
+        header = _encode(encoder, [empty])
+        return header, _encode(encoder, [probe])[len(header):].decode('utf-8')
+
+    def header(self, encoder, content_type):
+        """
+        Get the header (HELP and TYPE lines) rendered by the encoder
+
+        Returns:
+            bytes: Rendered header. None if the encoder renders the samples in another format
+        """
+        try:
+            return self._headers[content_type]
+        except KeyError:
+            header, line = self._render(encoder)
+            header = header if line == self._probe_line else None
+            self._headers[content_type] = header
+            return header
+
+    def line(self, labels, value):
+        """
+        Render the exposition line of a sample
+
+        Args:
+            labels (tuple): Values of the labels (without the constant ones)
+            value (float): Sample value
+        """
+        return self._format(*map(_escape_label, labels)) + ' ' + \
+            client_utils.floatToGoString(value) + '\n'
+
+
+class RenderedGauge(object): # pylint:disable=R0205
+    """
+    Gauge metric family whose samples are rendered to exposition lines as they are added,
+    instead of keeping them. The samples are parsed back from the lines if they are requested
+    """
+
+    type = 'gauge'
+
+    def __init__(self, template):
+        """
+        Args:
+            template (GaugeTemplate): Template of the gauge
+        """
+        self.template = template
+        self.name = template.name
+        self.documentation = template.documentation
+        self.unit = template.unit
+        self.lines = []
+
+    def add_metric(self, labels, value):
+        """
+        Add a sample
+
+        Args:
+            labels (tuple): Values of the labels (without the constant ones of the template)
+            value (float): Sample value
+        """
+        self.lines.append(self.template.line(labels, value))
+
+    def render(self, encoder, content_type):
+        """
+        Render the gauge as the encoder does
+
+        Returns:
+            bytes: Rendered gauge. None if the encoder renders the samples in another format
+        """
+        header = self.template.header(encoder, content_type)
+        if header is None:
+            return None
+        return header + ''.join(self.lines).encode('utf-8')
+
+    def _parse(self):
+        """
+        Parse the metric family from the exposition lines
+        """
+        text = self.template.header(
+            exposition.generate_latest, exposition.CONTENT_TYPE_LATEST).decode('utf-8')
+        return next(parser.text_string_to_metric_families(text + ''.join(self.lines)))
+
+    @property
+    def samples(self):
+        """
+        Samples of the gauge
+        """
+        return self._parse().samples
+
+    def _restricted_metric(self, names):
+        """
+        Get the metric family with the samples of the given names (used by the restricted
+        registries)
+        """
+        # Hook of the prometheus_client metric families, it has no public counterpart
+        return self._parse()._restricted_metric(names) # pylint:disable=W0212
+
+
+def direct_encoder(encoder, content_type):
+    """
+    Get the encoder writing the exposition lines of the rendered gauges directly, and the rest
+    of the metric families with the negotiated encoder. The output is the same as the
+    negotiated encoder one
+
+    Args:
+        encoder (callable): Negotiated encoder
+        content_type (str): Content type of the negotiated format
+
+    Returns:
+        callable: Encoder of the registries
+    """
+    openmetrics = content_type.startswith(exposition_server.OPENMETRICS_CONTENT_TYPE)
+
+    def encode(registry):
+        output = []
+        pending = []
+        for metric in registry.collect():
+            rendered = None
+            if isinstance(metric, RenderedGauge):
+                rendered = metric.render(encoder, content_type)
+            if rendered is None:
+                pending.append(metric)
+                continue
+            if pending:
+                output.append(_encode(encoder, pending))
+                pending = []
+            output.append(rendered)
+        if pending:
+            output.append(_encode(encoder, pending))
+        if openmetrics:
+            output.append(exposition_server.OPENMETRICS_EOF)
+        return b''.join(output)
+    return encode
+
 
 class SapHanaCollectors(object):
     """
     SAP HANA database data exporter using multiple db connectors
     """
 
-    def __init__(self, connectors, metrics_file):
+    # The collector options come from the configuration file
+    # pylint:disable=R0902,R0913,R0914,R0917
+    def __init__(self, connectors, metrics_file, workers=1, timeout=COLLECTION_TIMEOUT,
+                 query_timeout=None,
+                 startup_workers=1, query_workers=1, failure_threshold=0,
+                 check_privileges=False, batch_size=0, direct_exposition=False,
+                 reuse_results=False, label_values_size=LABEL_VALUES_SIZE):
+        """
+        Args:
+            connectors (list): Connected hdb_connector instances (one per database)
+            metrics_file (str): Path to the metrics file
+            workers (int, opt): Maximum number of databases collected concurrently. With 1 (the
+                default) the databases are collected one after another
+            timeout (float, opt): Seconds to wait for the concurrent collection. The databases
+                that have not finished by then are skipped in the current scrape. None waits
+                until all of them finish
+            query_timeout (float, opt): Default timeout in seconds of the queries without their
+                own timeout in the metrics file
+            startup_workers (int, opt): Maximum number of collectors created (retrieving the
+                database metadata) concurrently
+            query_workers (int, opt): Maximum number of queries run concurrently in each
+                database
+            failure_threshold (int, opt): Consecutive failures suspending a query (0 never
+                suspends them)
+            check_privileges (bool, opt): Disable the queries reading objects the database user
+                cannot read
+            batch_size (int, opt): Number of records fetched at once. 0 fetches all of them
+            direct_exposition (bool, opt): Render the exposition lines of the samples as they
+                are added to the gauges (to be written with direct_encoder)
+            reuse_results (bool, opt): Reuse the metrics of the previous execution of the
+                queries whose result has not changed
+            label_values_size (int, opt): Maximum number of label values interned, shared by
+                all the databases. 0 disables the interning
+        """
         self._logger = logging.getLogger(__name__)
-        self._collectors = []
+        # The metrics file is loaded once and shared by all the collectors
+        self._metrics_config = prometheus_metrics.PrometheusMetrics(metrics_file)
+        # Options of the collectors, used as well by the ones of the discovered databases
+        self._collector_options = {
+            'query_timeout': query_timeout, 'query_workers': query_workers,
+            'failure_threshold': failure_threshold, 'check_privileges': check_privileges,
+            'batch_size': batch_size, 'direct_exposition': direct_exposition,
+            'reuse_results': reuse_results,
+            'label_values': utils.InternTable(label_values_size)}
+        start = time.perf_counter()
+        if startup_workers > 1 and len(connectors) > 1:
+            with futures.ThreadPoolExecutor(
+                    max_workers=startup_workers, thread_name_prefix='hanadb_startup') as executor:
+                self._collectors = list(executor.map(self._create_collector, connectors))
+        else:
+            self._collectors = [self._create_collector(connector) for connector in connectors]
+        self._logger.info(
+            'Metadata of %d databases retrieved in %.3f seconds',
+            len(self._collectors), time.perf_counter() - start)
+        self._timeout = timeout
+        self._executor = None
+        # Collections that did not finish in time. They are not submitted again until they finish
+        self._pending = {}
+        self._single_flight = utils.SingleFlight()
+        # Held by each collection cycle, so a new metrics file is swapped in between cycles
+        self._cycle_lock = threading.Lock()
+        if workers > 1:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='hanadb_collector')
+
+    def _create_collector(self, connector):
+        """
+        Create the collector of the given connector with the shared options
+        """
+        return SapHanaCollector(connector, self._metrics_config, **self._collector_options)
+
+    def sync(self, connectors):
+        """
+        Update the collectors with the current connectors. The collectors of the new connectors
+        are created and the ones of the removed connectors are stopped
+
+        Args:
+            connectors (list): Connected hdb_connector instances (one per database)
+        """
+        current = {collector.connector: collector for collector in self._collectors}
+        collectors = []
         for connector in connectors:
-            collector = SapHanaCollector(connector, metrics_file)
-            self._collectors.append(collector)
+            collector = current.pop(connector, None)
+            if collector is None:
+                try:
+                    collector = self._create_collector(connector)
+                except Exception as err: # pylint:disable=W0703
+                    self._logger.error('Collector of a new database could not be created: %s',
+                                       str(err))
+                    continue
+                self._logger.info('Database %s added to the collection', collector.database_name)
+            collectors.append(collector)
+        # The list is replaced as a whole, so a running collection keeps using the previous one
+        self._collectors = collectors
+        for collector in current.values():
+            self._logger.info('Database %s removed from the collection', collector.database_name)
+            self._pending.pop(collector, None)
+            collector.stop()
 
     def collect(self):
         """
         Collect metrics for each collector
+
+        Concurrent scrapes share the running collection, so the databases are queried only once
+        no matter how many scrapers are requesting the metrics at the same time. The shared
+        collection uses the deadline of the scrape that started it
+        """
+        deadline = utils.get_scrape_deadline()
+        return self._single_flight.run(lambda: self._collect_cycle(deadline))
+
+    def _collect_cycle(self, deadline=None):
+        """
+        Run a collection cycle
+
+        Args:
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+        """
+        with self._cycle_lock:
+            return list(self._collect(deadline))
+
+    def reload(self, metrics_file):
+        """
+        Load the metrics file again and use it from the next collection cycle. The connections
+        are kept, as well as the state (cached metrics, failures...) of the unchanged queries.
+        If the file cannot be loaded the current queries are kept
+
+        Args:
+            metrics_file (str): Path to the metrics file
+
+        Returns:
+            bool: True if the metrics file is reloaded
+        """
+        start = time.perf_counter()
+        try:
+            metrics_config = prometheus_metrics.PrometheusMetrics(metrics_file)
+        except Exception as err: # pylint:disable=W0703
+            self._logger.error(
+                'Metrics file %s could not be reloaded, keeping the current queries: %s',
+                metrics_file, str(err))
+            return False
+        with self._cycle_lock:
+            added, removed, changed = metrics_config.merge(self._metrics_config)
+            self._metrics_config = metrics_config
+            for collector in self._collectors:
+                collector.set_metrics_config(metrics_config, removed + changed)
+        self._logger.info(
+            'Metrics file %s reloaded in %.3f seconds: %d queries added, %d removed and %d '
+            'changed', metrics_file, time.perf_counter() - start, len(added), len(removed),
+            len(changed))
+        return True
+
+    def _collect(self, deadline=None):
+        """
+        Collect metrics for each collector
+
+        Args:
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+        """
+        if self._executor is None:
+            for collector in self._collectors:
+                yield from collector.collect(deadline)
+        else:
+            yield from self._collect_concurrently(deadline)
+
+    def _collect_concurrently(self, deadline=None):
         """
+        Run the collection of each database in the workers pool and merge the results once all of
+        them have finished (or the timeout or the scrape deadline are reached)
+
+        Args:
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+        """
+        collections = []
         for collector in self._collectors:
-            for metric in collector.collect():
-                yield metric
+            future = self._pending.pop(collector, None)
+            if future is not None and not future.done():
+                self._logger.warning(
+                    'Previous collection of database %s is still running, skipping...',
+                    collector.database_name)
+                self._pending[collector] = future
+                continue
+            future = self._executor.submit(
+                lambda coll=collector: list(coll.collect(deadline)))
+            collections.append((collector, future))
+
+        timeout = self._timeout
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        futures.wait([future for _, future in collections], timeout=timeout)
+
+        for collector, future in collections:
+            if not future.done():
+                self._logger.warning(
+                    'Collection of database %s has not finished in %s seconds, skipping...',
+                    collector.database_name, timeout)
+                self._pending[collector] = future
+                continue
+            try:
+                metrics = future.result()
+            except Exception as err: # pylint:disable=W0703
+                self._logger.error(
+                    'Collection of database %s failed, skipping...', collector.database_name)
+                self._logger.error(str(err))
+                continue
+            yield from metrics
+
+
+class SnapshotCollector(object): # pylint:disable=R0205
+    """
+    Serve the latest collection of the wrapped collector. The collection runs in a background
+    thread with a fixed cadence, so the scrapes don't query the databases
+    """
+
+    def __init__(self, collector, interval):
+        """
+        Args:
+            collector (SapHanaCollectors): Collector used to create the snapshots
+            interval (float): Seconds between the start of two consecutive collections
+        """
+        self._logger = logging.getLogger(__name__)
+        self._collector = collector
+        self._interval = interval
+        # (timestamp, metrics) pair. It is replaced as a whole, so readers always get a
+        # consistent snapshot without locking
+        self._snapshot = (None, ())
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """
+        Run a new collection and swap the served snapshot
+        """
+        metrics = tuple(self._collector.collect())
+        self._snapshot = (time.time(), metrics)
+
+    def _run(self):
+        """
+        Collection loop
+        """
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception as err: # pylint:disable=W0703
+                self._logger.error('Collection failed, serving the previous snapshot...')
+                self._logger.error(str(err))
+            elapsed = time.time() - start
+            self._logger.debug('Collection finished in %.3f seconds', elapsed)
+            self._stop_event.wait(max(0, self._interval - elapsed))
+
+    def reload(self, metrics_file):
+        """
+        Reload the metrics file of the wrapped collector. The new queries are collected from
+        the next snapshot
+
+        Args:
+            metrics_file (str): Path to the metrics file
+        """
+        return self._collector.reload(metrics_file)
+
+    def start(self):
+        """
+        Start the background collection
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='hanadb_snapshot_collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background collection
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def generation(self):
+        """
+        Get the timestamp of the served snapshot. It changes once per collection cycle
+        """
+        return self._snapshot[0]
+
+    def collect_snapshot(self):
+        """
+        Yield the metrics of the latest snapshot
+        """
+        yield from self._snapshot[1]
+
+    def collect_age(self):
+        """
+        Yield the age of the latest snapshot
+        """
+        timestamp = self._snapshot[0]
+        age = core.GaugeMetricFamily(
+            'hanadb_exporter_snapshot_age_seconds',
+            'Seconds since the served collection finished', None, [], 'seconds')
+        if timestamp is not None:
+            age.add_metric([], time.time() - timestamp)
+        yield age
+
+    def collect(self):
+        """
+        Yield the metrics of the latest snapshot and its age
+        """
+        yield from self.collect_snapshot()
+        yield from self.collect_age()
 
 
 class SapHanaCollector(object):
@@ -42,21 +581,133 @@ class SapHanaCollector(object):
     SAP HANA database data exporter
     """
 
+    # The collector options come from the configuration file
+    # pylint:disable=R0902,R0913,R0917
     METADATA_LABEL_HEADERS = ['sid', 'insnr', 'database_name']
 
-    def __init__(self, connector, metrics_file):
+    def __init__(self, connector, metrics_config, query_timeout=None, query_workers=1,
+                 failure_threshold=0, check_privileges=False, batch_size=0,
+                 direct_exposition=False, reuse_results=False, label_values=None):
+        """
+        Args:
+            connector (obj): Connected hdb_connector instance
+            metrics_config (prometheus_metrics.PrometheusMetrics): Loaded metrics file
+            query_timeout (float, opt): Default timeout in seconds of the queries
+            query_workers (int, opt): Maximum number of queries of the database run concurrently.
+                The connector must have as many connections (see db_manager.ConnectionPool)
+            failure_threshold (int, opt): Consecutive failures suspending a query (0 never
+                suspends them). The suspension starts in QUERY_BACKOFF_BASE seconds and it is
+                doubled after each new failure, up to QUERY_BACKOFF_MAX
+            check_privileges (bool, opt): Disable the queries reading objects the database user
+                cannot read (checked in SYS.EFFECTIVE_PRIVILEGES when the metadata is retrieved)
+            batch_size (int, opt): Number of records fetched at once. The samples of each batch
+                are added to the metrics as it arrives, so the whole result is never kept in
+                memory. 0 (the default) fetches all the records at once
+            direct_exposition (bool, opt): Create RenderedGauge gauges, rendering the exposition
+                lines of the samples as they are added instead of keeping the samples
+            reuse_results (bool, opt): Fingerprint the query results, and reuse the metrics of
+                the previous execution when the fingerprint has not changed instead of building
+                them again. The streamed results (batch_size) are not fingerprinted
+            label_values (utils.InternTable, opt): Table interning the label values, so the
+                values repeated in every scrape (and database) share the same strings
+        """
         self._logger = logging.getLogger(__name__)
         self._hdb_connector = connector
+        self._query_timeout = query_timeout
+        self._query_workers = query_workers
+        self._failure_threshold = failure_threshold
+        self._check_privileges = check_privileges
+        self._batch_size = batch_size
+        self._direct_exposition = direct_exposition
+        self._reuse_results = reuse_results
+        if label_values is None:
+            label_values = utils.InternTable(LABEL_VALUES_SIZE)
+        self._label_values = label_values
+        # Interned sid, insnr and database_name labels, added to every sample
+        self._metadata_label_values = ()
+        # Templates of the rendered gauges: {(name, description, labels, unit): GaugeTemplate}
+        self._gauge_templates = {}
+        # Effective privileges of the database user. None if they are not checked
+        self._privileges = None
+        # Circuit breakers of the failing queries: {query: (consecutive failures, retry time)}
+        self._breakers = {}
+        # Connections of the connector. Each cancelled query that is still running keeps one
+        # of them busy
+        self._connections = utils.connection_count(connector)
+        # Queries with timeout run in these threads, so the collection can stop waiting for
+        # them. The running queries plus the cancelled ones that are still running
+        self._query_executor = futures.ThreadPoolExecutor(
+            max_workers=query_workers + self._connections - 1, thread_name_prefix='hanadb_query')
+        # Cancelled queries that are still running. The queries run concurrently, so the set
+        # is guarded by the lock
+        self._cancelled_queries = set()
+        self._query_lock = threading.Lock()
+        # Concurrent collection of the queries (if query_workers is bigger than 1)
+        self._collect_executor = None
+        if query_workers > 1:
+            self._collect_executor = futures.ThreadPoolExecutor(
+                max_workers=query_workers, thread_name_prefix='hanadb_query_collector')
         # metrics_config contains the configuration api/json data
-        self._metrics_config = prometheus_metrics.PrometheusMetrics(metrics_file)
+        self._metrics_config = metrics_config
+        # Built metrics of the queries with a collection interval: {query: (timestamp, metrics)}
+        self._query_cache = {}
+        # Fingerprints of the results the cached metrics were built from: {query: fingerprint}
+        self._result_fingerprints = {}
+        # Queries available in the connected database. Resolved again when the metadata changes
+        self._active_queries = None
+        # Self monitoring metrics by query id
+        self._query_metrics = {}
+        # Background reconnection of a lost connection
+        self._reconnect_thread = None
+        self._reconnect_lock = threading.Lock()
+        self._stop_event = threading.Event()
         self.retrieve_metadata()
 
+    @property
+    def connector(self):
+        """
+        Get the connector of the database
+        """
+        return self._hdb_connector
+
+    @property
+    def database_name(self):
+        """
+        Get the name of the database
+        """
+        return self._database_name
+
     @property
     def metadata_labels(self):
         """
         Get metadata labels data
         """
-        return [self._sid, self._insnr, self._database_name]
+        return list(self._metadata_label_values)
+
+    @property
+    def active_queries(self):
+        """
+        Get the enabled queries available in the connected hana version
+        """
+        if self._active_queries is None:
+            hana_version = utils.parse_version(self._hana_version)
+            self._active_queries = []
+            for query in self._metrics_config.queries:
+                if not query.enabled:
+                    self._logger.info('Query %s is disabled', query.query)
+                elif not query.is_available(hana_version):
+                    self._logger.info('Query %s out of the provided hana version range: %s',
+                                      query.query, query.hana_version_range)
+                else:
+                    missing = self._privileges.missing_objects(query.query) \
+                        if self._privileges is not None else []
+                    if missing:
+                        self._logger.warning(
+                            'Query %s is disabled, the user cannot read: %s',
+                            query.query, ', '.join(missing))
+                        continue
+                    self._active_queries.append(query)
+        return self._active_queries
 
     def retrieve_metadata(self):
         """
@@ -83,99 +734,624 @@ FROM m_database m;"""
         self._sid = formatted_result['SID']
         self._insnr = formatted_result['INSNR']
         self._database_name = formatted_result['DATABASE_NAME']
+        self._metadata_label_values = self._label_values.intern_all(
+            (self._sid, self._insnr, self._database_name))
+        if self._check_privileges:
+            try:
+                self._privileges = privileges.Privileges.retrieve(self._hdb_connector)
+            except hdb_connector.connectors.base_connector.QueryError as err:
+                self._logger.warning(
+                    'Privileges of the database user could not be checked: %s', str(err))
+                self._privileges = None
+        self._active_queries = None
+        self._query_metrics = {}
+        # The metadata labels are part of the templates and the cached metrics
+        self._gauge_templates = {}
+        self._result_fingerprints = {}
         self._logger.info(
             'Metadata retrieved. version: %s, sid: %s, insnr: %s, database: %s',
             self._hana_version, self._sid, self._insnr, self._database_name)
 
-    def _manage_gauge(self, metric, formatted_query_result):
+    def _manage_gauge(self, metric_plan, records):
         """
         Manage Gauge type metric:
         metric is the json.file object for example
-        parse a SQL query and fullfill(formatted_query_result) the metric object from prometheus
+        parse a SQL query and fullfill(records) the metric object from prometheus
 
         Args:
-            metric (dict): a dictionary containing information about the metric
-            formatted_query_result (nested list): query formated by _format_query_result method
+            metric_plan (prometheus_metrics.MetricPlan): metric and its resolved result columns
+            records (list): query result records (tuples)
         """
-        # Add sid, insnr and database_name labels
-        combined_label_headers = self.METADATA_LABEL_HEADERS + metric.labels
-        metric_obj = core.GaugeMetricFamily(
-            metric.name, metric.description, None, combined_label_headers, metric.unit)
-        for row in formatted_query_result:
-            labels = []
-            metric_value = None
-            for column_name, column_value in row.items():
-                try:
-                    labels.insert(metric.labels.index(column_name.lower()), column_value)
-                except ValueError:  # Received data is not a label, check for the lowercased value
-                    if column_name.lower() == metric.value.lower():
-                        metric_value = column_value
-            if metric_value is None:
-                self._logger.warn(
-                    'Specified value in metrics.json for metric "%s": (%s) not found or it is '\
-                    'invalid (None) in the query result',
-                    metric.name, metric.value)
-                continue
-            elif len(labels) != len(metric.labels):
-                # Log when a label(s) specified in metrics.json is not found in the query result
-                self._logger.warn(
-                    'One or more label(s) specified in metrics.json '
-                    'for metric "%s" that are not found in the query result',
-                    metric.name)
-                continue
-            else:
-                # Add sid, insnr and database_name labels
-                combined_labels = self.metadata_labels + labels
-                metric_obj.add_metric(combined_labels, metric_value)
-        self._logger.debug('%s \n', metric_obj.samples)
+        metric_obj, add_records = self._gauge_builder(metric_plan)
+        add_records(records)
+        if not self._direct_exposition:
+            # The samples of the rendered gauges are parsed from their lines
+            self._logger.debug('%s \n', metric_obj.samples)
         return metric_obj
 
-    def reconnect(self):
+    def _intern_labels(self, metric_plans, records):
+        """
+        Intern the label values of the records, so the built samples keep the values shared
+        by all the scrapes instead of the fetched ones
+
+        Args:
+            metric_plans (list): Plans of the query metrics
+            records (list): Query result records
+
+        Returns:
+            list: Records with the interned label values
+        """
+        if self._direct_exposition:
+            # The label values are rendered in the exposition lines right away
+            return records
+        positions = set()
+        for metric_plan in metric_plans:
+            positions.update(metric_plan.label_positions or ())
+        return self._label_values.intern_columns(records, sorted(positions))
+
+    def set_metrics_config(self, metrics_config, outdated_queries=()):
         """
-        Reconnect if needed and retrieve new metadata
+        Use a new metrics file from the next collection
+
+        Args:
+            metrics_config (prometheus_metrics.PrometheusMetrics): Loaded metrics file
+            outdated_queries (list): Queries removed or changed in the new metrics file. Their
+                cached metrics, fingerprints and failures are discarded, and the self
+                monitoring series of the ids not used anymore are removed
+        """
+        query_ids = set(query.id for query in metrics_config.queries)
+        for query in outdated_queries:
+            self._query_cache.pop(query.query, None)
+            self._result_fingerprints.pop(query.query, None)
+            breaker = self._breakers.pop(query.query, None)
+            if query.id not in query_ids:
+                self._query_metrics.pop(query.id, None)
+                exporter_metrics.remove_query_metrics(query.id, self._database_name)
+            elif breaker is not None:
+                self._get_query_metrics(query).circuit_open.set(0)
+        self._metrics_config = metrics_config
+        # The active queries are resolved again in the next collection
+        self._active_queries = None
+
+    def _gauge_template(self, metric):
+        """
+        Get the template of the rendered gauges of the metric
+
+        Args:
+            metric (prometheus_metrics.Metric): Metric of the gauge
+        """
+        key = (metric.name, metric.description, tuple(metric.labels), metric.unit)
+        template = self._gauge_templates.get(key)
+        if template is None:
+            template = GaugeTemplate(
+                metric.name, metric.description, self.METADATA_LABEL_HEADERS + metric.labels,
+                metric.unit, self._metadata_label_values)
+            self._gauge_templates[key] = template
+        return template
+
+    def _gauge_builder(self, metric_plan):
+        """
+        Create the gauge of the metric and the function adding the samples of a list of records
+        to it, so the samples can be added in batches
+
+        Args:
+            metric_plan (prometheus_metrics.MetricPlan): metric and its resolved result columns
+
+        Returns:
+            tuple: Gauge metric family and function adding the records to it
+        """
+        metric = metric_plan.metric
+        if self._direct_exposition:
+            # The metadata labels are rendered in the template
+            metric_obj = RenderedGauge(self._gauge_template(metric))
+            metadata_labels = ()
+        else:
+            # Add sid, insnr and database_name labels
+            combined_label_headers = self.METADATA_LABEL_HEADERS + metric.labels
+            metric_obj = core.GaugeMetricFamily(
+                metric.name, metric.description, None, combined_label_headers, metric.unit)
+            metadata_labels = self._metadata_label_values
+        get_labels = metric_plan.get_labels
+        value_position = metric_plan.value_position
+        if get_labels is None:
+            # Log when a label(s) specified in metrics.json is not found in the query result
+            self._logger.warning(
+                'One or more label(s) specified in metrics.json '
+                'for metric "%s" that are not found in the query result',
+                metric.name)
+            return metric_obj, lambda records: None
+
+        add_metric = metric_obj.add_metric
+        def add_records(records):
+            for record in records:
+                metric_value = record[value_position] if value_position is not None else None
+                if metric_value is None:
+                    self._logger.warning(
+                        'Specified value in metrics.json for metric "%s": (%s) not found or it '\
+                        'is invalid (None) in the query result',
+                        metric.name, metric.value)
+                    continue
+                # Add sid, insnr and database_name labels
+                add_metric(metadata_labels + get_labels(record), metric_value)
+        return metric_obj, add_records
+
+    @property
+    def reconnecting(self):
+        """
+        Check if the background reconnection is running
+        """
+        thread = self._reconnect_thread
+        return thread is not None and thread.is_alive()
+
+    @staticmethod
+    def reconnect_delay(attempt):
+        """
+        Get the seconds to wait after a failed reconnection. The delay grows exponentially and
+        it is randomized, so the databases that failed at the same time don't retry together
+
+        Args:
+            attempt (int): Number of the failed attempt (starting at 0)
+        """
+        delay = min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** attempt)
+        return random.uniform(delay / 2.0, delay)
+
+    def _reconnect_loop(self):
+        """
+        Reconnect and retrieve new metadata, retrying until it succeeds
 
         hdb_connector reconnect already checks if the connection is working, but we need to
-        recheck to run the retrieve_metadata method to update some possible changes
+        run the retrieve_metadata method to update some possible changes
         """
-        if not self._hdb_connector.isconnected():
-            self._hdb_connector.reconnect()
-            self.retrieve_metadata()
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self._hdb_connector.reconnect()
+                self.retrieve_metadata()
+                self._logger.info('Reconnected to the database %s', self._database_name)
+                return
+            except Exception as err: # pylint:disable=W0703
+                delay = self.reconnect_delay(attempt)
+                self._logger.warning(
+                    'Reconnection to the database %s failed, retrying in %.1f seconds: %s',
+                    self._database_name, delay, str(err))
+            finally:
+                exporter_metrics.RECONNECT_DURATION.labels(self._database_name).observe(
+                    time.perf_counter() - start)
+            attempt += 1
+            if self._stop_event.wait(delay):
+                return
 
-    def collect(self):
+    def stop(self):
         """
-        execute db queries defined by metrics_config/api file, and store them in
-        a prometheus metric_object, which will be served over http for scraping e.g gauge, etc.
+        Stop the background tasks of the collector and remove the self monitoring series of the
+        database. Used when the database is removed
         """
-        # Try to reconnect if the connection is lost. It will raise an exception is case of error
-        self.reconnect()
+        self._stop_event.set()
+        self._query_executor.shutdown(wait=False)
+        if self._collect_executor is not None:
+            self._collect_executor.shutdown(wait=False)
+        # The metrics of the queries already collected are removed even if they are not in
+        # the metrics file anymore
+        query_ids = set(self._query_metrics)
+        query_ids.update(query.id for query in self._metrics_config.queries)
+        exporter_metrics.remove_database_metrics(self._database_name, query_ids)
 
-        for query in self._metrics_config.queries:
-            if not query.enabled:
-                self._logger.info('Query %s is disabled', query.query)
-            elif not utils.check_hana_range(self._hana_version, query.hana_version_range):
-                self._logger.info('Query %s out of the provided hana version range: %s',
-                                  query.query, query.hana_version_range)
-            else:
+    def reconnect(self):
+        """
+        Start the reconnection in background if the connection is lost. The collection doesn't
+        wait for it
+
+        Returns:
+            bool: True if the connection is usable
+        """
+        with self._reconnect_lock:
+            if self.reconnecting:
+                return False
+            if self._hdb_connector.isconnected():
+                return True
+            self._logger.warning(
+                'Connection to the database %s lost, reconnecting in background...',
+                self._database_name)
+            self._reconnect_thread = threading.Thread(
+                target=self._reconnect_loop, name='hanadb_reconnect', daemon=True)
+            self._reconnect_thread.start()
+            return False
+
+    def _query(self, query, deadline=None, fetch=None):
+        """
+        Run the query. If it exceeds its timeout the query is cancelled and QueryTimeoutError is
+        raised. If it is still running at the scrape deadline it is cancelled too and
+        ScrapeDeadlineError is raised
+
+        Args:
+            query (prometheus_metrics.Query): Query to run
+            deadline (float, opt): time.monotonic value when the scrape must be finished. The
+                query (with or without timeout) is not waited for beyond it
+            fetch (callable, opt): Function running the query and returning its result. The
+                connector query by default
+        """
+        if fetch is None:
+            fetch = functools.partial(self._hdb_connector.query, query.query)
+        with self._query_lock:
+            # Each cancelled query that is still running keeps one connection busy
+            self._cancelled_queries = set(
+                future for future in self._cancelled_queries if not future.done())
+            if len(self._cancelled_queries) >= self._connections:
+                raise QueryTimeoutError(
+                    'all the connections are still running previously cancelled queries')
+        timeout = query.timeout if query.timeout is not None else self._query_timeout
+        at_deadline = False
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+            at_deadline = not timeout or remaining < timeout
+            if at_deadline:
+                timeout = remaining
+        elif not timeout:
+            return fetch()
+
+        running_query = self._query_executor.submit(fetch)
+        try:
+            return running_query.result(timeout=timeout)
+        except futures.TimeoutError as err:
+            with self._query_lock:
+                self._cancelled_queries.add(running_query)
+            cancelled = utils.cancel_query(self._hdb_connector, query.query)
+            if at_deadline:
+                # The scrape does not wait for the cancellation, the connection is busy until
+                # the query finishes
+                raise ScrapeDeadlineError(
+                    # pylint:disable-next=C0209
+                    'query still running at the scrape deadline after {} seconds{}'.format(
+                        timeout, '' if cancelled else
+                        '. The used connector does not support the cancellation')) from err
+            exporter_metrics.QUERY_TIMEOUTS.labels(query.id, self._database_name).inc()
+            if cancelled:
+                futures.wait([running_query], timeout=CANCEL_TIMEOUT)
+                raise QueryTimeoutError(
+                    # pylint:disable-next=C0209
+                    'query cancelled after {} seconds'.format(timeout)) from err
+            raise QueryTimeoutError(
+                # pylint:disable-next=C0209
+                'query exceeded {} seconds. The used connector does not support the '
+                'cancellation'.format(timeout)) from err
+
+    def _get_query_metrics(self, query):
+        """
+        Get the self monitoring metrics of the query
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+        """
+        query_metrics = self._query_metrics.get(query.id)
+        if query_metrics is None:
+            query_metrics = exporter_metrics.query_metrics(query.id, self._database_name)
+            self._query_metrics[query.id] = query_metrics
+        return query_metrics
+
+    def _query_failed(self, query, query_metrics):
+        """
+        Count a consecutive failure of the query, suspending it once failure_threshold is reached.
+        Only the failures of a connected database are counted
+
+        Args:
+            query (prometheus_metrics.Query): Failed query
+            query_metrics (exporter_metrics.QUERYMETRICS): Self monitoring metrics of the query
+        """
+        if not self._failure_threshold:
+            return
+        failures = self._breakers.get(query.query, (0, 0))[0] + 1
+        retry_time = 0
+        if failures >= self._failure_threshold:
+            delay = min(
+                QUERY_BACKOFF_BASE * 2 ** (failures - self._failure_threshold), QUERY_BACKOFF_MAX)
+            retry_time = time.monotonic() + delay
+            self._logger.warning(
+                'Query %s ... failed %d times in a row, suspended for %d seconds',
+                query.query, failures, delay)
+            query_metrics.circuit_open.set(1)
+        self._breakers[query.query] = (failures, retry_time)
+
+    def _query_succeeded(self, query, query_metrics):
+        """
+        Reset the consecutive failures of the query, resuming it if it was suspended
+
+        Args:
+            query (prometheus_metrics.Query): Succeeded query
+            query_metrics (exporter_metrics.QUERYMETRICS): Self monitoring metrics of the query
+        """
+        breaker = self._breakers.pop(query.query, None)
+        if breaker is not None and breaker[0] >= self._failure_threshold:
+            self._logger.info('Query %s ... succeeded, resumed', query.query)
+            query_metrics.circuit_open.set(0)
+
+    def _stream_metrics(self, query):
+        """
+        Run the query fetching its records in batches, adding the samples of each batch to the
+        metrics as it arrives
+
+        Args:
+            query (prometheus_metrics.Query): Query to run
+
+        Returns:
+            tuple: Number of records, built metrics and the format and build durations
+        """
+        with utils.stream_query(self._hdb_connector, query.query, self._batch_size) as stream:
+            start = time.perf_counter()
+            metric_plans = query.resolve_columns([meta[0] for meta in stream.metadata])
+            format_duration = time.perf_counter() - start
+            start = time.perf_counter()
+            builders = []
+            for metric_plan in metric_plans:
+                metric = metric_plan.metric
+                if metric.type != "gauge":
+                    raise NotImplementedError(
+                        '{} type not implemented'.format(metric.type)) # pylint:disable=C0209
+                builders.append(self._gauge_builder(metric_plan))
+            build_duration = time.perf_counter() - start
+            rows = 0
+            for records in stream.batches():
+                rows += len(records)
+                start = time.perf_counter()
+                records = self._intern_labels(metric_plans, records)
+                for builder in list(builders):
+                    try:
+                        builder[1](records)
+                    except ValueError as err:
+                        # The metric is skipped, as in the records fetched at once
+                        self._logger.error(str(err))
+                        builders.remove(builder)
+                build_duration += time.perf_counter() - start
+        return rows, [builder[0] for builder in builders], format_duration, build_duration
+
+    def _collect_query(self, query, deadline=None): # pylint:disable=R0911
+        """
+        Run the query (unless it is served from the cache) and yield its metrics
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+            deadline (float, opt): time.monotonic value when the scrape must be finished. If it
+                is reached the metrics of the previous execution are served
+
+        Returns:
+            bool: True if the query succeeded or it was served from the cache (the generator
+                return value)
+        """
+        query_metrics = self._get_query_metrics(query)
+        cached = self._query_cache.get(query.query)
+        if cached is not None and query.interval and time.time() - cached[0] < query.interval:
+            self._logger.debug('Query %s ... served from cache', query.query)
+            query_metrics.cached.inc()
+            query_metrics.stale.set(0)
+            yield from cached[1]
+            return True
+        breaker = self._breakers.get(query.query)
+        if breaker is not None and time.monotonic() < breaker[1]:
+            self._logger.debug(
+                'Query %s ... suspended after %d failures, skipping...', query.query, breaker[0])
+            query_metrics.suspended.inc()
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            self._logger.warning(
+                'Scrape deadline reached before running query %s ..., serving its previous '
+                'metrics', query.query)
+            query_metrics.deadline.inc()
+            yield from self._serve_stale(query_metrics, cached)
+            return False
+        query_metrics.stale.set(0)
+        query_time = time.time()
+        try:
+            result = self._run_query(query, query_metrics, deadline)
+        except ScrapeDeadlineError:
+            yield from self._serve_stale(query_metrics, cached)
+            return False
+        if result is None:
+            return False
+        rows, metric_objs, query_result, format_duration, build_duration = result
+        if breaker is not None:
+            self._query_succeeded(query, query_metrics)
+        query_metrics.rows.set(rows)
+        if not rows:
+            self._logger.warning(
+                'Query %s ... has not returned any record', query.query)
+            query_metrics.empty.inc()
+            return True
+        if metric_objs is not None:
+            query_metrics.format_duration.observe(format_duration)
+            query_metrics.build_duration.observe(build_duration)
+            self._query_cache[query.query] = (query_time, metric_objs)
+            yield from metric_objs
+        else:
+            yield from self._build_query_metrics(
+                query, query_result, query_metrics, cached, query_time)
+        return True
+
+    def _run_query(self, query, query_metrics, deadline=None):
+        """
+        Run the query, streaming its metrics if the records are fetched in batches. The failures
+        are logged and counted
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+            query_metrics (exporter_metrics.QUERYMETRICS): Self monitoring metrics of the query
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+
+        Returns:
+            tuple: Number of records, streamed metrics (None if they are not streamed), query
+                result (None if the metrics are streamed) and format and build durations of
+                the streamed metrics. None if the query failed
+
+        Raises:
+            ScrapeDeadlineError: The query was still running at the scrape deadline
+        """
+        start = time.perf_counter()
+        # The streamed records are formatted and built while they are fetched
+        format_duration = build_duration = 0
+        try:
+            if self._batch_size:
+                rows, metric_objs, format_duration, build_duration = self._query(
+                    query, deadline, functools.partial(self._stream_metrics, query))
+                return rows, metric_objs, None, format_duration, build_duration
+            query_result = self._query(query, deadline)
+            return len(query_result.records), None, query_result, 0, 0
+        except ScrapeDeadlineError as err:
+            self._logger.warning(
+                'Scrape deadline reached running query %s ..., serving its previous metrics: %s',
+                query.query, str(err))
+            query_metrics.deadline.inc()
+            raise
+        except QueryTimeoutError as err:
+            self._logger.error('Timeout in query: %s, skipping...', query.query)
+            self._logger.error(str(err))
+        except hdb_connector.connectors.base_connector.QueryError as err:
+            self._logger.error('Failure in query: %s, skipping...', query.query)
+            self._logger.error(str(err))
+            query_metrics.errors.inc()
+            # The failures caused by a lost connection are not failures of the query
+            if self._hdb_connector.isconnected():
+                self._query_failed(query, query_metrics)
+        except hdb_connector.connectors.base_connector.ConnectionError as err:
+            self._logger.error('Connection lost running query: %s, skipping...', query.query)
+            self._logger.error(str(err))
+        finally:
+            query_metrics.fetch_duration.observe(
+                time.perf_counter() - start - format_duration - build_duration)
+        return None
+
+    @staticmethod
+    def _serve_stale(query_metrics, cached):
+        """
+        Yield the metrics of the previous execution of a query that missed the scrape deadline
+
+        Args:
+            query_metrics (exporter_metrics.QUERYMETRICS): Self monitoring metrics of the query
+            cached (tuple): Time and metrics of the previous execution. None if there is none
+        """
+        if cached is not None:
+            query_metrics.stale.set(1)
+            yield from cached[1]
+
+    def _build_query_metrics(self, query, query_result, query_metrics, cached, query_time):
+        """
+        Build and yield the metrics of the query result. The metrics of the previous execution
+        are served instead when the result has not changed and the results are reused
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+            query_result (shaptools.hdb_connector.connectors.base_connector.QueryResult):
+                Query result
+            query_metrics (exporter_metrics.QUERYMETRICS): Self monitoring metrics of the query
+            cached (tuple): Time and metrics of the previous execution. None if there is none
+            query_time (float): time.time value when the query was run
+        """
+        fingerprint = None
+        if self._reuse_results:
+            fingerprint = utils.result_fingerprint(query_result)
+            if cached is not None and self._result_fingerprints.get(query.query) == fingerprint:
+                self._logger.debug('Query %s ... result has not changed', query.query)
+                query_metrics.unchanged.inc()
+                self._query_cache[query.query] = (query_time, cached[1])
+                yield from cached[1]
+                return
+            query_metrics.changed.inc()
+        start = time.perf_counter()
+        metric_plans = query.resolve_columns(
+            [meta[0] for meta in query_result.metadata])
+        query_metrics.format_duration.observe(time.perf_counter() - start)
+        metric_objs = []
+        start = time.perf_counter()
+        records = self._intern_labels(metric_plans, query_result.records)
+        build_duration = time.perf_counter() - start
+        for metric_plan in metric_plans:
+            if metric_plan.metric.type == "gauge":
+                start = time.perf_counter()
                 try:
-                    query_result = self._hdb_connector.query(query.query)
-                except hdb_connector.connectors.base_connector.QueryError as err:
-                    self._logger.error('Failure in query: %s, skipping...', query.query)
+                    metric_obj = self._manage_gauge(metric_plan, records)
+                except ValueError as err:
                     self._logger.error(str(err))
-                    continue  # Moving to the next iteration (query)
-                formatted_query_result = utils.format_query_result(query_result)
-                if not formatted_query_result:
-                    self._logger.warning(
-                        'Query %s ... has not returned any record', query.query)
+                    # If an a ValueError exception is caught, skip the metric and go on to
+                    # complete the rest of the loop
                     continue
-                for metric in query.metrics:
-                    if metric.type == "gauge":
-                        try:
-                            metric_obj = self._manage_gauge(metric, formatted_query_result)
-                        except ValueError as err:
-                            self._logger.error(str(err))
-                            # If an a ValueError exception is caught, skip the metric and go on to
-                            # complete the rest of the loop
-                            continue
-                    else:
-                        raise NotImplementedError('{} type not implemented'.format(metric.type))
-                    yield metric_obj
+                finally:
+                    build_duration += time.perf_counter() - start
+            else:
+                raise NotImplementedError(
+                    '{} type not implemented'.format(metric_plan.metric.type))
+            metric_objs.append(metric_obj)
+            yield metric_obj
+        query_metrics.build_duration.observe(build_duration)
+        # The metrics are kept even without interval, to serve them when the deadline is reached
+        self._query_cache[query.query] = (query_time, metric_objs)
+        if fingerprint is not None:
+            self._result_fingerprints[query.query] = fingerprint
+
+    def _collect_connected_query(self, query, deadline=None):
+        """
+        Collect the query while the connector is connected. Once a query finds the connection
+        lost, the remaining queries of the database are skipped instead of failing one by one
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+        """
+        if not self._hdb_connector.isconnected():
+            return iter(())
+        return self._collect_query(query, deadline)
+
+    def _gather_query(self, query, deadline=None):
+        """
+        Collect the query in a worker of the collection executor
+
+        Args:
+            query (prometheus_metrics.Query): Collected query
+            deadline (float, opt): time.monotonic value when the scrape must be finished
+
+        Returns:
+            tuple: Metrics of the query, and True if the query succeeded
+        """
+        metric_objs = []
+        collected = self._collect_connected_query(query, deadline)
+        while True:
+            try:
+                metric_objs.append(next(collected))
+            except StopIteration as stop:
+                return metric_objs, bool(stop.value)
+
+    def collect(self, deadline=None):
+        """
+        execute db queries defined by metrics_config/api file, and store them in
+        a prometheus metric_object, which will be served over http for scraping e.g gauge, etc.
+
+        Args:
+            deadline (float, opt): time.monotonic value when the scrape must be finished. The
+                queries not started before it are served from their previous execution
+        """
+        # Reconnect in background if the connection is lost. The database is skipped meanwhile
+        if not self.reconnect():
+            self._logger.warning(
+                'Database %s is not connected, skipping its collection...', self._database_name)
+            exporter_metrics.DATABASE_UP.labels(self._database_name).set(0)
+            return
+        exporter_metrics.DATABASE_UP.labels(self._database_name).set(1)
+
+        # The collections where every query failed are not successful
+        succeeded = False
+        if self._collect_executor is None:
+            for query in self.active_queries:
+                query_succeeded = yield from self._collect_connected_query(query, deadline)
+                succeeded = succeeded or bool(query_succeeded)
+        else:
+            # map keeps the order of the queries, so the exposition is stable
+            for metric_objs, query_succeeded in self._collect_executor.map(
+                    lambda query: self._gather_query(query, deadline), self.active_queries):
+                yield from metric_objs
+                succeeded = succeeded or query_succeeded
+        if not self._hdb_connector.isconnected():
+            self._logger.warning(
+                'Connection to the database %s lost during the collection, its remaining '
+                'queries were skipped', self._database_name)
+            exporter_metrics.DATABASE_UP.labels(self._database_name).set(0)
+            self.reconnect()
+            return
+        if succeeded:
+            exporter_metrics.LAST_SUCCESS.labels(self._database_name).set_to_current_time()
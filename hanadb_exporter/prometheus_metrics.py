@@ -11,6 +11,9 @@ SAP HANA database prometheus data exporter metrics
 import logging
 import collections
 import json
+import operator
+
+from hanadb_exporter import utils
 
 
 METRICMODEL = collections.namedtuple(
@@ -19,6 +22,26 @@ METRICMODEL = collections.namedtuple(
 )
 
 
+METRICPLANMODEL = collections.namedtuple(
+    'MetricPlan',
+    'metric label_positions value_position'
+)
+
+
+def _labels_getter(positions):
+    """
+    Get a function returning the labels tuple of a result record
+    """
+    if positions is None:
+        return None
+    if not positions:
+        return lambda record: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda record: (record[position],)
+    return operator.itemgetter(*positions)
+
+
 class Metric(METRICMODEL):
     """
     store loaded prometheus metrics from the config/api (structure inherited from namedtuple)
@@ -39,16 +62,39 @@ class Metric(METRICMODEL):
                                           unit, type, enabled, hana_version_range)
 
 
+class MetricPlan(METRICPLANMODEL):
+    """
+    Metric data resolved for a concrete query result layout (structure inherited from namedtuple).
+    label_positions and value_position are the indexes of the columns in the result records
+    (None if they are not in the result)
+    """
+
+    def __new__(cls, metric, label_positions, value_position):
+        plan = super(MetricPlan, cls).__new__(cls, metric, label_positions, value_position)
+        # Precompiled function to get the labels tuple from a record
+        plan.get_labels = _labels_getter(label_positions)
+        return plan
+
+
 class Query(object):
     """
     Class to store the query and its metrics
     """
 
+    # The query options of the metrics file are kept as attributes
+    # pylint:disable=R0902
     def __init__(self):
         self.query = None
+        self.id = None # pylint:disable=C0103
         self.metrics = []
         self.enabled = True
         self.hana_version_range = ['1.0.0']
+        self._version_range = utils.parse_hana_range(self.hana_version_range)
+        self.interval = 0
+        self.timeout = None
+        self.priority = 0
+        # Resolved metric plans by result columns
+        self._plans = {}
 
     def parse(self, query, query_data):
         """
@@ -56,11 +102,63 @@ class Query(object):
         """
         self.query = query
         self.metrics = []
+        self._plans = {}
         self.enabled = query_data.get('enabled', True)
         self.hana_version_range = query_data.get('hana_version', ['1.0.0'])
+        self._version_range = utils.parse_hana_range(self.hana_version_range)
+        self.interval = query_data.get('interval', 0)
+        self.timeout = query_data.get('timeout', None)
+        self.priority = query_data.get('priority', 0)
         for metric in query_data['metrics']:
             modeled_data = Metric(**metric)
             self.metrics.append(modeled_data)
+        # The id identifies the query in the exporter own metrics. The name of the first metric
+        # is used by default as the query itself is too long to be used as label
+        self.id = query_data.get('id')
+        if self.id is None:
+            self.id = self.metrics[0].name if self.metrics else query[:50]
+
+    @property
+    def definition(self):
+        """
+        Parsed definition of the query, used to find the queries changed in a new metrics file
+        """
+        return (self.query, self.id, self.enabled, self.hana_version_range, self.interval,
+                self.timeout, self.priority, self.metrics)
+
+    def is_available(self, hana_version):
+        """
+        Check if the query is available in the given hana version
+
+        Args:
+            hana_version (tuple): Hana version parsed with utils.parse_version
+        """
+        return utils.in_hana_range(hana_version, self._version_range)
+
+    def resolve_columns(self, columns):
+        """
+        Get the plan of each metric for the given query result columns. The positions of the
+        labels and value of the metrics are found once per result layout and cached, so the
+        result records are mapped with direct index lookups
+
+        Args:
+            columns (list): Column names of the query result
+
+        Returns:
+            list: MetricPlan entries, one per metric
+        """
+        columns = tuple(columns)
+        plans = self._plans.get(columns)
+        if plans is None:
+            positions = {column.lower(): index for index, column in enumerate(columns)}
+            plans = []
+            for metric in self.metrics:
+                label_positions = tuple(positions.get(label) for label in metric.labels)
+                if None in label_positions:
+                    label_positions = None
+                plans.append(MetricPlan(metric, label_positions, positions.get(metric.value)))
+            self._plans[columns] = plans
+        return plans
 
     @classmethod
     def get_model(cls, query, metrics):
@@ -80,6 +178,31 @@ class PrometheusMetrics(object):
     def __init__(self, metrics_file):
         self.queries = self.load_metrics(metrics_file)
 
+    def merge(self, previous):
+        """
+        Compare the queries with the ones of the previously loaded metrics file. The unchanged
+        queries are replaced by the previous ones, so their resolved columns are kept
+
+        Args:
+            previous (PrometheusMetrics): Previously loaded metrics file
+
+        Returns:
+            tuple: Lists of the added, removed and changed queries. The removed and changed
+                ones are the previous queries
+        """
+        previous_queries = {query.query: query for query in previous.queries}
+        added = []
+        changed = []
+        for index, query in enumerate(self.queries):
+            previous_query = previous_queries.pop(query.query, None)
+            if previous_query is None:
+                added.append(query)
+            elif previous_query.definition != query.definition:
+                changed.append(previous_query)
+            else:
+                self.queries[index] = previous_query
+        return added, list(previous_queries.values()), changed
+
     @classmethod
     def load_metrics(cls, metrics_file):
         """
@@ -99,4 +222,7 @@ class PrometheusMetrics(object):
             logger.error(str(err))
             raise
 
+        # The queries with higher priority run first. The sort is stable, so the queries with
+        # the same priority keep the file order
+        queries.sort(key=lambda query: query.priority, reverse=True)
         return queries
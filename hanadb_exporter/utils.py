@@ -8,16 +8,144 @@ Generic methods
 :since: 2019-07-04
 """
 
+import re
+import hashlib
 import socket
 import os
+import threading
+import contextlib
 
-from distutils import version
+VERSION_COMPONENTS = re.compile(r'(\d+|[a-z]+|\.)')
+
+# Deadline of the scrape rendered in the current thread
+_SCRAPE = threading.local()
 
 class NotSystemdException(Exception):
     """
     The exporter is not running as systemd daemon
     """
 
+class _FlightCall(object): # pylint:disable=R0903,R0205
+    """
+    In-flight call shared by SingleFlight callers
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object): # pylint:disable=R0903,R0205
+    """
+    Coalesce concurrent executions of the same function. Callers arriving while a call is
+    running wait for it and get its result (or exception) instead of running it again
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+
+    def run(self, func):
+        """
+        Run func, or wait for the running call if there is one
+
+        Args:
+            func (callable): Function without arguments to run
+
+        Returns:
+            The value returned by func
+        """
+        with self._lock:
+            call = self._call
+            leader = call is None
+            if leader:
+                call = self._call = _FlightCall()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                self._call = None
+            call.done.set()
+        return call.result
+
+class InternTable(object): # pylint:disable=R0205
+    """
+    Bounded table of interned strings, so the equal values (like the label values repeated in
+    every scrape) share the same object. Once the table is full it is emptied, so the memory
+    used does not grow with the uptime
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size (int): Maximum number of strings in the table. 0 disables the interning
+        """
+        self._max_size = max_size
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def intern(self, value):
+        """
+        Get the interned value. Only strings are interned, as equal values of other types
+        (like 1 and 1.0) are rendered differently
+        """
+        if not isinstance(value, str) or not self._max_size:
+            return value
+        interned = self._values.get(value)
+        if interned is None:
+            if len(self._values) >= self._max_size:
+                self._values.clear()
+            self._values[value] = interned = value
+        return interned
+
+    def intern_all(self, values):
+        """
+        Get the tuple of the interned values
+        """
+        return tuple(map(self.intern, values))
+
+    def intern_columns(self, records, positions):
+        """
+        Intern the strings of the given columns of the records. The values of a column have
+        the same type, so each column is interned at once (without checking every value)
+
+        Args:
+            records (list): Records of a query result
+            positions (list): Indexes of the interned columns
+
+        Returns:
+            list: Records (tuples) with the interned values. The given records if none of the
+                columns has strings
+        """
+        if not self._max_size or not records or not positions:
+            return records
+        columns = list(zip(*records))
+        intern = self._values.setdefault
+        interned = False
+        for position in positions:
+            column = columns[position]
+            first = next((value for value in column if value is not None), None)
+            if isinstance(first, str):
+                columns[position] = tuple(map(intern, column, column))
+                interned = True
+        if len(self._values) > self._max_size:
+            self._values.clear()
+        return list(zip(*columns)) if interned else records
+
+
 # TODO: this method could go in shaptools itself, providing the query return formatted if
 # it is requested (returning a list of dictionaries like this method)
 def format_query_result(query_result):
@@ -39,6 +167,250 @@ def format_query_result(query_result):
     return formatted_query_result
 
 
+def result_fingerprint(query_result):
+    """
+    Get the fingerprint of a query result: the digest of its columns and records, so two
+    results are compared without keeping the records
+
+    Args:
+        query_result (obj): QueryResult object
+
+    Returns:
+        bytes: Fingerprint of the result
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr([meta[0] for meta in query_result.metadata]).encode('utf-8'))
+    digest.update(repr([tuple(record) for record in query_result.records]).encode('utf-8'))
+    return digest.digest()
+
+
+@contextlib.contextmanager
+def scrape_deadline(deadline):
+    """
+    Set the deadline of the scrape rendered in the current thread, so the collectors called by
+    the prometheus_client encoders can get it
+
+    Args:
+        deadline (float): time.monotonic value when the scrape must be finished. None if the
+            scrape has no deadline
+    """
+    previous = getattr(_SCRAPE, 'deadline', None)
+    _SCRAPE.deadline = deadline
+    try:
+        yield
+    finally:
+        _SCRAPE.deadline = previous
+
+
+def get_scrape_deadline():
+    """
+    Get the deadline of the scrape rendered in the current thread (None if it has no deadline)
+    """
+    return getattr(_SCRAPE, 'deadline', None)
+
+
+class QueryStream(object): # pylint:disable=R0205
+    """
+    Result of a query fetched in batches. It must be closed once it is read, releasing the
+    resources used to fetch the records
+    """
+
+    def __init__(self, metadata, batches, close=None):
+        """
+        Args:
+            metadata (list): Description of the result columns (DB-API cursor description)
+            batches (iterable): Lists of records
+            close (callable, opt): Function called when the stream is closed
+        """
+        self.metadata = metadata
+        self._batches = batches
+        self._close_callbacks = [close] if close is not None else []
+
+    def batches(self):
+        """
+        Iterate over the lists of records as they are fetched
+        """
+        return iter(self._batches)
+
+    def on_close(self, callback):
+        """
+        Add a function called when the stream is closed
+        """
+        self._close_callbacks.append(callback)
+
+    def close(self):
+        """
+        Close the stream. It can be called more than once
+        """
+        callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PooledConnector(object): # pylint:disable=R0205
+    """
+    Interface of the connectors running the queries in several connections (the connection
+    pools). The rest of the connectors are hdb_connector instances with a single connection
+    """
+
+    @property
+    def size(self):
+        """
+        Get the number of open connections
+        """
+        raise NotImplementedError
+
+    def stream_query(self, sql_statement, batch_size):
+        """
+        Run the query fetching its records in batches
+
+        Args:
+            sql_statement (str): SQL query
+            batch_size (int): Number of records fetched at once
+
+        Returns:
+            QueryStream: Query result
+        """
+        raise NotImplementedError
+
+    def cancel_query(self, sql_statement=None):
+        """
+        Cancel the statements running in the connections
+
+        Args:
+            sql_statement (str, opt): Cancel only the connections running this statement
+
+        Returns:
+            bool: True if the running statements are cancelled
+        """
+        raise NotImplementedError
+
+
+def dbapi_connection(connector):
+    """
+    Get the dbapi (hdbcli) connection of the hdb_connector instance. The connectors don't expose
+    the cursors nor the cancellation, so their connection is used directly. It is only accessed
+    through this function
+
+    Args:
+        connector (obj): hdb_connector instance
+
+    Returns:
+        obj: dbapi connection. None if the connector doesn't use dbapi
+    """
+    return getattr(connector, '_connection', None)
+
+
+def stream_query(connector, sql_statement, batch_size):
+    """
+    Run the query fetching its records in batches. Only the connection pools fetch them
+    progressively, the rest of the connectors return all the records in a single batch
+
+    Args:
+        connector (obj): hdb_connector instance or connection pool
+        sql_statement (str): SQL query
+        batch_size (int): Number of records fetched at once
+
+    Returns:
+        QueryStream: Query result
+    """
+    if isinstance(connector, PooledConnector):
+        return connector.stream_query(sql_statement, batch_size)
+    query_result = connector.query(sql_statement)
+    return QueryStream(
+        query_result.metadata, [query_result.records] if query_result.records else [])
+
+
+def connection_count(connector):
+    """
+    Get the number of connections of the connector. Connection pools have several of them
+
+    Args:
+        connector (obj): hdb_connector instance or connection pool
+    """
+    if isinstance(connector, PooledConnector):
+        return connector.size
+    return 1
+
+
+def cancel_query(connector, sql_statement=None):
+    """
+    Cancel the statement running in the connector. Only the dbapi (hdbcli) connections support
+    the cancellation, which the connectors don't expose, so their connection is used directly
+
+    Args:
+        connector (obj): hdb_connector instance
+        sql_statement (str, opt): Statement to cancel. Connection pools only cancel the
+            connections running it (all the running statements if it is not set)
+
+    Returns:
+        bool: True if the statement has been cancelled
+    """
+    # Connection pools cancel the statements running in their connections
+    if isinstance(connector, PooledConnector):
+        return connector.cancel_query(sql_statement)
+    cancel = getattr(dbapi_connection(connector), 'cancel', None)
+    if cancel is None:
+        return False
+    try:
+        return bool(cancel())
+    except Exception: # pylint:disable=W0703
+        return False
+
+
+def parse_version(version_string):
+    """
+    Parse a version string in a comparable tuple. The version is split in its numeric and
+    alphabetic components, as distutils LooseVersion does
+
+    Args:
+        version_string (str): Version string (e.g. 2.00.040.00.1553674765)
+
+    Returns:
+        tuple: Version components
+    """
+    return tuple(
+        int(component) if component.isdigit() else component
+        for component in VERSION_COMPONENTS.split(version_string)
+        if component and component != '.')
+
+def parse_hana_range(availability_range):
+    """
+    Parse the hana versions availability range
+
+    Args:
+        availability_range (list): List with one or two elements definining the
+            available hana versions
+
+    Returns:
+        tuple: Parsed versions of the range
+    """
+    if len(availability_range) not in (1, 2):
+        raise ValueError(
+            'provided availability range does not have the correct number of elements')
+    return tuple(parse_version(range_version) for range_version in availability_range)
+
+def in_hana_range(hana_version, availability_range):
+    """
+    Check if the current hana version is inside the available range
+
+    Args:
+        hana_version (tuple): Current hana version parsed with parse_version
+        availability_range (tuple): Availability range parsed with parse_hana_range
+
+    Returns:
+        bool: True if the current hana version is inside the availability range
+    """
+    if hana_version < availability_range[0]:
+        return False
+    return len(availability_range) == 1 or hana_version <= availability_range[1]
+
 def check_hana_range(hana_version, availability_range):
     """
     Check if the current hana version is inside the available range
@@ -51,13 +423,7 @@ def check_hana_range(hana_version, availability_range):
     Returns:
         bool: True if the current hana version is inside the availability range
     """
-
-    if len(availability_range) == 1:
-        return version.LooseVersion(hana_version) >= version.LooseVersion(availability_range[0])
-    elif len(availability_range) == 2:
-        return version.LooseVersion(hana_version) >= version.LooseVersion(availability_range[0]) \
-            and version.LooseVersion(hana_version) <= version.LooseVersion(availability_range[1])
-    raise ValueError('provided availability range does not have the correct number of elements')
+    return in_hana_range(parse_version(hana_version), parse_hana_range(availability_range))
 
 def systemd_ready():
     """
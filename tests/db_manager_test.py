@@ -12,6 +12,7 @@ Unitary tests for exporters/db_manager.py.
 
 import os
 import sys
+import threading
 import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -39,6 +40,17 @@ class TestDatabaseManager(object):
         self._db_manager = db_manager.DatabaseManager()
         mock_hdb.assert_called_once_with()
 
+    @mock.patch('hanadb_exporter.db_manager.utils.format_query_result')
+    def test_get_tenants_port_active(self, mock_format_query):
+        self._db_manager._system_db_pool = mock.Mock()
+        self._db_manager._check_tenant_status = True
+        mock_format_query.return_value = [{'DATABASE_NAME': 'PRD', 'SQL_PORT': '30040'}]
+
+        assert list(self._db_manager._get_tenants_port()) == [('PRD', 30040)]
+        self._db_manager._system_db_pool.query.assert_called_once_with(
+            db_manager.DatabaseManager.TENANT_DATA_QUERY +
+            db_manager.DatabaseManager.ACTIVE_TENANTS_FILTER)
+
     @mock.patch('hanadb_exporter.db_manager.utils.format_query_result')
     def test_get_tenants_port(self, mock_format_query):
         self._db_manager._system_db_connector = mock.Mock()
@@ -69,6 +81,7 @@ class TestDatabaseManager(object):
 
         connection_data = {'mock_data': 'data'}
 
+        self._db_manager._create_pool = mock.Mock(side_effect=['pool1', 'pool2', 'pool3'])
         self._db_manager._connect_tenants('10.10.10.10', connection_data)
 
         assert mock_hdb.call_count == 3
@@ -77,7 +90,7 @@ class TestDatabaseManager(object):
         mock_conn2.connect.assert_called_once_with('10.10.10.10', 2, **connection_data)
         mock_conn3.connect.assert_called_once_with('10.10.10.10', 3, **connection_data)
 
-        assert self._db_manager._db_connectors == [mock_conn1, mock_conn2, mock_conn3]
+        assert self._db_manager._db_connectors == ['pool1', 'pool2', 'pool3']
 
     @mock.patch('hanadb_exporter.db_manager.hdb_connector.HdbConnector')
     def test_connect_tenants_userkey(self, mock_hdb):
@@ -98,6 +111,7 @@ class TestDatabaseManager(object):
             {'mock_data': 'data', 'userkey': 'userkey', 'databaseName': 'db3'}
         ]
 
+        self._db_manager._create_pool = mock.Mock(side_effect=['pool1', 'pool2', 'pool3'])
         self._db_manager._connect_tenants('10.10.10.10', connection_data)
 
         assert mock_hdb.call_count == 3
@@ -106,12 +120,52 @@ class TestDatabaseManager(object):
         mock_conn2.connect.assert_called_once_with('10.10.10.10', 2, **updated_connection_data[1])
         mock_conn3.connect.assert_called_once_with('10.10.10.10', 3, **updated_connection_data[2])
 
-        assert self._db_manager._db_connectors == [mock_conn1, mock_conn2, mock_conn3]
+        assert self._db_manager._db_connectors == ['pool1', 'pool2', 'pool3']
+        assert [call[0][:3] for call in self._db_manager._create_pool.call_args_list] == [
+            (mock_conn1, '10.10.10.10', 1),
+            (mock_conn2, '10.10.10.10', 2),
+            (mock_conn3, '10.10.10.10', 3)
+        ]
+
+    @mock.patch('logging.Logger.info')
+    def test_connect_tenants_concurrently(self, mock_info):
+        self._db_manager._get_tenants_port = mock.Mock(return_value=[
+            ('db1', 1), ('db2', 2), ('db3', 3)])
+        self._db_manager._connect_workers = 3
+        # All the tenants must be connecting at the same time to pass the barrier
+        barrier = threading.Barrier(3, timeout=5)
+        def connect_tenant(host, database, tenant_port, connection_data):
+            barrier.wait()
+            connection_data['databaseName'] = database
+            return None if database == 'db2' else 'pool_{}'.format(database)
+        self._db_manager._connect_tenant = mock.Mock(side_effect=connect_tenant)
+        connection_data = {'mock_data': 'data'}
+
+        self._db_manager._connect_tenants('10.10.10.10', connection_data)
+
+        assert self._db_manager._db_connectors == ['pool_db1', 'pool_db3']
+        assert list(self._db_manager._tenants.items()) == [
+            ('db1', (1, 'pool_db1')), ('db3', (3, 'pool_db3'))]
+        assert connection_data == {'mock_data': 'data'}
+        mock_info.assert_called_once_with(
+            'Connected to %d of %d TENANT databases in %.3f seconds', 2, 3, mock.ANY)
+
+    @mock.patch('hanadb_exporter.db_manager.hdb_connector')
+    def test_connect_tenant_timeout(self, mock_api):
+        mock_api.API = 'dbapi'
+        self._db_manager._tenant_timeout = 30
+        self._db_manager._create_pool = mock.Mock(return_value='pool')
+        connection_data = {'mock_data': 'data'}
+
+        assert self._db_manager._connect_tenant(
+            '10.10.10.10', 'db1', 1, connection_data) == 'pool'
+        mock_api.HdbConnector.return_value.connect.assert_called_once_with(
+            '10.10.10.10', 1, mock_data='data', connectTimeout=30000)
 
-    @mock.patch('logging.Logger.warn')
+    @mock.patch('logging.Logger.warning')
     @mock.patch('hanadb_exporter.db_manager.hdb_connector.connectors.base_connector')
     @mock.patch('hanadb_exporter.db_manager.hdb_connector.HdbConnector')
-    def test_connect_tenants_error_connecting(self, mock_hdb, mock_connector, mock_warn):
+    def test_connect_tenants_error_connecting(self, mock_hdb, mock_connector, mock_warning):
 
         self._db_manager._get_tenants_port = mock.Mock(return_value=[
             ('db1', 1), ('db2', 2),('db3', 3)])
@@ -131,6 +185,7 @@ class TestDatabaseManager(object):
             {'mock_data': 'data', 'userkey': 'userkey', 'databaseName': 'db3'}
         ]
 
+        self._db_manager._create_pool = mock.Mock(side_effect=['pool1', 'pool2', 'pool3'])
         self._db_manager._connect_tenants('10.10.10.10', connection_data)
 
         assert mock_hdb.call_count == 3
@@ -139,8 +194,8 @@ class TestDatabaseManager(object):
         mock_conn2.connect.assert_called_once_with('10.10.10.10', 2, **updated_connection_data[1])
         mock_conn3.connect.assert_called_once_with('10.10.10.10', 3, **updated_connection_data[2])
 
-        assert self._db_manager._db_connectors == [mock_conn1, mock_conn2]
-        mock_warn.assert_called_once_with(
+        assert self._db_manager._db_connectors == ['pool1', 'pool2']
+        mock_warning.assert_called_once_with(
             'Could not connect to TENANT database %s with error: %s', 'db3', str('err'))
 
     def test_get_connection_data_invalid_data(self):
@@ -170,7 +225,7 @@ class TestDatabaseManager(object):
             in str(err.value)
 
     @mock.patch('hanadb_exporter.db_manager.hdb_connector')
-    @mock.patch('logging.Logger.warn')
+    @mock.patch('logging.Logger.warning')
     @mock.patch('logging.Logger.info')
     def test_get_connection_data_userkey(self, logger,logger_warn, mock_api):
 
@@ -184,7 +239,7 @@ class TestDatabaseManager(object):
         assert logger_warn.call_count == 0
 
     @mock.patch('hanadb_exporter.db_manager.hdb_connector')
-    @mock.patch('logging.Logger.warn')
+    @mock.patch('logging.Logger.warning')
     @mock.patch('logging.Logger.info')
     def test_get_connection_data_userkey_warn(self, logger,logger_warn, mock_api):
 
@@ -319,13 +374,16 @@ class TestDatabaseManager(object):
         self._db_manager._system_db_connector = mock.Mock()
         self._db_manager._connect_tenants = mock.Mock()
 
+        self._db_manager._create_pool = mock.Mock(return_value='pool')
+
         self._db_manager._system_db_connector.connect.side_effect = [
             mock_exception.ConnectionError('err'),
             mock_exception.ConnectionError('err'),
             None]
 
         self._db_manager.start(
-            '10.10.10.10', 30013, user='user', password='pass', multi_tenant=False, timeout=2)
+            '10.10.10.10', 30013, user='user', password='pass', multi_tenant=False, timeout=2,
+            pool_size=2, health_check_interval=10)
 
         self._db_manager._system_db_connector.connect.assert_has_calls([
             mock.call('10.10.10.10', 30013, **connection_data),
@@ -343,7 +401,11 @@ class TestDatabaseManager(object):
             mock.call('the connection to the system database failed. error message: %s', 'err')
         ])
 
-        assert self._db_manager._db_connectors == [self._db_manager._system_db_connector]
+        assert self._db_manager._db_connectors == ['pool']
+        self._db_manager._create_pool.assert_called_once_with(
+            self._db_manager._system_db_connector, '10.10.10.10', 30013, connection_data)
+        assert self._db_manager._pool_size == 2
+        assert self._db_manager._health_check_interval == 10
         self._db_manager._connect_tenants.assert_not_called()
 
     @mock.patch('hanadb_exporter.db_manager.hdb_connector.connectors.base_connector')
@@ -361,6 +423,8 @@ class TestDatabaseManager(object):
         self._db_manager._system_db_connector = mock.Mock()
         self._db_manager._connect_tenants = mock.Mock()
 
+        self._db_manager._create_pool = mock.Mock(return_value='pool')
+
         self._db_manager._system_db_connector.connect.side_effect = [
             mock_exception.ConnectionError('err'),
             mock_exception.ConnectionError('err'),
@@ -385,10 +449,294 @@ class TestDatabaseManager(object):
             mock.call('the connection to the system database failed. error message: %s', 'err')
         ])
 
-        assert self._db_manager._db_connectors == [self._db_manager._system_db_connector]
+        assert self._db_manager._db_connectors == ['pool']
+        assert self._db_manager._pool_size == 1
+        assert self._db_manager._health_check_interval == 30
         self._db_manager._connect_tenants.assert_called_once_with('10.10.10.10', connection_data)
 
 
     def test_get_connectors(self):
         self._db_manager._db_connectors = 'conns'
         assert 'conns' == self._db_manager.get_connectors()
+
+    @mock.patch('hanadb_exporter.db_manager.ConnectionPool')
+    @mock.patch('hanadb_exporter.db_manager.hdb_connector.HdbConnector')
+    def test_create_pool(self, mock_hdb, mock_pool):
+        self._db_manager._pool_size = 2
+        self._db_manager._health_check_interval = 10
+        connection_data = {'mock_data': 'data'}
+
+        pool = self._db_manager._create_pool('conn', '10.10.10.10', 30013, connection_data)
+
+        assert pool == mock_pool.return_value
+        mock_pool.assert_called_once_with(
+            'conn', mock.ANY, size=2, health_check_interval=10)
+        pool.start.assert_called_once_with()
+
+        # The connection data is copied, as it is updated for each tenant
+        connection_data['databaseName'] = 'db1'
+        connect = mock_pool.call_args[0][1]
+        assert connect() == mock_hdb.return_value
+        mock_hdb.return_value.connect.assert_called_once_with(
+            '10.10.10.10', 30013, mock_data='data')
+
+    @mock.patch('logging.Logger.info')
+    def test_discover_tenants(self, mock_info):
+        self._db_manager._host = '10.10.10.10'
+        self._db_manager._connection_data = {'mock_data': 'data'}
+        self._db_manager._tenants['db1'] = (1, 'pool1')
+        self._db_manager._tenants['db2'] = (2, 'pool2')
+        self._db_manager._tenants['db3'] = (3, 'pool3')
+        self._db_manager._db_connectors = ['system', 'pool1', 'pool2', 'pool3']
+        self._db_manager._get_tenants_port = mock.Mock(return_value=[
+            ('db1', 1), ('db3', 4), ('db4', 5), ('db5', 6)])
+        self._db_manager._connect_tenant = mock.Mock(side_effect=['pool3_new', 'pool4', None])
+
+        removed = self._db_manager._discover_tenants()
+
+        assert removed == ['pool2', 'pool3']
+        assert self._db_manager._db_connectors == ['system', 'pool1', 'pool3_new', 'pool4']
+        assert list(self._db_manager._tenants.items()) == [
+            ('db1', (1, 'pool1')), ('db3', (4, 'pool3_new')), ('db4', (5, 'pool4'))]
+        self._db_manager._connect_tenant.assert_has_calls([
+            mock.call('10.10.10.10', 'db3', 4, {'mock_data': 'data'}),
+            mock.call('10.10.10.10', 'db4', 5, {'mock_data': 'data'}),
+            mock.call('10.10.10.10', 'db5', 6, {'mock_data': 'data'})
+        ])
+        mock_info.assert_has_calls([
+            mock.call('TENANT database %s is not available anymore, disconnecting...', 'db2'),
+            mock.call('TENANT database %s is not available anymore, disconnecting...', 'db3')
+        ])
+
+    @mock.patch('logging.Logger.error')
+    def test_discovery_loop(self, mock_error):
+        pool = mock.Mock()
+        callback = mock.Mock()
+        self._db_manager._stop_event = mock.Mock()
+        self._db_manager._stop_event.wait.side_effect = [False, False, True]
+        self._db_manager._discover_tenants = mock.Mock(side_effect=[[pool], Exception('error')])
+
+        self._db_manager._discovery_loop(10, callback)
+
+        self._db_manager._stop_event.wait.assert_has_calls([mock.call(10)] * 3)
+        callback.assert_called_once_with(self._db_manager._db_connectors)
+        pool.stop.assert_called_once_with()
+        mock_error.assert_called_once_with('Tenant discovery failed: %s', 'error')
+
+    def test_start_discovery(self):
+        self._db_manager._discovery_loop = mock.Mock()
+        self._db_manager.start_discovery(10, 'callback')
+        self._db_manager.stop_discovery()
+        self._db_manager._discovery_loop.assert_called_once_with(10, 'callback')
+        assert self._db_manager._discovery_thread is None
+        assert self._db_manager._stop_event.is_set()
+
+
+class TestConnectionPool(object):
+    """
+    Unitary tests for ConnectionPool.
+    """
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._query_error = type('QueryError', (Exception,), {})
+        self._connection_error = type('ConnectionError', (Exception,), {})
+        self._patcher = mock.patch(
+            'hanadb_exporter.db_manager.hdb_connector.connectors.base_connector')
+        mock_base_connector = self._patcher.start()
+        mock_base_connector.QueryError = self._query_error
+        mock_base_connector.ConnectionError = self._connection_error
+
+        self._conn1 = mock.Mock()
+        self._conn2 = mock.Mock()
+        self._connect = mock.Mock(return_value=self._conn2)
+        self._pool = db_manager.ConnectionPool(
+            self._conn1, self._connect, size=2, health_check_interval=0)
+
+    def teardown(self):
+        """
+        Test tearDown.
+        """
+        self._patcher.stop()
+
+    def test_start(self):
+        assert self._pool.size == 1
+        self._pool.start()
+        self._connect.assert_called_once_with()
+        assert self._pool._connections == [self._conn1, self._conn2]
+        assert self._pool.size == 2
+        assert self._pool._health_check_thread is None
+
+        self._pool.stop()
+        self._conn1.disconnect.assert_called_once_with()
+        self._conn2.disconnect.assert_called_once_with()
+
+    @mock.patch('logging.Logger.warning')
+    def test_start_error(self, mock_warning):
+        self._connect.side_effect = self._connection_error('error')
+        self._pool.start()
+        assert self._pool._connections == [self._conn1]
+        mock_warning.assert_called_once_with('Could not open a pool connection: %s', 'error')
+
+    def test_start_health_check(self):
+        self._pool._health_check_interval = 0.01
+        self._pool.check = mock.Mock()
+        self._pool.start()
+        assert self._pool._health_check_thread.daemon
+        self._pool.stop()
+        assert self._pool._health_check_thread is None
+
+    def test_query(self):
+        self._pool.start()
+        assert self._pool.query('select') == self._conn2.query.return_value
+        self._conn2.query.assert_called_once_with('select')
+        self._conn2.isconnected.assert_not_called()
+        assert list(self._pool._idle) == [self._conn1, self._conn2]
+        assert self._pool._busy == {}
+
+    def test_query_error(self):
+        self._conn1.query.side_effect = self._query_error('error')
+        self._conn1.isconnected.return_value = True
+        with pytest.raises(self._query_error):
+            self._pool.query('select')
+        self._conn1.reconnect.assert_not_called()
+        assert list(self._pool._idle) == [self._conn1]
+
+        assert self._pool.isconnected() == True
+
+        # The broken connections are reconnected in background, not by the failed query
+        self._conn1.isconnected.return_value = False
+        with pytest.raises(self._query_error):
+            self._pool.query('select')
+        self._conn1.reconnect.assert_not_called()
+        self._conn1.query.assert_called_with('select')
+        assert self._pool.isconnected() == False
+        assert list(self._pool._idle) == [self._conn1]
+
+        assert self._pool.check() == True
+        self._conn1.query.assert_called_with(db_manager.HEALTH_CHECK_QUERY)
+        self._conn1.reconnect.assert_called_once_with()
+        assert self._pool.isconnected() == True
+
+    def test_stream_query(self):
+        cursor = self._conn1._connection.cursor.return_value
+        cursor.fetchmany.side_effect = [[('data1',), ('data2',)], [('data3',)], []]
+
+        with self._pool.stream_query('select', 2) as stream:
+            # The connection is borrowed until the stream is closed
+            assert self._pool._busy == {self._conn1: 'select'}
+            assert stream.metadata == cursor.description
+            assert list(stream.batches()) == [[('data1',), ('data2',)], [('data3',)]]
+
+        cursor.execute.assert_called_once_with('select')
+        cursor.fetchmany.assert_has_calls([mock.call(2)] * 3)
+        cursor.close.assert_called_once_with()
+        self._conn1.query.assert_not_called()
+        assert list(self._pool._idle) == [self._conn1]
+        assert self._pool._busy == {}
+
+    def test_stream_query_error(self):
+        cursor = self._conn1._connection.cursor.return_value
+        cursor.execute.side_effect = ValueError('error')
+        self._conn1.isconnected.return_value = False
+
+        with pytest.raises(self._query_error) as err:
+            self._pool.stream_query('select', 2)
+        assert 'query failed: error' in str(err.value)
+        cursor.close.assert_called_once_with()
+        # The broken connection is flagged, and it is validated in background
+        self._conn1.query.assert_not_called()
+        self._conn1.reconnect.assert_not_called()
+        assert self._pool.isconnected() == False
+        assert list(self._pool._idle) == [self._conn1]
+
+        # The errors fetching the records are query errors too
+        self._pool._healthy = True
+        self._conn1.isconnected.return_value = True
+        cursor.execute.side_effect = None
+        cursor.fetchmany.side_effect = ValueError('error')
+        with self._pool.stream_query('select', 2) as stream:
+            with pytest.raises(self._query_error):
+                list(stream.batches())
+        assert self._pool.isconnected() == True
+        assert list(self._pool._idle) == [self._conn1]
+
+    def test_stream_query_fetch_error(self):
+        cursor = self._conn1._connection.cursor.return_value
+        cursor.fetchmany.side_effect = [[('data1',), ('data2',)], ValueError('error')]
+        self._conn1.isconnected.return_value = False
+
+        batches = []
+        with self._pool.stream_query('select', 2) as stream:
+            with pytest.raises(self._query_error) as err:
+                for batch in stream.batches():
+                    batches.append(batch)
+        assert 'query failed: error' in str(err.value)
+        assert batches == [[('data1',), ('data2',)]]
+        cursor.close.assert_called_once_with()
+        # The connection broken while fetching is flagged as the failed queries
+        self._conn1.query.assert_not_called()
+        self._conn1.reconnect.assert_not_called()
+        assert self._pool.isconnected() == False
+        assert list(self._pool._idle) == [self._conn1]
+        assert self._pool._busy == {}
+
+    def test_stream_query_no_cursor(self):
+        self._conn1._connection = None
+        self._conn1.query.return_value = mock.Mock(metadata='metadata', records=[('data1',)])
+
+        with self._pool.stream_query('select', 2) as stream:
+            assert stream.metadata == 'metadata'
+            assert list(stream.batches()) == [[('data1',)]]
+        self._conn1.query.assert_called_once_with('select')
+        assert list(self._pool._idle) == [self._conn1]
+
+    def test_check(self):
+        self._pool.start()
+        self._conn1.query.side_effect = self._query_error('error')
+        self._conn1.reconnect.side_effect = self._connection_error('error')
+
+        assert self._pool.check() == True
+        self._conn1.query.assert_called_once_with(db_manager.HEALTH_CHECK_QUERY)
+        self._conn1.reconnect.assert_called_once_with()
+        self._conn2.query.assert_called_once_with(db_manager.HEALTH_CHECK_QUERY)
+        self._conn2.reconnect.assert_not_called()
+
+        self._conn2.query.side_effect = self._query_error('error')
+        self._conn2.reconnect.side_effect = self._connection_error('error')
+        assert self._pool.check() == False
+        assert self._pool.isconnected() == False
+        assert sorted(self._pool._idle, key=id) == sorted([self._conn1, self._conn2], key=id)
+
+    def test_check_busy(self):
+        self._pool._acquire()
+        assert self._pool.check() == True
+        self._conn1.query.assert_not_called()
+
+    def test_reconnect(self):
+        self._pool.check = mock.Mock(return_value=True)
+        self._pool.reconnect()
+        self._pool.check.assert_called_once_with()
+
+        self._pool.check.return_value = False
+        with pytest.raises(self._connection_error) as err:
+            self._pool.reconnect()
+        assert 'none of the pool connections could be reconnected' in str(err.value)
+
+    @mock.patch('hanadb_exporter.db_manager.utils.cancel_query')
+    def test_cancel_query(self, mock_cancel):
+        mock_cancel.return_value = True
+        assert self._pool.cancel_query() == True
+        mock_cancel.assert_not_called()
+
+        self._pool.start()
+        self._pool._acquire(sql_statement='query1')
+        self._pool._acquire(sql_statement='query2')
+        assert self._pool.cancel_query('query2') == True
+        mock_cancel.assert_called_once_with(self._conn1)
+
+        assert self._pool.cancel_query() == True
+        mock_cancel.assert_has_calls([mock.call(self._conn2), mock.call(self._conn1)])
+        assert mock_cancel.call_count == 3
@@ -0,0 +1,124 @@
+"""
+Unitary tests for exporter_metrics.py.
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.com
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212,W0611
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.modules['prometheus_client'] = mock.MagicMock()
+
+from hanadb_exporter import exporter_metrics
+
+
+class TestExporterMetrics(object):
+    """
+    Unitary tests for exporter_metrics.
+    """
+
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_RESULTS')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_CIRCUIT_OPEN')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_STALE')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_SKIPS')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_ERRORS')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_ROWS')
+    @mock.patch('hanadb_exporter.exporter_metrics.QUERY_DURATION')
+    def test_query_metrics(self, mock_duration, mock_rows, mock_errors, mock_skips,
+                           mock_stale, mock_circuit_open, mock_results):
+        mock_duration.labels.side_effect = ['fetch', 'format', 'build']
+        mock_skips.labels.side_effect = ['cached', 'empty', 'deadline', 'suspended']
+        mock_results.labels.side_effect = ['unchanged', 'changed']
+
+        query_metrics = exporter_metrics.query_metrics('query_id', 'db_name')
+
+        assert query_metrics == exporter_metrics.QUERYMETRICS(
+            fetch_duration='fetch', format_duration='format', build_duration='build',
+            rows=mock_rows.labels.return_value, errors=mock_errors.labels.return_value,
+            cached='cached', empty='empty', deadline='deadline',
+            stale=mock_stale.labels.return_value, suspended='suspended',
+            circuit_open=mock_circuit_open.labels.return_value, unchanged='unchanged',
+            changed='changed')
+        mock_duration.labels.assert_has_calls([
+            mock.call('query_id', 'db_name', 'fetch'),
+            mock.call('query_id', 'db_name', 'format'),
+            mock.call('query_id', 'db_name', 'build')
+        ])
+        mock_rows.labels.assert_called_once_with('query_id', 'db_name')
+        mock_errors.labels.assert_called_once_with('query_id', 'db_name')
+        mock_skips.labels.assert_has_calls([
+            mock.call('query_id', 'db_name', 'cached'),
+            mock.call('query_id', 'db_name', 'empty'),
+            mock.call('query_id', 'db_name', 'deadline'),
+            mock.call('query_id', 'db_name', 'suspended')
+        ])
+        mock_stale.labels.assert_called_once_with('query_id', 'db_name')
+        mock_circuit_open.labels.assert_called_once_with('query_id', 'db_name')
+        mock_results.labels.assert_has_calls([
+            mock.call('query_id', 'db_name', 'unchanged'),
+            mock.call('query_id', 'db_name', 'changed')
+        ])
+
+    def test_remove_database_metrics(self):
+        metrics = {
+            name: mock.Mock() for name in [
+                'DATABASE_UP', 'LAST_SUCCESS', 'RECONNECT_DURATION', 'QUERY_TIMEOUTS',
+                'QUERY_ROWS', 'QUERY_ERRORS', 'QUERY_CIRCUIT_OPEN', 'QUERY_STALE',
+                'QUERY_DURATION', 'QUERY_SKIPS', 'QUERY_RESULTS']}
+        # The children never created are skipped
+        metrics['QUERY_TIMEOUTS'].remove.side_effect = KeyError('query_id')
+
+        with mock.patch.multiple('hanadb_exporter.exporter_metrics', **metrics):
+            exporter_metrics.remove_database_metrics('db_name', ['query_id'])
+
+        for name in ['DATABASE_UP', 'LAST_SUCCESS', 'RECONNECT_DURATION']:
+            metrics[name].remove.assert_called_once_with('db_name')
+        for name in ['QUERY_TIMEOUTS', 'QUERY_ROWS', 'QUERY_ERRORS', 'QUERY_CIRCUIT_OPEN',
+                     'QUERY_STALE']:
+            metrics[name].remove.assert_called_once_with('query_id', 'db_name')
+        metrics['QUERY_DURATION'].remove.assert_has_calls([
+            mock.call('query_id', 'db_name', 'fetch'),
+            mock.call('query_id', 'db_name', 'format'),
+            mock.call('query_id', 'db_name', 'build')
+        ])
+        metrics['QUERY_SKIPS'].remove.assert_has_calls([
+            mock.call('query_id', 'db_name', 'cached'),
+            mock.call('query_id', 'db_name', 'empty'),
+            mock.call('query_id', 'db_name', 'deadline'),
+            mock.call('query_id', 'db_name', 'suspended')
+        ])
+        metrics['QUERY_RESULTS'].remove.assert_has_calls([
+            mock.call('query_id', 'db_name', 'unchanged'),
+            mock.call('query_id', 'db_name', 'changed')
+        ])
+
+    def test_remove_query_metrics(self):
+        metrics = {
+            name: mock.Mock() for name in [
+                'DATABASE_UP', 'QUERY_TIMEOUTS', 'QUERY_ROWS', 'QUERY_ERRORS',
+                'QUERY_CIRCUIT_OPEN', 'QUERY_STALE', 'QUERY_DURATION', 'QUERY_SKIPS',
+                'QUERY_RESULTS']}
+
+        with mock.patch.multiple('hanadb_exporter.exporter_metrics', **metrics):
+            exporter_metrics.remove_query_metrics('query_id', 'db_name')
+
+        # The series of the database are kept
+        metrics['DATABASE_UP'].remove.assert_not_called()
+        for name in ['QUERY_TIMEOUTS', 'QUERY_ROWS', 'QUERY_ERRORS', 'QUERY_CIRCUIT_OPEN',
+                     'QUERY_STALE']:
+            metrics[name].remove.assert_called_once_with('query_id', 'db_name')
+        assert metrics['QUERY_DURATION'].remove.call_count == 3
+        assert metrics['QUERY_SKIPS'].remove.call_count == 4
+        assert metrics['QUERY_RESULTS'].remove.call_count == 2
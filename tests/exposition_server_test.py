@@ -0,0 +1,334 @@
+"""
+Unitary tests for exposition_server.py.
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.com
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212,W0611
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import asyncio
+import gc
+import gzip
+import logging
+import socket
+import threading
+import zlib
+from http import client
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+sys.modules['prometheus_client'] = mock.MagicMock()
+
+from hanadb_exporter import exposition_server
+
+
+class TestPayloadCache(object):
+    """
+    Unitary tests for PayloadCache.
+    """
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._registry = mock.Mock()
+        self._live = mock.Mock()
+        self._generation = mock.Mock(return_value=1)
+        self._cache = exposition_server.PayloadCache(
+            self._registry, self._generation, live=self._live)
+
+    def test_get(self):
+        encoder = mock.Mock(side_effect=lambda registry: {
+            self._registry: b'metrics\n', self._live: b'age\n'}[registry])
+
+        assert self._cache.get(encoder, 'text/plain', False) == b'metrics\nage\n'
+        assert self._cache.get(encoder, 'text/plain', False) == b'metrics\nage\n'
+        # The registry is rendered once per generation, the live metrics on every request
+        encoder.assert_has_calls([
+            mock.call(self._registry), mock.call(self._live), mock.call(self._live)])
+
+        self._generation.return_value = 2
+        assert self._cache.get(encoder, 'text/plain', False) == b'metrics\nage\n'
+        assert encoder.call_args_list.count(mock.call(self._registry)) == 2
+
+    def test_get_openmetrics(self):
+        encoder = mock.Mock(side_effect=lambda registry: {
+            self._registry: b'metrics\n# EOF\n', self._live: b'age\n# EOF\n'}[registry])
+        content_type = 'application/openmetrics-text; version=0.0.1; charset=utf-8'
+
+        assert self._cache.get(encoder, content_type, False) == b'metrics\nage\n# EOF\n'
+
+        cache = exposition_server.PayloadCache(self._registry, self._generation)
+        assert cache.get(encoder, content_type, False) == b'metrics\n# EOF\n'
+
+    def test_get_gzip(self):
+        encoder = mock.Mock(side_effect=lambda registry: {
+            self._registry: b'metrics\n', self._live: b'age\n'}[registry])
+
+        for _ in range(2):
+            payload = self._cache.get(encoder, 'text/plain', True)
+            # The payload is a single gzip stream
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            assert decompressor.decompress(payload) == b'metrics\nage\n'
+            assert decompressor.eof and not decompressor.unused_data
+        assert encoder.call_args_list.count(mock.call(self._registry)) == 1
+
+
+class TestExpositionServer(object):
+    """
+    Unitary tests for ExpositionServer.
+    """
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._registry = mock.Mock()
+        self._encoder = mock.Mock(return_value=b'metrics')
+        self._patcher = mock.patch('hanadb_exporter.exposition_server.exposition')
+        self._mock_exposition = self._patcher.start()
+        self._mock_exposition.choose_encoder.return_value = (self._encoder, 'text/plain')
+
+        self._server = exposition_server.ExpositionServer(self._registry, max_requests=2)
+        self._thread = threading.Thread(target=self._server.serve, args=('127.0.0.1', 0))
+        self._thread.start()
+        assert self._server.started.wait(5)
+
+    def teardown(self):
+        """
+        Test tearDown.
+        """
+        self._server.stop()
+        self._thread.join(5)
+        self._patcher.stop()
+        assert not self._thread.is_alive()
+
+    def _connection(self):
+        return client.HTTPConnection('127.0.0.1', self._server.port, timeout=5)
+
+    def test_serve_on_started(self):
+        server = exposition_server.ExpositionServer(self._registry)
+        connections = []
+        # The callback runs once the port is listening
+        on_started = mock.Mock(side_effect=lambda: connections.append(
+            socket.create_connection(('127.0.0.1', server.port), timeout=5)))
+        thread = threading.Thread(target=server.serve, args=('127.0.0.1', 0, on_started))
+        thread.start()
+        assert server.started.wait(5)
+        server.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+        on_started.assert_called_once_with()
+        connections[0].close()
+
+    def test_stop_keep_alive_connection(self):
+        connection = self._connection()
+        connection.request('GET', '/metrics')
+        connection.getresponse().read()
+        assert len(self._server._connections) == 1
+
+        with mock.patch.object(logging.getLogger('asyncio'), 'error') as mock_error:
+            self._server.stop()
+            self._thread.join(5)
+            # The tasks left pending are reported when they are garbage collected
+            gc.collect()
+
+        assert not self._thread.is_alive()
+        assert self._server._connections == set()
+        mock_error.assert_not_called()
+        # The server closes the idle connection
+        assert connection.sock.recv(1) == b''
+        connection.close()
+
+    def test_cancel_tasks(self):
+        server = exposition_server.ExpositionServer(self._registry)
+        server._loop = asyncio.new_event_loop()
+        try:
+            # A connection handler started after the open connections were cancelled
+            task = server._loop.create_task(asyncio.sleep(60))
+            server._cancel_tasks()
+            assert task.cancelled()
+        finally:
+            server._loop.close()
+
+    def test_get(self):
+        connection = self._connection()
+        connection.request('GET', '/metrics', headers={'Accept': 'text/plain'})
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.getheader('Content-Type') == 'text/plain'
+        assert response.getheader('Connection') == 'keep-alive'
+        assert response.read() == b'metrics'
+        self._mock_exposition.choose_encoder.assert_called_once_with('text/plain')
+        self._encoder.assert_called_once_with(self._registry)
+
+        # The connection is kept open for the next requests
+        connection.request('HEAD', '/metrics')
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader('Content-Length') == '7'
+        assert response.read() == b''
+        assert self._encoder.call_count == 2
+        connection.close()
+
+    def test_get_gzip(self):
+        connection = self._connection()
+        connection.request('GET', '/', headers={'Accept-Encoding': 'gzip, deflate'})
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert gzip.decompress(response.read()) == b'metrics'
+        connection.close()
+
+    def test_get_names(self):
+        connection = self._connection()
+        connection.request('GET', '/metrics?name[]=metric1&name[]=metric2')
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.read() == b'metrics'
+        self._registry.restricted_registry.assert_called_once_with(['metric1', 'metric2'])
+        self._encoder.assert_called_once_with(self._registry.restricted_registry.return_value)
+        connection.close()
+
+    def test_get_encoder_wrapper(self):
+        wrapped_encoder = mock.Mock(return_value=b'wrapped metrics')
+        encoder_wrapper = mock.Mock(return_value=wrapped_encoder)
+        self._server._encoder_wrapper = encoder_wrapper
+        connection = self._connection()
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.read() == b'wrapped metrics'
+        encoder_wrapper.assert_called_once_with(self._encoder, 'text/plain')
+        wrapped_encoder.assert_called_once_with(self._registry)
+        self._encoder.assert_not_called()
+        connection.close()
+
+    def test_get_error(self):
+        self._encoder.side_effect = ValueError('error')
+        connection = self._connection()
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+
+        assert response.status == 500
+        assert response.read() == b'error rendering the metrics'
+        connection.close()
+
+    def test_not_served(self):
+        connection = self._connection()
+        connection.request('POST', '/metrics', body=b'data')
+        response = connection.getresponse()
+        assert response.status == 405
+        assert response.getheader('Allow') == 'GET, HEAD'
+        response.read()
+
+        connection.request('GET', '/favicon.ico', headers={'Connection': 'close'})
+        response = connection.getresponse()
+        assert response.status == 404
+        assert response.getheader('Connection') == 'close'
+        response.read()
+        connection.close()
+        self._encoder.assert_not_called()
+
+    def test_bad_request(self):
+        sock = socket.create_connection(('127.0.0.1', self._server.port), timeout=5)
+        sock.sendall(b'GET\r\n\r\n')
+        response = b''
+        data = sock.recv(1024)
+        while data:
+            response += data
+            data = sock.recv(1024)
+        sock.close()
+
+        assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+        assert response.endswith(b'malformed request line')
+
+    def test_keep_alive(self):
+        request = exposition_server.HTTPREQUEST('GET', '/', 'HTTP/1.1', {})
+        assert exposition_server.ExpositionServer._keep_alive(request) == True
+        request = exposition_server.HTTPREQUEST('GET', '/', 'HTTP/1.1', {'connection': 'close'})
+        assert exposition_server.ExpositionServer._keep_alive(request) == False
+        request = exposition_server.HTTPREQUEST('GET', '/', 'HTTP/1.0', {})
+        assert exposition_server.ExpositionServer._keep_alive(request) == False
+        request = exposition_server.HTTPREQUEST(
+            'GET', '/', 'HTTP/1.0', {'connection': 'Keep-Alive'})
+        assert exposition_server.ExpositionServer._keep_alive(request) == True
+
+    def test_get_payload_cache(self):
+        self._server._payload_cache = mock.Mock()
+        self._server._payload_cache.get.return_value = b'cached'
+        connection = self._connection()
+        connection.request('GET', '/metrics', headers={'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert response.read() == b'cached'
+        self._server._payload_cache.get.assert_called_once_with(
+            self._encoder, 'text/plain', True)
+
+        # The requests of some metrics are not cached
+        connection.request('GET', '/metrics?name[]=metric1')
+        response = connection.getresponse()
+        assert response.read() == b'metrics'
+        assert self._server._payload_cache.get.call_count == 1
+        connection.close()
+
+    @mock.patch('hanadb_exporter.exposition_server.time.monotonic', return_value=100)
+    def test_scrape_deadline(self, mock_monotonic):
+        request = exposition_server.HTTPREQUEST('GET', '/', 'HTTP/1.1', {})
+        assert self._server._scrape_deadline(request) is None
+
+        request = exposition_server.HTTPREQUEST(
+            'GET', '/', 'HTTP/1.1', {'x-prometheus-scrape-timeout-seconds': '10'})
+        assert self._server._scrape_deadline(request) == 109.5
+
+        self._server._scrape_timeout = 5
+        assert self._server._scrape_deadline(request) == 109.5
+        request = exposition_server.HTTPREQUEST(
+            'GET', '/', 'HTTP/1.1', {'x-prometheus-scrape-timeout-seconds': 'invalid'})
+        assert self._server._scrape_deadline(request) == 104.5
+        request = exposition_server.HTTPREQUEST(
+            'GET', '/', 'HTTP/1.1', {'x-prometheus-scrape-timeout-seconds': '0.1'})
+        assert self._server._scrape_deadline(request) == 100
+
+    def test_get_scrape_deadline(self):
+        deadlines = []
+        self._encoder.side_effect = lambda registry: deadlines.append(
+            exposition_server.utils.get_scrape_deadline()) or b'metrics'
+        connection = self._connection()
+        connection.request(
+            'GET', '/metrics', headers={'X-Prometheus-Scrape-Timeout-Seconds': '10'})
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert response.read() == b'metrics'
+        # The deadline is set while the registry is encoded
+        assert len(deadlines) == 1 and deadlines[0] is not None
+        assert exposition_server.utils.get_scrape_deadline() is None
+        connection.close()
+
+    def test_set_payload_cache(self):
+        self._server.set_payload_cache('cache')
+        assert self._server._payload_cache == 'cache'
+
+    def test_collector_view(self):
+        collect = mock.Mock()
+        assert exposition_server.CollectorView(collect).collect is collect
@@ -119,6 +119,7 @@ class TestMain(object):
             main.lookup_etc_folder(main.METRICS_FILES)
         assert 'configuration file does not exist in {}'.format(",".join(main.METRICS_FILES)) in str(err.value)
 
+    @mock.patch('hanadb_exporter.main.signal')
     @mock.patch('hanadb_exporter.utils.systemd_ready')
     @mock.patch('hanadb_exporter.main.LOGGER')
     @mock.patch('hanadb_exporter.main.parse_arguments')
@@ -127,13 +128,12 @@ class TestMain(object):
     @mock.patch('hanadb_exporter.main.db_manager.DatabaseManager')
     @mock.patch('hanadb_exporter.main.prometheus_exporter.SapHanaCollectors')
     @mock.patch('hanadb_exporter.main.REGISTRY.register')
-    @mock.patch('hanadb_exporter.main.start_http_server')
+    @mock.patch('hanadb_exporter.main.exposition_server.ExpositionServer')
     @mock.patch('logging.getLogger')
-    @mock.patch('time.sleep')
     def test_run(
-            self, mock_sleep, mock_get_logger, mock_start_server, mock_registry,
+            self, mock_get_logger, mock_server, mock_registry,
             mock_exporters, mock_db_manager, mock_setup_logging,
-            mock_parse_config, mock_parse_arguments, mock_logger, mock_systemd):
+            mock_parse_config, mock_parse_arguments, mock_logger, mock_systemd, mock_signal):
 
         mock_arguments = mock.Mock(config='config', metrics='metrics', daemon=False, version=False)
         mock_parse_arguments.return_value = mock_arguments
@@ -162,10 +162,7 @@ class TestMain(object):
         mock_collector = mock.Mock()
         mock_exporters.return_value = mock_collector
 
-        mock_sleep.side_effect = Exception
-
-        with pytest.raises(Exception):
-            main.run()
+        main.run()
 
         mock_parse_arguments.assert_called_once_with()
         mock_parse_config.assert_called_once_with(mock_arguments.config)
@@ -173,19 +170,113 @@ class TestMain(object):
         mock_db_manager.assert_called_once_with()
         db_instance.start.assert_called_once_with(
             '10.10.10.10', 1234, user='user', password='pass',
-            userkey=None, multi_tenant=True, timeout=30, ssl=True, ssl_validate_cert=True)
+            userkey=None, multi_tenant=True, timeout=30, ssl=True, ssl_validate_cert=True,
+            pool_size=1, health_check_interval=30, check_tenant_status=False,
+            connect_workers=4)
         db_instance.get_connectors.assert_called_once_with()
         mock_exporters.assert_called_once_with(
-            connectors='connectors', metrics_file='metrics')
+            connectors='connectors', metrics_file='metrics', workers=1, timeout=60,
+            query_timeout=None, startup_workers=4, query_workers=1, failure_threshold=0,
+            check_privileges=False, batch_size=0, direct_exposition=False,
+            reuse_results=False, label_values_size=100000)
 
+        db_instance.start_discovery.assert_called_once_with(300, mock_collector.sync)
+        db_instance.stop_discovery.assert_called_once_with()
         mock_registry.assert_called_once_with(mock_collector)
         mock_logger.info.assert_has_calls([
             mock.call('exporter successfully registered'),
+            mock.call('exporter started in %.3f seconds', mock.ANY),
             mock.call('starting to serve metrics')
         ])
-        mock_start_server.assert_called_once_with(9668, '127.0.0.1')
-        mock_sleep.assert_called_once_with(1)
+        mock_server.assert_called_once_with(
+            main.REGISTRY, max_requests=4, payload_cache=None, scrape_timeout=None,
+            encoder_wrapper=None)
+        mock_server.return_value.serve.assert_called_once_with(
+            '127.0.0.1', 9668, on_started=None)
         assert mock_systemd.call_count == 0
+        mock_signal.signal.assert_called_once_with(mock_signal.SIGHUP, mock.ANY)
+
+    @mock.patch('hanadb_exporter.utils.systemd_ready')
+    @mock.patch('hanadb_exporter.main.LOGGER')
+    @mock.patch('hanadb_exporter.main.parse_arguments')
+    @mock.patch('hanadb_exporter.main.parse_config')
+    @mock.patch('hanadb_exporter.main.setup_logging')
+    @mock.patch('hanadb_exporter.main.db_manager.DatabaseManager')
+    @mock.patch('hanadb_exporter.main.prometheus_exporter.SnapshotCollector')
+    @mock.patch('hanadb_exporter.main.prometheus_exporter.SapHanaCollectors')
+    @mock.patch('hanadb_exporter.main.REGISTRY.register')
+    @mock.patch('hanadb_exporter.main.exposition_server.PayloadCache')
+    @mock.patch('hanadb_exporter.main.exposition_server.CollectorView')
+    @mock.patch('hanadb_exporter.main.exposition_server.ExpositionServer')
+    @mock.patch('logging.getLogger')
+    def test_run_collection_interval(
+            self, mock_get_logger, mock_server, mock_view, mock_payload_cache, mock_registry,
+            mock_exporters, mock_snapshot, mock_db_manager, mock_setup_logging,
+            mock_parse_config, mock_parse_arguments, mock_logger, mock_systemd):
+
+        mock_arguments = mock.Mock(config='config', metrics='metrics', daemon=False, version=False)
+        mock_parse_arguments.return_value = mock_arguments
+
+        config = {
+            'collection_workers': 4,
+            'collection_timeout': 20,
+            'collection_interval': 30,
+            'scrape_timeout': 10,
+            'direct_exposition': True,
+            'query_failure_threshold': 3,
+            'multi_tenant': False,
+            'hana': {
+                'host': '10.10.10.10',
+                'port': 1234,
+                'user': 'user',
+                'password': 'pass'
+            },
+            'logging': {
+                'log_file': 'my_file',
+                'config_file': 'my_config_file'
+            }
+        }
+        mock_parse_config.return_value = config
+
+        db_instance = mock.Mock()
+        db_instance.get_connectors.return_value = 'connectors'
+        mock_db_manager.return_value = db_instance
+
+        mock_collector = mock.Mock()
+        mock_exporters.return_value = mock_collector
+        mock_snapshot_collector = mock.Mock()
+        mock_snapshot.return_value = mock_snapshot_collector
+
+        main.run()
+
+        mock_exporters.assert_called_once_with(
+            connectors='connectors', metrics_file='metrics', workers=4, timeout=20,
+            query_timeout=None, startup_workers=4, query_workers=1, failure_threshold=3,
+            check_privileges=False, batch_size=0, direct_exposition=True,
+            reuse_results=False, label_values_size=100000)
+        mock_snapshot.assert_called_once_with(mock_collector, 30)
+        db_instance.start_discovery.assert_not_called()
+        mock_snapshot_collector.start.assert_called_once_with()
+        mock_snapshot_collector.stop.assert_called_once_with()
+        mock_view.assert_has_calls([
+            mock.call(mock_snapshot_collector.collect_snapshot),
+            mock.call(mock_snapshot_collector.collect_age)
+        ])
+        mock_registry.assert_called_once_with(mock_view.return_value)
+        mock_payload_cache.assert_called_once_with(
+            main.REGISTRY, mock.ANY, live=mock_view.return_value)
+        generation = mock_payload_cache.call_args[0][1]
+        assert generation() == mock_snapshot_collector.generation
+        mock_logger.info.assert_has_calls([
+            mock.call('metrics are collected in background every %s seconds', 30),
+            mock.call('exporter successfully registered'),
+            mock.call('exporter started in %.3f seconds', mock.ANY),
+            mock.call('starting to serve metrics')
+        ])
+        mock_server.assert_called_once_with(
+            main.REGISTRY, max_requests=4, payload_cache=mock_payload_cache.return_value,
+            scrape_timeout=10, encoder_wrapper=main.prometheus_exporter.direct_encoder)
+        mock_server.return_value.serve.assert_called_once_with('0.0.0.0', 9668, on_started=None)
 
     @mock.patch('hanadb_exporter.utils.systemd_ready')
     @mock.patch('hanadb_exporter.main.LOGGER')
@@ -196,11 +287,10 @@ class TestMain(object):
     @mock.patch('hanadb_exporter.main.db_manager.DatabaseManager')
     @mock.patch('hanadb_exporter.main.prometheus_exporter.SapHanaCollectors')
     @mock.patch('hanadb_exporter.main.REGISTRY.register')
-    @mock.patch('hanadb_exporter.main.start_http_server')
+    @mock.patch('hanadb_exporter.main.exposition_server.ExpositionServer')
     @mock.patch('logging.getLogger')
-    @mock.patch('time.sleep')
     def test_run_defaults(
-            self, mock_sleep, mock_get_logger, mock_start_server, mock_registry,
+            self, mock_get_logger, mock_server, mock_registry,
             mock_exporters, mock_db_manager, mock_setup_logging, mock_parse_config,
             mock_parse_arguments, mock_lookup_etc_folder, mock_logger, mock_systemd):
 
@@ -231,10 +321,7 @@ class TestMain(object):
         mock_collector = mock.Mock()
         mock_exporters.return_value = mock_collector
 
-        mock_sleep.side_effect = Exception
-
-        with pytest.raises(Exception):
-            main.run()
+        main.run()
 
         mock_parse_arguments.assert_called_once_with()
         mock_parse_config.assert_called_once_with("new_metrics")
@@ -242,19 +329,29 @@ class TestMain(object):
         mock_db_manager.assert_called_once_with()
         db_instance.start.assert_called_once_with(
             '10.10.10.10', 1234, user='user', password='pass',
-            userkey=None, multi_tenant=True, timeout=30, ssl=False, ssl_validate_cert=False)
+            userkey=None, multi_tenant=True, timeout=30, ssl=False, ssl_validate_cert=False,
+            pool_size=1, health_check_interval=30, check_tenant_status=False,
+            connect_workers=4)
         db_instance.get_connectors.assert_called_once_with()
         mock_exporters.assert_called_once_with(
-            connectors='connectors', metrics_file='new_metrics')
+            connectors='connectors', metrics_file='new_metrics', workers=1, timeout=60,
+            query_timeout=None, startup_workers=4, query_workers=1, failure_threshold=0,
+            check_privileges=False, batch_size=0, direct_exposition=False,
+            reuse_results=False, label_values_size=100000)
 
         mock_registry.assert_called_once_with(mock_collector)
         mock_logger.info.assert_has_calls([
             mock.call('exporter successfully registered'),
+            mock.call('exporter started in %.3f seconds', mock.ANY),
             mock.call('starting to serve metrics')
         ])
-        mock_start_server.assert_called_once_with(9668, '0.0.0.0')
-        mock_sleep.assert_called_once_with(1)
-        mock_systemd.assert_called_once_with()
+        mock_server.assert_called_once_with(
+            main.REGISTRY, max_requests=4, payload_cache=None, scrape_timeout=None,
+            encoder_wrapper=None)
+        # systemd is notified once the server is listening
+        mock_server.return_value.serve.assert_called_once_with(
+            '0.0.0.0', 9668, on_started=mock_systemd)
+        mock_systemd.assert_not_called()
 
     @mock.patch('hanadb_exporter.main.parse_arguments')
     def test_run_invalid_args(self, mock_parse_arguments):
@@ -308,12 +405,11 @@ class TestMain(object):
     @mock.patch('hanadb_exporter.main.db_manager.DatabaseManager')
     @mock.patch('hanadb_exporter.main.prometheus_exporter.SapHanaCollectors')
     @mock.patch('hanadb_exporter.main.REGISTRY.register')
-    @mock.patch('hanadb_exporter.main.start_http_server')
+    @mock.patch('hanadb_exporter.main.exposition_server.ExpositionServer')
     @mock.patch('logging.getLogger')
-    @mock.patch('time.sleep')
-    @mock.patch('hanadb_exporter.main.secrets_manager.get_db_credentials')
+    @mock.patch('hanadb_exporter.secrets_manager.get_db_credentials')
     def test_run_secret_manager(
-            self, mock_secret_manager, mock_sleep, mock_get_logger, mock_start_server, mock_registry,
+            self, mock_secret_manager, mock_get_logger, mock_server, mock_registry,
             mock_exporters, mock_db_manager, mock_setup_logging,
             mock_parse_config, mock_parse_arguments, mock_logger, mock_systemd):
 
@@ -347,10 +443,7 @@ class TestMain(object):
         mock_collector = mock.Mock()
         mock_exporters.return_value = mock_collector
 
-        mock_sleep.side_effect = Exception
-
-        with pytest.raises(Exception):
-            main.run()
+        main.run()
 
         mock_parse_arguments.assert_called_once_with()
         mock_parse_config.assert_called_once_with(mock_arguments.config)
@@ -358,17 +451,131 @@ class TestMain(object):
         mock_db_manager.assert_called_once_with()
         db_instance.start.assert_called_once_with(
             '10.10.10.10', 1234, user='db_user', password='db_pass',
-            userkey=None, multi_tenant=True, timeout=30, ssl=False, ssl_validate_cert=False)
+            userkey=None, multi_tenant=True, timeout=30, ssl=False, ssl_validate_cert=False,
+            pool_size=1, health_check_interval=30, check_tenant_status=False,
+            connect_workers=4)
         db_instance.get_connectors.assert_called_once_with()
         mock_exporters.assert_called_once_with(
-            connectors='connectors', metrics_file='metrics')
+            connectors='connectors', metrics_file='metrics', workers=1, timeout=60,
+            query_timeout=None, startup_workers=4, query_workers=1, failure_threshold=0,
+            check_privileges=False, batch_size=0, direct_exposition=False,
+            reuse_results=False, label_values_size=100000)
 
         mock_registry.assert_called_once_with(mock_collector)
         mock_logger.info.assert_has_calls([
             mock.call('AWS secret name is going to be used to read the database username and password'),
+            mock.call('secrets manager loaded in %.3f seconds', mock.ANY),
+            mock.call('tenants are discovered every %s seconds', 300),
             mock.call('exporter successfully registered'),
+            mock.call('exporter started in %.3f seconds', mock.ANY),
             mock.call('starting to serve metrics')
         ])
-        mock_start_server.assert_called_once_with(9668, '0.0.0.0')
-        mock_sleep.assert_called_once_with(1)
+        mock_server.assert_called_once_with(
+            main.REGISTRY, max_requests=4, payload_cache=None, scrape_timeout=None,
+            encoder_wrapper=None)
+        mock_server.return_value.serve.assert_called_once_with('0.0.0.0', 9668, on_started=None)
         assert mock_systemd.call_count == 0
+
+    @mock.patch('hanadb_exporter.utils.systemd_ready')
+    @mock.patch('hanadb_exporter.main.LOGGER')
+    @mock.patch('hanadb_exporter.main.parse_arguments')
+    @mock.patch('hanadb_exporter.main.parse_config')
+    @mock.patch('hanadb_exporter.main.setup_logging')
+    @mock.patch('hanadb_exporter.main.db_manager.DatabaseManager')
+    @mock.patch('hanadb_exporter.main.exporter_metrics')
+    @mock.patch('hanadb_exporter.main.start_in_background')
+    @mock.patch('hanadb_exporter.main.exposition_server.ExpositionServer')
+    @mock.patch('threading.Thread')
+    def test_run_fast_start(
+            self, mock_thread, mock_server, mock_start, mock_exporter_metrics, mock_db_manager,
+            mock_setup_logging, mock_parse_config, mock_parse_arguments, mock_logger,
+            mock_systemd):
+
+        mock_arguments = mock.Mock(config='config', metrics='metrics', daemon=True, version=False)
+        mock_parse_arguments.return_value = mock_arguments
+        config = {
+            'fast_start': True,
+            'hana': {
+                'host': '10.10.10.10',
+                'user': 'user',
+                'password': 'pass'
+            },
+            'logging': {
+                'log_file': 'my_file',
+                'config_file': 'my_config_file'
+            }
+        }
+        mock_parse_config.return_value = config
+        db_instance = mock_db_manager.return_value
+
+        main.run()
+
+        db_instance.start.assert_not_called()
+        mock_server.assert_called_once_with(
+            main.REGISTRY, max_requests=4, payload_cache=None, scrape_timeout=None,
+            encoder_wrapper=None)
+        mock_exporter_metrics.DATABASE_UP.labels.assert_called_once_with('SYSTEMDB')
+        mock_exporter_metrics.DATABASE_UP.labels.return_value.set.assert_called_once_with(0)
+        mock_thread.assert_called_once_with(
+            target=mock_start, args=(
+                db_instance, ('10.10.10.10', 30013, {
+                    'user': 'user', 'password': 'pass', 'userkey': None, 'multi_tenant': True,
+                    'timeout': 30, 'ssl': False, 'ssl_validate_cert': False, 'pool_size': 1,
+                    'health_check_interval': 30, 'check_tenant_status': False,
+                    'connect_workers': 4}),
+                config, 'metrics', mock_server.return_value, {}),
+            name='hanadb_startup', daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+        mock_systemd.assert_not_called()
+        mock_server.return_value.serve.assert_called_once_with(
+            '0.0.0.0', 9668, on_started=mock_systemd)
+        db_instance.stop_discovery.assert_called_once_with()
+
+    @mock.patch('hanadb_exporter.main.LOGGER')
+    def test_reload_metrics(self, mock_logger):
+        collector = mock.Mock()
+        main.reload_metrics({'collector': collector}, 'metrics')
+        collector.reload.assert_called_once_with('metrics')
+        mock_logger.info.assert_called_once_with('reloading metrics file %s', 'metrics')
+
+        # The metrics file is not reloaded until the collector is started
+        main.reload_metrics({}, 'metrics')
+        mock_logger.warning.assert_called_once_with(
+            'metrics file not reloaded, the databases are not connected yet')
+
+    @mock.patch('hanadb_exporter.main.exporter_metrics')
+    @mock.patch('hanadb_exporter.main.LOGGER')
+    @mock.patch('hanadb_exporter.main.setup_collector')
+    def test_start_in_background(self, mock_setup_collector, mock_logger, mock_exporter_metrics):
+        dbs = mock.Mock()
+        server = mock.Mock()
+        state = {}
+        mock_setup_collector.return_value = ('collector', 'payload_cache')
+
+        main.start_in_background(
+            dbs, ('host', 30013, {'user': 'user'}), 'config', 'metrics', server, state)
+
+        dbs.start.assert_called_once_with('host', 30013, user='user')
+        # The SYSTEMDB placeholder is not exported once the databases are connected
+        mock_exporter_metrics.remove_database_metrics.assert_called_once_with('SYSTEMDB', [])
+        mock_setup_collector.assert_called_once_with(dbs, 'config', 'metrics')
+        server.set_payload_cache.assert_called_once_with('payload_cache')
+        server.stop.assert_not_called()
+        assert state == {'collector': 'collector'}
+
+    @mock.patch('hanadb_exporter.main.LOGGER')
+    @mock.patch('hanadb_exporter.main.setup_collector')
+    def test_start_in_background_error(self, mock_setup_collector, mock_logger):
+        dbs = mock.Mock()
+        error = ValueError('error')
+        dbs.start.side_effect = error
+        server = mock.Mock()
+        state = {}
+
+        main.start_in_background(
+            dbs, ('host', 30013, {'user': 'user'}), 'config', 'metrics', server, state)
+
+        mock_setup_collector.assert_not_called()
+        server.stop.assert_called_once_with()
+        assert state == {'error': error}
+        mock_logger.error.assert_called_once_with('exporter could not be started: %s', 'error')
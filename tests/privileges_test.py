@@ -0,0 +1,83 @@
+"""
+Unitary tests for privileges.py.
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.com
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212,W0611
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+from hanadb_exporter import privileges
+
+
+class TestPrivileges(object):
+    """
+    Unitary tests for privileges.
+    """
+
+    def test_referenced_objects(self):
+        assert privileges.referenced_objects(
+            'SELECT host FROM sys.m_cs_tables t JOIN "_SYS_STATISTICS"."Alerts" a '
+            'ON t.host = a.host JOIN M_SERVICES s ON 1 = 1 JOIN sys . m_cs_tables') == [
+                ('SYS', 'M_CS_TABLES'), ('_SYS_STATISTICS', 'Alerts'), ('SYS', 'M_SERVICES')]
+
+    def test_referenced_objects_subqueries(self):
+        assert privileges.referenced_objects(
+            'WITH data AS (SELECT host FROM m_host_information), other AS (SELECT 1 FROM DUMMY) '
+            'SELECT EXTRACT(YEAR FROM time), TRIM(BOTH FROM host) FROM data, '
+            '(SELECT 1 FROM _SYS_STATISTICS.STATISTICS_CURRENT_ALERTS) JOIN other') == [
+                ('SYS', 'M_HOST_INFORMATION'), ('SYS', 'DUMMY'),
+                ('_SYS_STATISTICS', 'STATISTICS_CURRENT_ALERTS')]
+
+    def test_retrieve(self):
+        connector = mock.Mock()
+        connector.query.return_value.records = [
+            ('SYSTEMPRIVILEGE', None, None, 'CATALOG READ')]
+
+        user_privileges = privileges.Privileges.retrieve(connector)
+
+        connector.query.assert_called_once_with(privileges.PRIVILEGES_QUERY)
+        assert user_privileges.can_read('SYS', 'M_SERVICES')
+
+    def test_can_read(self):
+        user_privileges = privileges.Privileges([
+            ('SCHEMA', '_SYS_STATISTICS', None, 'SELECT'),
+            ('VIEW', 'OTHER', 'VIEW1', 'SELECT'),
+            ('TABLE', 'OTHER', 'TABLE1', 'INSERT'),
+            ('SCHEMA', 'OTHER2', None, 'CREATE ANY')
+        ])
+
+        assert user_privileges.can_read('SYS', 'DUMMY')
+        assert not user_privileges.can_read('SYS', 'M_SERVICES')
+        assert user_privileges.can_read('_SYS_STATISTICS', 'STATISTICS_CURRENT_ALERTS')
+        assert user_privileges.can_read('OTHER', 'VIEW1')
+        assert not user_privileges.can_read('OTHER', 'TABLE1')
+        assert not user_privileges.can_read('OTHER2', 'TABLE1')
+
+        user_privileges = privileges.Privileges([
+            ('SYSTEMPRIVILEGE', None, None, 'DATA ADMIN')])
+        assert user_privileges.can_read('SYS', 'M_SERVICES')
+        assert not user_privileges.can_read('_SYS_STATISTICS', 'STATISTICS_CURRENT_ALERTS')
+
+    def test_missing_objects(self):
+        user_privileges = privileges.Privileges([
+            ('SYSTEMPRIVILEGE', None, None, 'CATALOG READ')])
+
+        assert user_privileges.missing_objects(
+            'SELECT * FROM M_SERVICES JOIN _SYS_STATISTICS.STATISTICS_CURRENT_ALERTS') == [
+                '_SYS_STATISTICS.STATISTICS_CURRENT_ALERTS']
+        assert user_privileges.missing_objects('SELECT 1 FROM DUMMY') == []
@@ -0,0 +1,223 @@
+"""
+Tests of the exporter against the installed prometheus_client (not mocked).
+
+:author: xarbulu
+:organization: SUSE Linux GmbH
+:contact: xarbulu@suse.com
+
+:since: 2026-10-18
+"""
+
+# pylint:disable=C0103,C0111,W0212,W0611
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import importlib
+import json
+import math
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+sys.modules['shaptools'] = mock.MagicMock()
+
+REAL_PACKAGES = ('prometheus_client', 'hanadb_exporter')
+
+
+def import_real_modules():
+    """
+    Import the exporter modules with the installed prometheus_client. The other test modules
+    replace it by a mock, so their modules are put aside and returned, to restore them after
+    the test
+    """
+    saved = {
+        name: module for name, module in sys.modules.items()
+        if name.split('.')[0] in REAL_PACKAGES}
+    for name in saved:
+        del sys.modules[name]
+    importlib.import_module('prometheus_client')
+    importlib.import_module('hanadb_exporter.prometheus_exporter')
+    return saved
+
+
+def restore_modules(saved):
+    """
+    Restore the modules put aside by import_real_modules
+    """
+    for name in list(sys.modules):
+        if name.split('.')[0] in REAL_PACKAGES:
+            del sys.modules[name]
+    sys.modules.update(saved)
+
+
+class FakeConnector(object):
+    """
+    hdb_connector replacement returning the same records for every query
+    """
+
+    def __init__(self, database_name):
+        self._database_name = database_name
+
+    def query(self, sql_statement):
+        if sql_statement.startswith('SELECT\n(SELECT value'):
+            return mock.Mock(
+                metadata=[('SID',), ('INSNR',), ('DATABASE_NAME',), ('VERSION',)],
+                records=[('PRD', '00', self._database_name, '2.00.040')])
+        return mock.Mock(
+            metadata=[('HOST',), ('VALUE',)], records=[('host1', 1), ('host2', 2)])
+
+    def isconnected(self):
+        return True
+
+    def reconnect(self):
+        pass
+
+
+def query_data(query_id):
+    return {
+        'id': query_id,
+        'metrics': [{
+            'name': '{}_value'.format(query_id), 'description': 'dummy', 'labels': ['HOST'],
+            'value': 'VALUE', 'unit': 'mb', 'type': 'gauge'}]}
+
+
+class TestReloadSelfMonitoring(object):
+    """
+    Self monitoring series of the reloaded metrics files
+    """
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._saved_modules = import_real_modules()
+        self._registry = sys.modules['prometheus_client'].REGISTRY
+        self._prometheus_exporter = sys.modules['hanadb_exporter.prometheus_exporter']
+
+    def teardown(self):
+        """
+        Test tearDown.
+        """
+        restore_modules(self._saved_modules)
+
+    def _query_samples(self, query_id):
+        return [
+            sample for family in self._registry.collect() for sample in family.samples
+            if sample.labels.get('query') == query_id]
+
+    def test_reload_removed_query(self, tmp_path):
+        metrics_file = tmp_path / 'metrics.json'
+        metrics_file.write_text(json.dumps({
+            'SELECT 1 FROM DUMMY': query_data('query1'),
+            'SELECT 2 FROM DUMMY': query_data('query2')}))
+        new_metrics_file = tmp_path / 'new_metrics.json'
+        new_metrics_file.write_text(json.dumps({'SELECT 1 FROM DUMMY': query_data('query1')}))
+
+        collectors = self._prometheus_exporter.SapHanaCollectors(
+            [FakeConnector('DB1')], str(metrics_file))
+        list(collectors.collect())
+        labels = {'query': 'query2', 'database_name': 'DB1'}
+        assert self._registry.get_sample_value('hanadb_exporter_query_rows', labels) == 2
+        assert self._query_samples('query2')
+
+        assert collectors.reload(str(new_metrics_file))
+        list(collectors.collect())
+
+        # The series of the removed query are not exported anymore
+        assert self._query_samples('query2') == []
+        labels = {'query': 'query1', 'database_name': 'DB1'}
+        assert self._registry.get_sample_value('hanadb_exporter_query_rows', labels) == 2
+
+
+class TestDirectExpositionOutput(object):
+    """
+    The rendered gauges are written byte by byte as the prometheus_client encoders write the
+    metric families
+    """
+
+    LABELS = ['sid', 'insnr', 'database_name', 'host', 'path']
+    CONSTANT_LABELS = ('PRD', '00', 'DB"1\\')
+    SAMPLES = [
+        (('host1', '/hana/data'), 10),
+        (('host2', 'c:\\hana\\"log"\nline'), 0.5),
+        (('h{0}', 'ñ'), 1e-10),
+        (('host4', ''), 12345678901234567890),
+        (('host5', 'nan'), math.nan),
+        (('host6', 'inf'), math.inf),
+        (('host7', '-inf'), -math.inf)
+    ]
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._saved_modules = import_real_modules()
+        self._client = sys.modules['prometheus_client']
+        self._prometheus_exporter = sys.modules['hanadb_exporter.prometheus_exporter']
+
+    def teardown(self):
+        """
+        Test tearDown.
+        """
+        restore_modules(self._saved_modules)
+
+    def _registry(self, families):
+        registry = self._client.CollectorRegistry(auto_describe=False)
+        registry.register(mock.Mock(spec=['collect'], collect=families))
+        return registry
+
+    def _families(self):
+        gauge = self._client.core.GaugeMetricFamily(
+            'hanadb_used_memory', 'Used memory\\ "by" path\nin MB', None, self.LABELS, 'mb')
+        for labels, value in self.SAMPLES:
+            gauge.add_metric(self.CONSTANT_LABELS + labels, value)
+        counter = self._client.core.CounterMetricFamily(
+            'hanadb_exporter_scrapes', 'Scrapes', labels=['database_name'])
+        counter.add_metric(['DB1'], 3)
+        return [gauge, counter, gauge]
+
+    def _rendered_families(self):
+        template = self._prometheus_exporter.GaugeTemplate(
+            'hanadb_used_memory', 'Used memory\\ "by" path\nin MB', self.LABELS, 'mb',
+            self.CONSTANT_LABELS)
+        gauge = self._prometheus_exporter.RenderedGauge(template)
+        for labels, value in self.SAMPLES:
+            gauge.add_metric(labels, value)
+        families = self._families()
+        return [gauge, families[1], gauge]
+
+    @pytest.mark.parametrize('accept', [
+        'text/plain;version=0.0.4',
+        'text/plain;version=1.0.0',
+        'application/openmetrics-text;version=0.0.1',
+        'application/openmetrics-text;version=1.0.0'
+    ])
+    def test_direct_encoder(self, accept):
+        encoder, content_type = self._client.exposition.choose_encoder(accept)
+        expected = encoder(self._registry(self._families))
+
+        # The gauges are written directly, not with the negotiated encoder
+        assert self._rendered_families()[0].render(encoder, content_type) is not None
+        direct_encoder = self._prometheus_exporter.direct_encoder(encoder, content_type)
+        output = direct_encoder(self._registry(self._rendered_families))
+
+        assert output == expected
+
+    def test_direct_encoder_openmetrics(self):
+        openmetrics = importlib.import_module('prometheus_client.openmetrics.exposition')
+        encoder, content_type = openmetrics.generate_latest, openmetrics.CONTENT_TYPE_LATEST
+        expected = encoder(self._registry(self._families))
+        assert expected.endswith(b'# EOF\n')
+
+        # The gauges are written directly, not with the negotiated encoder
+        assert self._rendered_families()[0].render(encoder, content_type) is not None
+        direct_encoder = self._prometheus_exporter.direct_encoder(encoder, content_type)
+        output = direct_encoder(self._registry(self._rendered_families))
+
+        assert output == expected
@@ -15,6 +15,8 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import logging
+import threading
+import time
 
 try:
     from unittest import mock
@@ -27,14 +29,80 @@ sys.modules['shaptools'] = mock.MagicMock()
 sys.modules['prometheus_client'] = mock.MagicMock()
 
 from hanadb_exporter import prometheus_exporter
+from hanadb_exporter import prometheus_metrics
+from hanadb_exporter import utils
+
+FAKE_QUERY = prometheus_metrics.Query.get_model('SELECT HOST, VALUE FROM DUMMY', {
+    'metrics': [{
+        'name': 'dummy_value', 'description': 'dummy', 'labels': ['HOST'], 'value': 'VALUE',
+        'unit': 'mb', 'type': 'gauge'}]})
+
+
+def metric_plan(metric):
+    """
+    Create the plan of a mocked metric
+    """
+    return prometheus_metrics.MetricPlan(metric, (), 0)
+
+
+def resolve_metrics(query):
+    """
+    Set the plans of the mocked query metrics
+    """
+    query.resolve_columns.return_value = [metric_plan(metric) for metric in query.metrics]
+
+
+class FakeConnector(object):
+    """
+    hdb_connector replacement returning static data after the injected latency
+    """
+
+    def __init__(self, database_name, latency=0, event=None):
+        self._database_name = database_name
+        self._latency = latency
+        self._event = event
+
+    def query(self, sql_statement):
+        time.sleep(self._latency)
+        if self._event is not None:
+            self._event.wait()
+        if sql_statement.startswith('SELECT\n(SELECT value'):
+            return mock.Mock(
+                metadata=[('SID',), ('INSNR',), ('DATABASE_NAME',), ('VERSION',)],
+                records=[('PRD', '00', self._database_name, '2.00.040')])
+        return mock.Mock(
+            metadata=[('HOST',), ('VALUE',)], records=[('host1', 1), ('host2', 2)])
+
+    def isconnected(self):
+        return True
+
+    def reconnect(self):
+        pass
+
+
+class FakeMetric(object):
+    """
+    Labelled prometheus metric replacement keeping its children
+    """
+
+    def __init__(self):
+        self.children = {}
+
+    def labels(self, *labelvalues):
+        return self.children.setdefault(labelvalues, mock.Mock())
+
+    def remove(self, *labelvalues):
+        del self.children[labelvalues]
+
 
 class TestSapHanaCollectors(object):
     """
     Unitary tests for SapHanaCollectors.
     """
 
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
     @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
-    def test_init(self, mock_collector):
+    def test_init(self, mock_collector, mock_metrics):
 
         conn1 = mock.Mock()
         conn2 = mock.Mock()
@@ -47,12 +115,149 @@ class TestSapHanaCollectors(object):
 
         collectors = prometheus_exporter.SapHanaCollectors(connectors, 'metrics.json')
 
+        mock_metrics.assert_called_once_with('metrics.json')
+        # The label values are interned in a table shared by all the collectors
+        label_values = collectors._collector_options['label_values']
+        assert isinstance(label_values, utils.InternTable)
         mock_collector.assert_has_calls([
-            mock.call(conn1, 'metrics.json'),
-            mock.call(conn2, 'metrics.json')
+            mock.call(conn1, mock_metrics.return_value, query_timeout=None,
+                      query_workers=1, failure_threshold=0, check_privileges=False,
+                      batch_size=0, direct_exposition=False, reuse_results=False,
+                      label_values=label_values),
+            mock.call(conn2, mock_metrics.return_value, query_timeout=None,
+                      query_workers=1, failure_threshold=0, check_privileges=False,
+                      batch_size=0, direct_exposition=False, reuse_results=False,
+                      label_values=label_values)
         ])
 
         assert collectors._collectors == [coll1, coll2]
+        assert collectors._executor is None
+        # A hung database does not block the concurrent collection forever
+        assert collectors._timeout == prometheus_exporter.COLLECTION_TIMEOUT
+
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_init_startup_workers(self, mock_collector, mock_metrics):
+        connectors = [mock.Mock(), mock.Mock(), mock.Mock()]
+        # All the collectors must be created at the same time to pass the barrier
+        barrier = threading.Barrier(3, timeout=5)
+        def create_collector(connector, metrics_config, **kwargs):
+            barrier.wait()
+            return mock.Mock(connector=connector)
+        mock_collector.side_effect = create_collector
+
+        collectors = prometheus_exporter.SapHanaCollectors(
+            connectors, 'metrics.json', startup_workers=3)
+
+        assert [collector.connector for collector in collectors._collectors] == connectors
+
+    @mock.patch('logging.Logger.info')
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_reload(self, mock_collector, mock_metrics, mock_info):
+        coll1, coll2 = mock.Mock(), mock.Mock()
+        mock_collector.side_effect = [coll1, coll2]
+        current, new = mock.Mock(), mock.Mock()
+        mock_metrics.side_effect = [current, new]
+        new.merge.return_value = (['query1'], ['query2'], ['query3'])
+
+        collectors = prometheus_exporter.SapHanaCollectors(
+            [mock.Mock(), mock.Mock()], 'metrics.json')
+
+        # The new metrics file is swapped in once the running collection finishes
+        results = []
+        collectors._cycle_lock.acquire()
+        thread = threading.Thread(
+            target=lambda: results.append(collectors.reload('new_metrics.json')))
+        thread.start()
+        time.sleep(0.1)
+        assert results == []
+        assert collectors._metrics_config is current
+        collectors._cycle_lock.release()
+        thread.join(5)
+
+        assert results == [True]
+        mock_metrics.assert_called_with('new_metrics.json')
+        new.merge.assert_called_once_with(current)
+        assert collectors._metrics_config is new
+        coll1.set_metrics_config.assert_called_once_with(new, ['query2', 'query3'])
+        coll2.set_metrics_config.assert_called_once_with(new, ['query2', 'query3'])
+        mock_info.assert_called_with(
+            'Metrics file %s reloaded in %.3f seconds: %d queries added, %d removed and %d '
+            'changed', 'new_metrics.json', mock.ANY, 1, 1, 1)
+
+    @mock.patch('logging.Logger.error')
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_reload_error(self, mock_collector, mock_metrics, mock_error):
+        current = mock.Mock()
+        mock_metrics.side_effect = [current, ValueError('error')]
+
+        collectors = prometheus_exporter.SapHanaCollectors([mock.Mock()], 'metrics.json')
+
+        assert collectors.reload('new_metrics.json') is False
+        assert collectors._metrics_config is current
+        mock_collector.return_value.set_metrics_config.assert_not_called()
+        mock_error.assert_called_once_with(
+            'Metrics file %s could not be reloaded, keeping the current queries: %s',
+            'new_metrics.json', 'error')
+
+    @mock.patch('logging.Logger.error')
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_sync(self, mock_collector, mock_metrics, mock_error):
+        conn1, conn2, conn3, conn4 = mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()
+        coll1 = mock.Mock(connector=conn1)
+        coll2 = mock.Mock(connector=conn2)
+        coll3 = mock.Mock(connector=conn3)
+        mock_collector.side_effect = [coll1, coll2, coll3, Exception('error')]
+
+        collectors = prometheus_exporter.SapHanaCollectors(
+            [conn1, conn2], 'metrics.json', query_timeout=5, failure_threshold=3)
+        collectors._pending[coll2] = mock.Mock()
+        collectors.sync([conn1, conn3, conn4])
+
+        assert collectors._collectors == [coll1, coll3]
+        label_values = collectors._collector_options['label_values']
+        mock_collector.assert_has_calls([
+            mock.call(conn3, mock_metrics.return_value, query_timeout=5, query_workers=1,
+                      failure_threshold=3, check_privileges=False,
+                      batch_size=0, direct_exposition=False, reuse_results=False,
+                      label_values=label_values),
+            mock.call(conn4, mock_metrics.return_value, query_timeout=5, query_workers=1,
+                      failure_threshold=3, check_privileges=False,
+                      batch_size=0, direct_exposition=False, reuse_results=False,
+                      label_values=label_values)
+        ])
+        coll1.stop.assert_not_called()
+        coll2.stop.assert_called_once_with()
+        assert collectors._pending == {}
+        mock_error.assert_called_once_with(
+            'Collector of a new database could not be created: %s', 'error')
+
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    def test_sync_removed_database_metrics(self, mock_metrics):
+        mock_metrics.return_value.queries = [FAKE_QUERY]
+        metrics = {
+            name: FakeMetric() for name in [
+                'DATABASE_UP', 'LAST_SUCCESS', 'RECONNECT_DURATION', 'QUERY_TIMEOUTS',
+                'QUERY_ROWS', 'QUERY_ERRORS', 'QUERY_CIRCUIT_OPEN', 'QUERY_STALE',
+                'QUERY_DURATION', 'QUERY_SKIPS', 'QUERY_RESULTS']}
+        conn1, conn2 = FakeConnector('DB1'), FakeConnector('DB2')
+
+        with mock.patch.multiple('hanadb_exporter.exporter_metrics', **metrics):
+            collectors = prometheus_exporter.SapHanaCollectors([conn1, conn2], 'metrics.json')
+            list(collectors.collect())
+            assert ('DB2',) in metrics['DATABASE_UP'].children
+            assert (FAKE_QUERY.id, 'DB2') in metrics['QUERY_ROWS'].children
+
+            collectors.sync([conn1])
+
+        # The series of the removed database are not exported anymore
+        for metric in metrics.values():
+            assert all('DB2' not in labelvalues for labelvalues in metric.children)
+        assert list(metrics['DATABASE_UP'].children) == [('DB1',)]
+        assert list(metrics['QUERY_ROWS'].children) == [(FAKE_QUERY.id, 'DB1')]
 
     @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
     def test_collect(self, mock_collector):
@@ -75,8 +280,225 @@ class TestSapHanaCollectors(object):
         for i, metric in enumerate(collectors.collect()):
             assert metric == metrics[i]
 
-        coll1.collect.assert_called_once_with()
-        coll2.collect.assert_called_once_with()
+        coll1.collect.assert_called_once_with(None)
+        coll2.collect.assert_called_once_with(None)
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_collect_single_flight(self, mock_collector):
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def collect(deadline):
+            started.set()
+            release.wait()
+            return ['metric1', 'metric2']
+
+        coll1 = mock.Mock()
+        coll1.collect.side_effect = collect
+        mock_collector.side_effect = [coll1]
+
+        collectors = prometheus_exporter.SapHanaCollectors(['conn1'], 'metrics.json')
+
+        results = []
+        scrapes = [
+            threading.Thread(target=lambda: results.append(collectors.collect()))
+            for _ in range(3)]
+        scrapes[0].start()
+        assert started.wait(1)
+        for scrape in scrapes[1:]:
+            scrape.start()
+        # Give some time to the other scrapes to join the running collection
+        time.sleep(0.1)
+        release.set()
+        for scrape in scrapes:
+            scrape.join()
+
+        assert results == [['metric1', 'metric2']] * 3
+        coll1.collect.assert_called_once_with(None)
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector')
+    def test_collect_concurrently_error(self, mock_collector):
+
+        coll1 = mock.Mock(database_name='SYSTEMDB')
+        coll1.collect.return_value = ['metric1', 'metric2']
+        coll2 = mock.Mock(database_name='PRD')
+        coll2.collect.side_effect = ValueError('error')
+        coll3 = mock.Mock(database_name='QAS')
+        coll3.collect.return_value = ['metric3']
+
+        mock_collector.side_effect = [coll1, coll2, coll3]
+
+        collectors = prometheus_exporter.SapHanaCollectors(
+            ['conn1', 'conn2', 'conn3'], 'metrics.json', workers=2)
+
+        assert list(collectors.collect()) == ['metric1', 'metric2', 'metric3']
+
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    def test_collect_concurrently_latency(self, mock_metrics):
+
+        mock_metrics.return_value.queries = [FAKE_QUERY]
+
+        connectors = [FakeConnector('DB{}'.format(index), 0.2) for index in range(4)]
+        collectors = prometheus_exporter.SapHanaCollectors(
+            connectors, 'metrics.json', workers=4)
+
+        start = time.time()
+        metrics = list(collectors.collect())
+        elapsed = time.time() - start
+
+        assert len(metrics) == 4
+        # Sequentially the scrape would take at least 0.8 seconds
+        assert elapsed < 0.6
+
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    def test_collect_concurrently_hung_database(self, mock_metrics, mock_warning):
+
+        mock_metrics.return_value.queries = [FAKE_QUERY]
+
+        hung_connector = FakeConnector('HUNG')
+        connectors = [FakeConnector('SYSTEMDB'), hung_connector, FakeConnector('PRD', 0.05)]
+        collectors = prometheus_exporter.SapHanaCollectors(
+            connectors, 'metrics.json', workers=2, timeout=0.5)
+
+        release = threading.Event()
+        hung_connector._event = release
+        try:
+            start = time.time()
+            metrics = list(collectors.collect())
+            elapsed = time.time() - start
+
+            assert len(metrics) == 2
+            assert elapsed < 1
+            mock_warning.assert_called_once_with(
+                'Collection of database %s has not finished in %s seconds, skipping...',
+                'HUNG', 0.5)
+
+            # The hung database is not queried again while the previous collection is running
+            mock_warning.reset_mock()
+            metrics = list(collectors.collect())
+            assert len(metrics) == 2
+            mock_warning.assert_called_once_with(
+                'Previous collection of database %s is still running, skipping...', 'HUNG')
+        finally:
+            release.set()
+
+        time.sleep(0.1)
+        assert len(list(collectors.collect())) == 3
+
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
+    def test_collect_concurrently_deadline(self, mock_metrics, mock_warning):
+
+        mock_metrics.return_value.queries = [FAKE_QUERY]
+
+        hung_connector = FakeConnector('HUNG')
+        connectors = [FakeConnector('SYSTEMDB'), hung_connector]
+        collectors = prometheus_exporter.SapHanaCollectors(
+            connectors, 'metrics.json', workers=2, timeout=10)
+
+        release = threading.Event()
+        # The collection hangs before running the queries, so they don't reach the deadline
+        hung_connector.isconnected = lambda: release.wait()
+        try:
+            # The scrape deadline is shorter than the collection timeout
+            with prometheus_exporter.utils.scrape_deadline(time.monotonic() + 0.2):
+                start = time.time()
+                metrics = list(collectors.collect())
+                elapsed = time.time() - start
+
+            assert len(metrics) == 1
+            assert elapsed < 1
+            mock_warning.assert_called_once_with(
+                'Collection of database %s has not finished in %s seconds, skipping...',
+                'HUNG', mock.ANY)
+        finally:
+            release.set()
+
+
+class TestSnapshotCollector(object):
+    """
+    Unitary tests for SnapshotCollector.
+    """
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._mock_collectors = mock.Mock()
+        self._collector = prometheus_exporter.SnapshotCollector(self._mock_collectors, 10)
+
+    def test_reload(self):
+        self._mock_collectors.reload.return_value = True
+        assert self._collector.reload('metrics.json') is True
+        self._mock_collectors.reload.assert_called_once_with('metrics.json')
+
+    @mock.patch('time.time')
+    def test_refresh(self, mock_time):
+        mock_time.return_value = 5
+        self._mock_collectors.collect.return_value = iter(['metric1', 'metric2'])
+        self._collector.refresh()
+        assert self._collector._snapshot == (5, ('metric1', 'metric2'))
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    @mock.patch('time.time')
+    def test_collect(self, mock_time, mock_core):
+        mock_age = mock.Mock()
+        mock_core.GaugeMetricFamily.return_value = mock_age
+        mock_time.return_value = 15
+        self._collector._snapshot = (5, ('metric1', 'metric2'))
+
+        assert list(self._collector.collect()) == ['metric1', 'metric2', mock_age]
+
+        self._mock_collectors.collect.assert_not_called()
+        mock_core.GaugeMetricFamily.assert_called_once_with(
+            'hanadb_exporter_snapshot_age_seconds',
+            'Seconds since the served collection finished', None, [], 'seconds')
+        mock_age.add_metric.assert_called_once_with([], 10)
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    @mock.patch('time.time')
+    def test_collect_snapshot_age(self, mock_time, mock_core):
+        mock_age = mock.Mock()
+        mock_core.GaugeMetricFamily.return_value = mock_age
+        mock_time.return_value = 15
+        assert self._collector.generation is None
+        self._collector._snapshot = (5, ('metric1', 'metric2'))
+
+        assert self._collector.generation == 5
+        assert list(self._collector.collect_snapshot()) == ['metric1', 'metric2']
+        mock_core.GaugeMetricFamily.assert_not_called()
+        assert list(self._collector.collect_age()) == [mock_age]
+        mock_age.add_metric.assert_called_once_with([], 10)
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_collect_empty(self, mock_core):
+        mock_age = mock.Mock()
+        mock_core.GaugeMetricFamily.return_value = mock_age
+
+        assert list(self._collector.collect()) == [mock_age]
+        mock_age.add_metric.assert_not_called()
+
+    @mock.patch('logging.Logger.error')
+    def test_start_stop(self, mock_logger):
+        collected = threading.Event()
+
+        def collect():
+            collected.set()
+            raise ValueError('error')
+
+        self._mock_collectors.collect.side_effect = collect
+        self._collector.start()
+        assert collected.wait(1)
+        self._collector.stop()
+
+        self._mock_collectors.collect.assert_called_once_with()
+        mock_logger.assert_has_calls([
+            mock.call('Collection failed, serving the previous snapshot...'),
+            mock.call('error')
+        ])
+        assert self._collector._snapshot == (None, ())
 
 
 class TestSapHanaCollector(object):
@@ -85,19 +507,19 @@ class TestSapHanaCollector(object):
     """
 
     @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector.retrieve_metadata')
-    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics')
-    def setup(self, mock_metrics, mock_retrieve_metadata):
+    def setup(self, mock_retrieve_metadata):
         """
         Test setUp.
         """
-        self._mock_metrics_config = mock.Mock()
-        mock_metrics.return_value = self._mock_metrics_config
+        self._mock_metrics_config = mock.Mock(queries=[])
         self._mock_connector = mock.Mock()
-        self._collector = prometheus_exporter.SapHanaCollector(self._mock_connector, 'metrics.json')
+        self._collector = prometheus_exporter.SapHanaCollector(
+            self._mock_connector, self._mock_metrics_config)
 
         self._collector._sid = 'prd'
         self._collector._insnr = '00'
         self._collector._database_name = 'db_name'
+        self._collector._metadata_label_values = ('prd', '00', 'db_name')
         self._collector._hana_version = '2.0'
 
         mock_retrieve_metadata.assert_called_once_with()
@@ -105,6 +527,32 @@ class TestSapHanaCollector(object):
     def test_metadata_labels(self):
         assert ['prd', '00', 'db_name'] == self._collector.metadata_labels
 
+    @mock.patch('logging.Logger.info')
+    def test_active_queries(self, mock_logger):
+        query1 = mock.Mock(enabled=True, query='query1')
+        query2 = mock.Mock(enabled=False, query='query2')
+        query3 = mock.Mock(enabled=True, query='query3', hana_version_range=['3.0'])
+        query3.is_available.return_value = False
+        self._collector._metrics_config.queries = [query1, query2, query3]
+
+        assert self._collector.active_queries == [query1]
+        # The queries are resolved only once until the metadata is retrieved again
+        assert self._collector.active_queries == [query1]
+        query1.is_available.assert_called_once_with((2, 0))
+        query3.is_available.assert_called_once_with((2, 0))
+        mock_logger.assert_has_calls([
+            mock.call('Query %s is disabled', 'query2'),
+            mock.call('Query %s out of the provided hana version range: %s', 'query3', ['3.0'])
+        ])
+
+        self._collector._hdb_connector.query = mock.Mock(return_value=mock.Mock(
+            metadata=[('SID',), ('INSNR',), ('DATABASE_NAME',), ('VERSION',)],
+            records=[('prd', '00', 'db_name', '3.0')]))
+        query3.is_available.return_value = True
+        self._collector.retrieve_metadata()
+        assert self._collector.active_queries == [query1, query3]
+        query3.is_available.assert_called_with((3, 0))
+
     @mock.patch('hanadb_exporter.utils.format_query_result')
     @mock.patch('logging.Logger.info')
     def test_retrieve_metadata(self, mock_logger, mock_format_query):
@@ -141,6 +589,43 @@ FROM m_database m;"""
         assert self._collector._insnr == '10'
         assert self._collector._database_name == 'DB_SYSTEM'
         assert self._collector._hana_version == '1.2.3'
+        assert self._collector._privileges is None
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.privileges.Privileges.retrieve')
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.utils.format_query_result')
+    @mock.patch('logging.Logger.warning')
+    def test_retrieve_metadata_privileges(
+            self, mock_warning, mock_format_query, mock_base_connector, mock_retrieve):
+        mock_base_connector.QueryError = Exception
+        mock_format_query.return_value = [
+            {'SID': 'ha1', 'INSNR': '10', 'DATABASE_NAME': 'DB_SYSTEM', 'VERSION': '1.2.3'}]
+        self._collector._check_privileges = True
+
+        self._collector.retrieve_metadata()
+        mock_retrieve.assert_called_once_with(self._mock_connector)
+        assert self._collector._privileges == mock_retrieve.return_value
+
+        # The queries are not disabled if the privileges cannot be retrieved
+        mock_retrieve.side_effect = Exception('error')
+        self._collector.retrieve_metadata()
+        assert self._collector._privileges is None
+        mock_warning.assert_called_once_with(
+            'Privileges of the database user could not be checked: %s', 'error')
+
+    @mock.patch('logging.Logger.warning')
+    def test_active_queries_privileges(self, mock_warning):
+        query1 = mock.Mock(enabled=True, query='query1')
+        query2 = mock.Mock(enabled=True, query='query2')
+        self._collector._metrics_config.queries = [query1, query2]
+        self._collector._privileges = mock.Mock()
+        self._collector._privileges.missing_objects.side_effect = [
+            [], ['_SYS_STATISTICS.ALERTS', 'SYS.M_CS_TABLES']]
+
+        assert self._collector.active_queries == [query1]
+        mock_warning.assert_called_once_with(
+            'Query %s is disabled, the user cannot read: %s', 'query2',
+            '_SYS_STATISTICS.ALERTS, SYS.M_CS_TABLES')
 
     @mock.patch('hanadb_exporter.prometheus_exporter.core')
     @mock.patch('logging.Logger.debug')
@@ -158,29 +643,50 @@ FROM m_database m;"""
         mock_metric.unit = 'mb'
         mock_metric.value = 'column3'
 
-        formatted_query = [
-            {'column1':'data1', 'column2':'data2', 'column3':'data3'},
-            {'column1':'data4', 'column2':'data5', 'column3':'data6'},
-            {'column1':'data7', 'column2':'data8', 'column3':'data9'}
+        records = [
+            ('data1', 'data2', 'data3'),
+            ('data4', 'data5', 'data6'),
+            ('data7', 'data8', 'data9')
         ]
 
-        metric_obj = self._collector._manage_gauge(mock_metric, formatted_query)
+        metric_plan = prometheus_metrics.MetricPlan(mock_metric, (0, 1), 2)
+        metric_obj = self._collector._manage_gauge(metric_plan, records)
 
         mock_core.GaugeMetricFamily.assert_called_once_with(
             'name', 'description', None,
             ['sid', 'insnr', 'database_name', 'column1', 'column2'], 'mb')
 
         mock_gauge_instance.add_metric.assert_has_calls([
-            mock.call(['prd', '00', 'db_name', 'data1', 'data2'], 'data3'),
-            mock.call(['prd', '00', 'db_name', 'data4', 'data5'], 'data6'),
-            mock.call(['prd', '00', 'db_name', 'data7', 'data8'], 'data9')
+            mock.call(('prd', '00', 'db_name', 'data1', 'data2'), 'data3'),
+            mock.call(('prd', '00', 'db_name', 'data4', 'data5'), 'data6'),
+            mock.call(('prd', '00', 'db_name', 'data7', 'data8'), 'data9')
         ])
 
         mock_logger.assert_called_once_with('%s \n', 'samples')
         assert metric_obj == mock_gauge_instance
 
+    def test_intern_labels(self):
+        metric_plans = [
+            prometheus_metrics.MetricPlan(mock.Mock(), (0,), 2),
+            prometheus_metrics.MetricPlan(mock.Mock(), (1, 0), 2),
+            prometheus_metrics.MetricPlan(mock.Mock(), None, 2)]
+        value = ''.join(['da', 'ta'])
+        records = self._collector._intern_labels(metric_plans, [(value, 1, 1.5)])
+        assert records == [('data', 1, 1.5)]
+
+        # The records of the next scrapes share the same label values
+        records = self._collector._intern_labels(
+            metric_plans, [(''.join(['dat', 'a']), 1, 2.5), (None, 2, 3.5)])
+        assert records == [('data', 1, 2.5), (None, 2, 3.5)]
+        assert records[0][0] is value
+
+        # The rendered gauges do not keep the label values
+        self._collector._direct_exposition = True
+        records = [(''.join(['dat', 'a']), 1, 2.5)]
+        assert self._collector._intern_labels(metric_plans, records) is records
+
     @mock.patch('hanadb_exporter.prometheus_exporter.core')
-    @mock.patch('logging.Logger.warn')
+    @mock.patch('logging.Logger.warning')
     @mock.patch('logging.Logger.debug')
     def test_manage_gauge_incorrect_label(self, logger_debug, logger_warn, mock_core):
 
@@ -196,11 +702,10 @@ FROM m_database m;"""
         mock_metric.unit = 'mb'
         mock_metric.value = 'column3'
 
-        formatted_query = [
-            {'column1': 'data1', 'column2': 'data2', 'column3': 'data3'}
-        ]
+        records = [('data1', 'data2', 'data3')]
 
-        metric_obj = self._collector._manage_gauge(mock_metric, formatted_query)
+        metric_plan = prometheus_metrics.MetricPlan(mock_metric, None, 2)
+        metric_obj = self._collector._manage_gauge(metric_plan, records)
 
         mock_core.GaugeMetricFamily.assert_called_once_with(
             'name', 'description', None,
@@ -215,7 +720,7 @@ FROM m_database m;"""
         logger_debug.assert_called_once_with('%s \n', [])
 
     @mock.patch('hanadb_exporter.prometheus_exporter.core')
-    @mock.patch('logging.Logger.warn')
+    @mock.patch('logging.Logger.warning')
     @mock.patch('logging.Logger.debug')
     def test_manage_gauge_incorrect_value(self, logger_debug, logger_warn, mock_core):
 
@@ -231,14 +736,14 @@ FROM m_database m;"""
         mock_metric.unit = 'mb'
         mock_metric.value = 'column4'
 
-        formatted_query = [
-            {'column1': 'data1', 'column2': 'data2', 'column3': 'data3'},
-            {'column1': 'data4', 'column4': None, 'column3': 'data6'}
-        ]
-
-        metric_obj = self._collector._manage_gauge(mock_metric, formatted_query)
+        # The value column is not in the first result and it is None in the second one
+        metric_plan = prometheus_metrics.MetricPlan(mock_metric, (0, 1), None)
+        metric_obj = self._collector._manage_gauge(metric_plan, [('data1', 'data2', 'data3')])
+        metric_plan = prometheus_metrics.MetricPlan(mock_metric, (0, 1), 3)
+        metric_obj = self._collector._manage_gauge(
+            metric_plan, [('data4', 'data5', 'data6', None)])
 
-        mock_core.GaugeMetricFamily.assert_called_once_with(
+        mock_core.GaugeMetricFamily.assert_called_with(
             'name', 'description', None,
             ['sid', 'insnr', 'database_name', 'column1', 'column2'], 'mb')
 
@@ -252,27 +757,219 @@ FROM m_database m;"""
                 'invalid (None) in the query result',
                 'name', 'column4')
         ])
-        assert mock_gauge_instance.call_count == 0
-        logger_debug.assert_called_once_with('%s \n', [])
+        assert mock_gauge_instance.add_metric.call_count == 0
+        logger_debug.assert_called_with('%s \n', [])
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.GaugeTemplate')
+    @mock.patch('logging.Logger.debug')
+    def test_manage_gauge_direct(self, logger_debug, mock_template):
+        self._collector._direct_exposition = True
+        mock_template.return_value.line.side_effect = lambda labels, value: (labels, value)
+
+        mock_metric = mock.Mock()
+        mock_metric.name = 'name'
+        mock_metric.description = 'description'
+        mock_metric.labels = ['column1']
+        mock_metric.unit = 'mb'
+
+        metric_plan = prometheus_metrics.MetricPlan(mock_metric, (0,), 1)
+        metric_obj = self._collector._manage_gauge(metric_plan, [('data1', 1), ('data2', 2)])
+        self._collector._manage_gauge(metric_plan, [('data3', 3)])
+
+        # The template is created once, with the metadata labels
+        mock_template.assert_called_once_with(
+            'name', 'description', ['sid', 'insnr', 'database_name', 'column1'], 'mb',
+            ('prd', '00', 'db_name'))
+        assert isinstance(metric_obj, prometheus_exporter.RenderedGauge)
+        assert metric_obj.template == mock_template.return_value
+        assert metric_obj.lines == [(('data1',), 1), (('data2',), 2)]
+        logger_debug.assert_not_called()
+
+        self._collector._gauge_templates = {}
+        self._collector._manage_gauge(metric_plan, [('data3', 3)])
+        assert mock_template.call_count == 2
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_set_metrics_config(self, mock_exporter_metrics):
+        query1 = mock.Mock(query='query1', id='id1')
+        query2 = mock.Mock(query='query2', id='id2')
+        query3 = mock.Mock(query='query3', id='id3')
+        self._collector._active_queries = [query1, query2, query3]
+        self._collector._query_cache = {
+            'query1': (0, ['gauge1']), 'query2': (0, ['gauge2']), 'query3': (0, ['gauge3'])}
+        self._collector._result_fingerprints = {'query1': 'fingerprint1'}
+        self._collector._breakers = {'query1': (3, 10), 'query2': (3, 10), 'query3': (3, 10)}
+        self._collector._query_metrics = {'id2': 'metrics2', 'id3': 'metrics3'}
+        # query1 is changed keeping its id and query3 is removed
+        metrics_config = mock.Mock(queries=[mock.Mock(id='id1'), query2])
+
+        self._collector.set_metrics_config(metrics_config, [query1, query3])
+
+        assert self._collector._metrics_config is metrics_config
+        assert self._collector._active_queries is None
+        # Only the state of the outdated queries is discarded
+        assert self._collector._query_cache == {'query2': (0, ['gauge2'])}
+        assert self._collector._result_fingerprints == {}
+        assert self._collector._breakers == {'query2': (3, 10)}
+        mock_exporter_metrics.query_metrics.assert_called_once_with('id1', 'db_name')
+        circuit_open = mock_exporter_metrics.query_metrics.return_value.circuit_open
+        circuit_open.set.assert_called_once_with(0)
+        # The self monitoring series of the removed query are not exported anymore
+        assert self._collector._query_metrics == {
+            'id1': mock_exporter_metrics.query_metrics.return_value, 'id2': 'metrics2'}
+        mock_exporter_metrics.remove_query_metrics.assert_called_once_with('id3', 'db_name')
 
     def test_reconnect_connected(self):
         self._mock_connector.isconnected.return_value = True
-        self._collector.reconnect()
+        assert self._collector.reconnect() == True
         self._mock_connector.isconnected.assert_called_once_with()
         self._mock_connector.reconnect.assert_not_called()
+        assert self._collector._reconnect_thread is None
 
-    def test_reconnect_not_connected(self):
+    @mock.patch('threading.Thread')
+    def test_reconnect_not_connected(self, mock_thread):
         self._mock_connector.isconnected.return_value = False
+        mock_thread.return_value.is_alive.return_value = True
+        assert self._collector.reconnect() == False
+        mock_thread.assert_called_once_with(
+            target=self._collector._reconnect_loop, name='hanadb_reconnect', daemon=True)
+        mock_thread.return_value.start.assert_called_once_with()
+        self._mock_connector.reconnect.assert_not_called()
+
+        # The running reconnection is not started again
+        assert self._collector.reconnect() == False
+        assert mock_thread.call_count == 1
+
+        # Once reconnected, the connection is used
+        mock_thread.return_value.is_alive.return_value = False
+        self._mock_connector.isconnected.return_value = True
+        assert self._collector.reconnect() == True
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.random.uniform')
+    def test_reconnect_delay(self, mock_uniform):
+        mock_uniform.side_effect = lambda low, high: high
+        assert prometheus_exporter.SapHanaCollector.reconnect_delay(0) == 1
+        assert prometheus_exporter.SapHanaCollector.reconnect_delay(3) == 8
+        assert prometheus_exporter.SapHanaCollector.reconnect_delay(10) == 60
+        mock_uniform.assert_called_with(30, 60)
+
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_reconnect_loop(self, mock_exporter_metrics, mock_warning):
+        self._mock_connector.reconnect.side_effect = [
+            Exception('error1'), Exception('error2'), None]
         self._collector.retrieve_metadata = mock.Mock()
-        self._collector.reconnect()
-        self._mock_connector.isconnected.assert_called_once_with()
-        self._mock_connector.reconnect.assert_called_once_with()
+        self._collector.reconnect_delay = mock.Mock(side_effect=[1, 2])
+        self._collector._stop_event = mock.Mock()
+        self._collector._stop_event.wait.return_value = False
+
+        self._collector._reconnect_loop()
+
+        assert self._mock_connector.reconnect.call_count == 3
         self._collector.retrieve_metadata.assert_called_once_with()
+        self._collector.reconnect_delay.assert_has_calls([mock.call(0), mock.call(1)])
+        self._collector._stop_event.wait.assert_has_calls([mock.call(1), mock.call(2)])
+        mock_warning.assert_has_calls([
+            mock.call('Reconnection to the database %s failed, retrying in %.1f seconds: %s',
+                      'db_name', 1, 'error1'),
+            mock.call('Reconnection to the database %s failed, retrying in %.1f seconds: %s',
+                      'db_name', 2, 'error2')
+        ])
+        assert mock_exporter_metrics.RECONNECT_DURATION.labels.return_value.observe.call_count == 3
+
+    def test_reconnect_loop_stopped(self):
+        self._mock_connector.reconnect.side_effect = Exception('error')
+        self._collector.reconnect_delay = mock.Mock(return_value=1)
+        self._collector.stop()
+
+        self._collector._reconnect_loop()
+
+        self._mock_connector.reconnect.assert_called_once_with()
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_stop(self, mock_exporter_metrics):
+        self._collector._query_executor = mock.Mock()
+        self._collector._query_metrics = {'query_id1': mock.Mock(), 'query_id2': mock.Mock()}
+        self._collector._metrics_config.queries = [mock.Mock(id='query_id2')]
+        self._collector.stop()
+        assert self._collector._stop_event.is_set()
+        self._collector._query_executor.shutdown.assert_called_once_with(wait=False)
+        mock_exporter_metrics.remove_database_metrics.assert_called_once_with(
+            'db_name', {'query_id1', 'query_id2'})
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_not_connected(self, mock_exporter_metrics):
+        self._collector.reconnect = mock.Mock(return_value=False)
+        self._collector._metrics_config.queries = [mock.Mock(enabled=True)]
+
+        assert list(self._collector.collect()) == []
+
+        self._mock_connector.query.assert_not_called()
+        mock_exporter_metrics.DATABASE_UP.labels.assert_called_once_with('db_name')
+        mock_exporter_metrics.DATABASE_UP.labels.return_value.set.assert_called_once_with(0)
+        mock_exporter_metrics.LAST_SUCCESS.labels.assert_not_called()
+
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_connection_lost(self, mock_exporter_metrics, mock_base_connector,
+                                     mock_warning):
+        mock_base_connector.QueryError = Exception
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._failure_threshold = 1
+        queries = [
+            mock.Mock(enabled=True, query='query{}'.format(index), interval=0, timeout=None)
+            for index in range(3)]
+        self._collector._metrics_config.queries = queries
+        connected = [True]
+        self._mock_connector.isconnected.side_effect = lambda: connected[0]
+
+        def query_error(sql_statement):
+            # The first query finds the connection lost
+            connected[0] = False
+            raise Exception('connection lost')
+        self._mock_connector.query.side_effect = query_error
+
+        assert list(self._collector.collect()) == []
+
+        # The remaining queries are skipped, and the connection is recovered in background
+        self._mock_connector.query.assert_called_once_with('query0')
+        self._mock_connector.reconnect.assert_not_called()
+        assert self._collector.reconnect.call_count == 2
+        mock_exporter_metrics.DATABASE_UP.labels.return_value.set.assert_has_calls([
+            mock.call(1), mock.call(0)])
+        mock_exporter_metrics.LAST_SUCCESS.labels.assert_not_called()
+        mock_warning.assert_called_with(
+            'Connection to the database %s lost during the collection, its remaining queries '
+            'were skipped', 'db_name')
+        # The outage does not suspend the query
+        assert self._collector._breakers == {}
+        mock_exporter_metrics.query_metrics.return_value.circuit_open.set.assert_not_called()
+
+    @mock.patch('logging.Logger.error')
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_connection_error(self, mock_exporter_metrics, mock_base_connector,
+                                      mock_error):
+        mock_base_connector.QueryError = ValueError
+        mock_base_connector.ConnectionError = Exception
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._failure_threshold = 1
+        query1 = mock.Mock(enabled=True, query='query1', interval=0, timeout=None)
+        self._collector._metrics_config.queries = [query1]
+        self._mock_connector.query.side_effect = Exception('error')
+
+        assert list(self._collector.collect()) == []
+
+        mock_error.assert_has_calls([
+            mock.call('Connection lost running query: %s, skipping...', 'query1'),
+            mock.call('error')
+        ])
+        assert self._collector._breakers == {}
+        mock_exporter_metrics.query_metrics.return_value.errors.inc.assert_not_called()
 
-    @mock.patch('hanadb_exporter.utils.format_query_result')
-    @mock.patch('hanadb_exporter.utils.check_hana_range')
     @mock.patch('logging.Logger.error')
-    def test_collect_value_error(self, mock_logger, mock_hana_range, mock_format_query):
+    def test_collect_value_error(self, mock_logger):
         """
         Test that when _manage_gauge is called and return ValueError (labels or value)
         are incorrect, that the ValueError is catched by collect() and a error is raised
@@ -281,11 +978,13 @@ FROM m_database m;"""
         self._collector._manage_gauge = mock.Mock()
 
         self._collector._manage_gauge.side_effect = ValueError('test')
-        mock_hana_range.return_value = True
+        self._mock_connector.query.return_value = mock.Mock(
+            metadata=[('COLUMN', None)], records=[('data',)])
 
         metrics1_1 = mock.Mock(type='gauge')
         metrics1 = [metrics1_1]
-        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'])
+        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'], timeout=None)
+        resolve_metrics(query1)
 
         self._collector._metrics_config.queries = [query1]
 
@@ -295,21 +994,18 @@ FROM m_database m;"""
         self._collector.reconnect.assert_called_once_with()
         mock_logger.assert_called_once_with('test')
 
-    @mock.patch('hanadb_exporter.utils.format_query_result')
-    @mock.patch('hanadb_exporter.utils.check_hana_range')
     @mock.patch('logging.Logger.warning')
     @mock.patch('logging.Logger.info')
-    def test_collect(self, mock_logger, mock_logger_warning, mock_hana_range, mock_format_query):
+    def test_collect(self, mock_logger, mock_logger_warning):
 
+        result1 = mock.Mock(metadata=[('COLUMN', None)], records=[('data1',)])
+        result2 = mock.Mock(metadata=[('COLUMN', None)], records=[('data2',)])
+        result3 = mock.Mock(metadata=[('COLUMN', None)], records=[])
         self._collector.reconnect = mock.Mock()
         self._collector._manage_gauge = mock.Mock()
 
         self._mock_connector.query.side_effect = [
-            'result1', 'result2', '']
-        mock_format_query.side_effect = [
-            'form_result1', 'form_result2', '']
-
-        mock_hana_range.side_effect = [True, True, False, True]
+            result1, result2, result3]
 
         self._collector._manage_gauge.side_effect = [
             'gauge1', 'gauge2', 'gauge3', 'gauge4', 'gauge5']
@@ -317,21 +1013,27 @@ FROM m_database m;"""
         metrics1_1 = mock.Mock(type='gauge')
         metrics1_2 = mock.Mock(type='gauge')
         metrics1 = [metrics1_1, metrics1_2]
-        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'])
+        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'], timeout=None)
+        resolve_metrics(query1)
         metrics2_1 = mock.Mock(type='gauge')
         metrics2_2 = mock.Mock(type='gauge')
         metrics2 = [metrics2_1, metrics2_2]
-        query2 = mock.Mock(enabled=False, query='query2', metrics=metrics2, hana_version_range=['2.0'])
+        query2 = mock.Mock(enabled=False, query='query2', metrics=metrics2, hana_version_range=['2.0'], timeout=None)
+        resolve_metrics(query2)
         metrics3_1 = mock.Mock(type='gauge')
         metrics3_2 = mock.Mock(type='gauge')
         metrics3_3 = mock.Mock(type='gauge')
         metrics3 = [metrics3_1, metrics3_2, metrics3_3]
-        query3 = mock.Mock(enabled=True, query='query3', metrics=metrics3, hana_version_range=['3.0'])
+        query3 = mock.Mock(enabled=True, query='query3', metrics=metrics3, hana_version_range=['3.0'], timeout=None)
+        resolve_metrics(query3)
         metrics4_1 = mock.Mock(type='gauge')
         metrics4_2 = mock.Mock(type='gauge')
         metrics4 = [metrics2_1, metrics2_2]
-        query4 = mock.Mock(enabled=True, query='query4', metrics=metrics4, hana_version_range=['1.0.0', '2.0.0'])
-        query5 = mock.Mock(enabled=True, query='query5', metrics=[], hana_version_range=['4.0'])
+        query4 = mock.Mock(enabled=True, query='query4', metrics=metrics4, hana_version_range=['1.0.0', '2.0.0'], timeout=None)
+        query4.is_available.return_value = False
+        resolve_metrics(query4)
+        query5 = mock.Mock(enabled=True, query='query5', metrics=[], hana_version_range=['4.0'], timeout=None)
+        resolve_metrics(query5)
 
         self._collector._metrics_config.queries = [
             query1, query2, query3, query4, query5
@@ -346,25 +1048,21 @@ FROM m_database m;"""
             mock.call('query3'),
             mock.call('query5')])
 
-        mock_format_query.assert_has_calls([
-            mock.call('result1'),
-            mock.call('result2'),
-            mock.call('')
-        ])
+        query1.is_available.assert_called_once_with((2, 0))
+        query2.is_available.assert_not_called()
+        query3.is_available.assert_called_once_with((2, 0))
+        query4.is_available.assert_called_once_with((2, 0))
+        query5.is_available.assert_called_once_with((2, 0))
 
-        mock_hana_range.assert_has_calls([
-            mock.call('2.0', ['1.0']),
-            mock.call('2.0', ['3.0']),
-            mock.call('2.0', ['1.0.0', '2.0.0']),
-            mock.call('2.0', ['4.0'])
-        ])
+        query1.resolve_columns.assert_called_once_with(['COLUMN'])
+        query3.resolve_columns.assert_called_once_with(['COLUMN'])
 
         self._collector._manage_gauge.assert_has_calls([
-            mock.call(metrics1_1, 'form_result1'),
-            mock.call(metrics1_2, 'form_result1'),
-            mock.call(metrics3_1, 'form_result2'),
-            mock.call(metrics3_2, 'form_result2'),
-            mock.call(metrics3_3, 'form_result2'),
+            mock.call(metric_plan(metrics1_1), [('data1',)]),
+            mock.call(metric_plan(metrics1_2), [('data1',)]),
+            mock.call(metric_plan(metrics3_1), [('data2',)]),
+            mock.call(metric_plan(metrics3_2), [('data2',)]),
+            mock.call(metric_plan(metrics3_3), [('data2',)]),
         ])
 
         mock_logger.assert_has_calls([
@@ -376,19 +1074,577 @@ FROM m_database m;"""
         mock_logger_warning.assert_called_once_with(
             'Query %s ... has not returned any record', 'query5')
 
-    @mock.patch('hanadb_exporter.utils.format_query_result')
-    @mock.patch('hanadb_exporter.utils.check_hana_range')
-    def test_collect_incorrect_type(self, mock_hana_range, mock_format_query):
+    @mock.patch('time.time')
+    def test_collect_interval(self, mock_time):
 
+        results = [
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data',)]) for _ in range(5)]
         self._collector.reconnect = mock.Mock()
         self._collector._manage_gauge = mock.Mock()
 
+        self._mock_connector.query.side_effect = results
+
+        self._collector._manage_gauge.side_effect = [
+            'gauge1', 'gauge2', 'gauge3', 'gauge4', 'gauge5']
+
+        metrics1_1 = mock.Mock(type='gauge')
+        query1 = mock.Mock(
+            enabled=True, query='query1', metrics=[metrics1_1], hana_version_range=['1.0'],
+            interval=0, timeout=None)
+        resolve_metrics(query1)
+        metrics2_1 = mock.Mock(type='gauge')
+        query2 = mock.Mock(
+            enabled=True, query='query2', metrics=[metrics2_1], hana_version_range=['1.0'],
+            interval=300, timeout=None)
+        resolve_metrics(query2)
+
+        self._collector._metrics_config.queries = [query1, query2]
+
+        # First scrape runs both queries, the second one only the query without interval and the
+        # third one runs both again as the interval has expired
+        mock_time.side_effect = [0, 0, 100, 100, 301, 301, 301]
+        assert list(self._collector.collect()) == ['gauge1', 'gauge2']
+        assert list(self._collector.collect()) == ['gauge3', 'gauge2']
+        assert list(self._collector.collect()) == ['gauge4', 'gauge5']
+
+        self._mock_connector.query.assert_has_calls([
+            mock.call('query1'),
+            mock.call('query2'),
+            mock.call('query1'),
+            mock.call('query1'),
+            mock.call('query2')])
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_reuse_results(self, mock_exporter_metrics):
+        self._collector._reuse_results = True
+        self._collector.reconnect = mock.Mock()
+        self._collector._manage_gauge = mock.Mock(side_effect=['gauge1', 'gauge2', 'gauge3'])
+        self._mock_connector.query.side_effect = [
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1',)]),
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1',)]),
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data2',)]),
+            mock.Mock(metadata=[('OTHER', None)], records=[('data2',)]),
+            mock.Mock(metadata=[('OTHER', None)], records=[('data2',)])]
+
+        query1 = mock.Mock(
+            enabled=True, query='query1', metrics=[mock.Mock(type='gauge')],
+            hana_version_range=['1.0'], interval=0, timeout=None)
+        resolve_metrics(query1)
+        self._collector._metrics_config.queries = [query1]
+
+        # The metrics are built again when the records or the columns change
+        assert list(self._collector.collect()) == ['gauge1']
+        assert list(self._collector.collect()) == ['gauge1']
+        assert list(self._collector.collect()) == ['gauge2']
+        assert list(self._collector.collect()) == ['gauge3']
+        assert list(self._collector.collect()) == ['gauge3']
+        assert self._collector._manage_gauge.call_count == 3
+
+        query_metrics = mock_exporter_metrics.query_metrics.return_value
+        assert query_metrics.changed.inc.call_count == 3
+        assert query_metrics.unchanged.inc.call_count == 2
+
+        # The metrics are built again once the metadata is retrieved
+        self._collector._result_fingerprints = {}
+        self._collector._manage_gauge.side_effect = ['gauge4']
+        self._mock_connector.query.side_effect = [
+            mock.Mock(metadata=[('OTHER', None)], records=[('data2',)])]
+        assert list(self._collector.collect()) == ['gauge4']
+
+    @mock.patch('time.time')
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_exporter_metrics(self, mock_exporter_metrics, mock_base_connector, mock_time):
+        mock_base_connector.QueryError = Exception
+        mock_time.return_value = 0
+        self._collector.reconnect = mock.Mock()
+        self._collector._manage_gauge = mock.Mock(return_value='gauge')
+        self._mock_connector.query.side_effect = [
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1',), ('data2',)]),
+            Exception('error'),
+            mock.Mock(metadata=[('COLUMN', None)], records=[])]
+        query_metrics = {
+            query_id: mock.Mock() for query_id in ['query_id1', 'query_id2', 'query_id3']}
+        mock_exporter_metrics.query_metrics.side_effect = \
+            lambda query_id, database_name: query_metrics[query_id]
+
+        query1 = mock.Mock(
+            enabled=True, query='query1', id='query_id1', metrics=[mock.Mock(type='gauge')],
+            interval=300, timeout=None)
+        resolve_metrics(query1)
+        query2 = mock.Mock(enabled=True, query='query2', id='query_id2', interval=0, timeout=None)
+        query3 = mock.Mock(enabled=True, query='query3', id='query_id3', interval=0, timeout=None)
+        self._collector._metrics_config.queries = [query1, query2, query3]
+
+        assert list(self._collector.collect()) == ['gauge']
+        # The first query is served from the cache in the second collection
+        self._mock_connector.query.side_effect = [Exception('error'), Exception('error')]
+        assert list(self._collector.collect()) == ['gauge']
+
+        mock_exporter_metrics.query_metrics.assert_has_calls([
+            mock.call('query_id1', 'db_name'),
+            mock.call('query_id2', 'db_name'),
+            mock.call('query_id3', 'db_name')
+        ])
+        assert mock_exporter_metrics.query_metrics.call_count == 3
+        mock_exporter_metrics.DATABASE_UP.labels.assert_called_with('db_name')
+        mock_exporter_metrics.DATABASE_UP.labels.return_value.set.assert_has_calls([
+            mock.call(1), mock.call(1)])
+        mock_exporter_metrics.LAST_SUCCESS.labels.assert_called_with('db_name')
+        assert mock_exporter_metrics.LAST_SUCCESS.labels.return_value.set_to_current_time.\
+            call_count == 2
+
+        metrics1 = query_metrics['query_id1']
+        assert metrics1.fetch_duration.observe.call_count == 1
+        metrics1.rows.set.assert_called_once_with(2)
+        assert metrics1.format_duration.observe.call_count == 1
+        assert metrics1.build_duration.observe.call_count == 1
+        metrics1.cached.inc.assert_called_once_with()
+        metrics1.errors.inc.assert_not_called()
+
+        metrics2 = query_metrics['query_id2']
+        assert metrics2.fetch_duration.observe.call_count == 2
+        assert metrics2.errors.inc.call_count == 2
+        metrics2.rows.set.assert_not_called()
+
+        metrics3 = query_metrics['query_id3']
+        metrics3.rows.set.assert_called_once_with(0)
+        metrics3.empty.inc.assert_called_once_with()
+        metrics3.format_duration.observe.assert_not_called()
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_all_failed(self, mock_exporter_metrics, mock_base_connector):
+        mock_base_connector.QueryError = Exception
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._mock_connector.query.side_effect = Exception('error')
+        self._collector._metrics_config.queries = [
+            mock.Mock(enabled=True, query='query{}'.format(index), interval=0, timeout=None)
+            for index in range(2)]
+
+        assert list(self._collector.collect()) == []
+
+        # The database is connected, but the collection did not succeed
+        assert self._mock_connector.query.call_count == 2
+        mock_exporter_metrics.DATABASE_UP.labels.return_value.set.assert_called_once_with(1)
+        mock_exporter_metrics.LAST_SUCCESS.labels.assert_not_called()
+
+        # A single successful query makes the collection successful
+        self._mock_connector.query.side_effect = [
+            Exception('error'), mock.Mock(metadata=[('COLUMN', None)], records=[])]
+        assert list(self._collector.collect()) == []
+        mock_exporter_metrics.LAST_SUCCESS.labels.assert_called_once_with('db_name')
+        mock_exporter_metrics.LAST_SUCCESS.labels.return_value.set_to_current_time.\
+            assert_called_once_with()
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_concurrently_all_failed(self, mock_exporter_metrics):
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._collect_executor = \
+            prometheus_exporter.futures.ThreadPoolExecutor(max_workers=2)
+        def collect_query(query, deadline):
+            yield 'metric{}'.format(query)
+            return query == 2
+        self._collector._collect_query = mock.Mock(side_effect=collect_query)
+        self._collector._active_queries = [1, 3]
+
+        try:
+            assert list(self._collector.collect()) == ['metric1', 'metric3']
+            mock_exporter_metrics.LAST_SUCCESS.labels.assert_not_called()
+
+            self._collector._active_queries = [1, 2, 3]
+            assert list(self._collector.collect()) == ['metric1', 'metric2', 'metric3']
+            mock_exporter_metrics.LAST_SUCCESS.labels.assert_called_once_with('db_name')
+        finally:
+            self._collector.stop()
+
+    def test_query(self):
+        self._mock_connector.query.return_value = 'result'
+        query = mock.Mock(query='query1', timeout=None)
+        assert self._collector._query(query) == 'result'
+        # The queries without timeout run in the collection thread
+        assert self._collector._query_executor._threads == set()
+
+        query = mock.Mock(query='query1', timeout=1)
+        assert self._collector._query(query) == 'result'
+        self._mock_connector.query.assert_has_calls([mock.call('query1'), mock.call('query1')])
+
+    @mock.patch('hanadb_exporter.utils.cancel_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_query_timeout(self, mock_exporter_metrics, mock_cancel):
+        release = threading.Event()
+        self._mock_connector.query.side_effect = lambda _: release.wait()
+        mock_cancel.side_effect = lambda connector, sql_statement: release.set() or True
+
+        query = mock.Mock(query='query1', id='query_id', timeout=0.1)
+        with pytest.raises(prometheus_exporter.QueryTimeoutError) as err:
+            self._collector._query(query)
+
+        assert 'query cancelled after 0.1 seconds' in str(err.value)
+        mock_cancel.assert_called_once_with(self._mock_connector, 'query1')
+        mock_exporter_metrics.QUERY_TIMEOUTS.labels.assert_called_once_with('query_id', 'db_name')
+        mock_exporter_metrics.QUERY_TIMEOUTS.labels.return_value.inc.assert_called_once_with()
+
+    @mock.patch('hanadb_exporter.utils.cancel_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_query_timeout_deadline(self, mock_exporter_metrics, mock_cancel):
+        release = threading.Event()
+        self._mock_connector.query.side_effect = lambda _: release.wait()
+        mock_cancel.side_effect = lambda connector, sql_statement: release.set() or True
+
+        # The query timeout is reduced to the time remaining until the scrape deadline
+        query = mock.Mock(query='query1', id='query_id', timeout=10)
+        start = time.time()
+        with pytest.raises(prometheus_exporter.QueryTimeoutError):
+            self._collector._query(query, time.monotonic() + 0.1)
+        assert time.time() - start < 1
+        mock_cancel.assert_called_once_with(self._mock_connector, 'query1')
+
+    @mock.patch('hanadb_exporter.utils.cancel_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_query_deadline_without_timeout(self, mock_exporter_metrics, mock_cancel):
+        release = threading.Event()
+        self._mock_connector.query.side_effect = lambda _: release.wait()
+        mock_cancel.return_value = False
+
+        # The queries without timeout are not waited for beyond the scrape deadline, even if
+        # they cannot be cancelled
+        query = mock.Mock(query='query1', id='query_id', timeout=None)
+        start = time.time()
+        try:
+            with pytest.raises(prometheus_exporter.ScrapeDeadlineError) as err:
+                self._collector._query(query, time.monotonic() + 0.1)
+        finally:
+            release.set()
+        assert time.time() - start < 1
+        assert 'query still running at the scrape deadline' in str(err.value)
+        assert 'does not support the cancellation' in str(err.value)
+        mock_cancel.assert_called_once_with(self._mock_connector, 'query1')
+        mock_exporter_metrics.QUERY_TIMEOUTS.labels.assert_not_called()
+
+    @mock.patch('hanadb_exporter.utils.cancel_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_query_timeout_not_cancelled(self, mock_exporter_metrics, mock_cancel):
+        release = threading.Event()
+        self._mock_connector.query.side_effect = lambda _: release.wait()
+        mock_cancel.return_value = False
+
+        self._collector._query_timeout = 0.1
+        query = mock.Mock(query='query1', id='query_id', timeout=None)
+        try:
+            with pytest.raises(prometheus_exporter.QueryTimeoutError) as err:
+                self._collector._query(query)
+            assert 'query exceeded 0.1 seconds. The used connector does not support the '\
+                'cancellation' in str(err.value)
+
+            # The connection is still busy, so the next queries are skipped (even without
+            # timeout, as they would wait for the connection)
+            with pytest.raises(prometheus_exporter.QueryTimeoutError) as err:
+                self._collector._query(query)
+            assert 'all the connections are still running previously cancelled queries' in \
+                str(err.value)
+            self._collector._query_timeout = None
+            with pytest.raises(prometheus_exporter.QueryTimeoutError):
+                self._collector._query(query)
+        finally:
+            release.set()
+
+        assert self._mock_connector.query.call_count == 1
+
+    @mock.patch('hanadb_exporter.utils.cancel_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector.retrieve_metadata')
+    def test_query_timeout_workers(self, mock_retrieve_metadata, mock_exporter_metrics,
+                                   mock_cancel):
+        release = threading.Event()
+        pool = mock.Mock(spec=utils.PooledConnector, size=3)
+        pool.query = mock.Mock(
+            side_effect=lambda sql_statement:
+            release.wait() if sql_statement == 'query1' else 'result')
+        mock_cancel.return_value = False
+        collector = prometheus_exporter.SapHanaCollector(
+            pool, self._mock_metrics_config, query_workers=2)
+        collector._database_name = 'db_name'
+        # The running queries plus the cancelled ones that keep a connection busy
+        assert collector._query_executor._max_workers == 4
+
+        query1 = mock.Mock(query='query1', id='query_id1', timeout=0.1)
+        query2 = mock.Mock(query='query2', id='query_id2', timeout=0.1)
+        try:
+            for _ in range(2):
+                with pytest.raises(prometheus_exporter.QueryTimeoutError) as err:
+                    collector._query(query1)
+                assert 'query exceeded' in str(err.value)
+            # The other connection of the pool is still available
+            assert collector._query(query2) == 'result'
+            with pytest.raises(prometheus_exporter.QueryTimeoutError):
+                collector._query(query1)
+            with pytest.raises(prometheus_exporter.QueryTimeoutError) as err:
+                collector._query(query2)
+            assert 'all the connections are still running' in str(err.value)
+        finally:
+            release.set()
+            collector.stop()
+
+    def test_collect_concurrently(self):
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._query_workers = 3
+        self._collector._collect_executor = \
+            prometheus_exporter.futures.ThreadPoolExecutor(max_workers=3)
+        # All the queries must be running at the same time to pass the barrier
+        barrier = threading.Barrier(3, timeout=5)
+        def collect_query(query, deadline):
+            barrier.wait()
+            # The first queries finish the last ones
+            time.sleep(0.01 * (3 - query))
+            yield 'metric{}_1'.format(query)
+            yield 'metric{}_2'.format(query)
+        self._collector._collect_query = mock.Mock(side_effect=collect_query)
+        self._collector._active_queries = [1, 2, 3]
+
+        try:
+            assert list(self._collector.collect()) == [
+                'metric1_1', 'metric1_2', 'metric2_1', 'metric2_2', 'metric3_1', 'metric3_2']
+        finally:
+            self._collector.stop()
+
+    @mock.patch('time.monotonic')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_deadline(self, mock_exporter_metrics, mock_monotonic):
+
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._manage_gauge = mock.Mock(side_effect=['gauge1', 'gauge2', 'gauge3'])
+        self._mock_connector.query.return_value = mock.Mock(
+            metadata=[('COLUMN', None)], records=[('data',)])
+        query1 = mock.Mock(
+            enabled=True, query='query1', id='query1', metrics=[mock.Mock(type='gauge')],
+            interval=0, timeout=None)
+        resolve_metrics(query1)
+        query2 = mock.Mock(
+            enabled=True, query='query2', id='query2', metrics=[mock.Mock(type='gauge')],
+            interval=0, timeout=None)
+        resolve_metrics(query2)
+        self._collector._metrics_config.queries = [query1, query2]
+        metrics1 = mock.Mock()
+        metrics2 = mock.Mock()
+        mock_exporter_metrics.query_metrics.side_effect = [metrics1, metrics2]
+
+        mock_monotonic.return_value = 0
+        assert list(self._collector.collect(10)) == ['gauge1', 'gauge2']
+        metrics2.stale.set.assert_called_once_with(0)
+
+        # The deadline is reached after running the first query, the second one is served
+        # from its previous execution
+        mock_monotonic.side_effect = [5, 5, 10]
+        assert list(self._collector.collect(10)) == ['gauge3', 'gauge2']
+        assert self._mock_connector.query.call_count == 3
+        metrics1.stale.set.assert_has_calls([mock.call(0), mock.call(0)])
+        metrics2.stale.set.assert_has_calls([mock.call(0), mock.call(1)])
+        metrics2.deadline.inc.assert_called_once_with()
+        metrics1.deadline.inc.assert_not_called()
+
+        # Queries without previous execution are skipped
+        self._collector._query_cache = {}
+        mock_monotonic.side_effect = [10, 10]
+        assert list(self._collector.collect(10)) == []
+        assert self._mock_connector.query.call_count == 3
+
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_deadline_running_query(self, mock_exporter_metrics, mock_warning):
+        self._collector.reconnect = mock.Mock(return_value=True)
+        query1 = mock.Mock(
+            enabled=True, query='query1', id='query1', metrics=[mock.Mock(type='gauge')],
+            interval=0, timeout=None)
+        self._collector._metrics_config.queries = [query1]
+        self._collector._query_cache = {'query1': (0, ['gauge1'])}
+        self._collector._query = mock.Mock(
+            side_effect=prometheus_exporter.ScrapeDeadlineError('error'))
+        metrics1 = mock_exporter_metrics.query_metrics.return_value
+
+        # The query still running at the deadline is served from its previous execution
+        deadline = time.monotonic() + 60
+        assert list(self._collector.collect(deadline)) == ['gauge1']
+        metrics1.stale.set.assert_has_calls([mock.call(0), mock.call(1)])
+        metrics1.deadline.inc.assert_called_once_with()
+        metrics1.rows.set.assert_not_called()
+        mock_warning.assert_called_once_with(
+            'Scrape deadline reached running query %s ..., serving its previous metrics: %s',
+            'query1', 'error')
+
+        self._collector._query_cache = {}
+        assert list(self._collector.collect(deadline)) == []
+
+    @mock.patch('time.monotonic')
+    @mock.patch('logging.Logger.warning')
+    @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_circuit_breaker(
+            self, mock_exporter_metrics, mock_base_connector, mock_warning, mock_monotonic):
+        mock_base_connector.QueryError = Exception
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._failure_threshold = 2
+        self._collector._manage_gauge = mock.Mock(return_value='gauge1')
+        query1 = mock.Mock(
+            enabled=True, query='query1', id='query1', metrics=[mock.Mock(type='gauge')],
+            interval=0, timeout=None)
+        resolve_metrics(query1)
+        self._collector._metrics_config.queries = [query1]
+        metrics1 = mock_exporter_metrics.query_metrics.return_value
+        result = mock.Mock(metadata=[('COLUMN', None)], records=[('data',)])
         self._mock_connector.query.side_effect = [
-            'result1', 'result2']
-        mock_format_query.side_effect = [
-            'form_result1', 'form_result2']
+            Exception('error'), Exception('error'), Exception('error'), result]
+        mock_monotonic.return_value = 0
+
+        # The breaker opens after failure_threshold consecutive failures
+        assert list(self._collector.collect()) == []
+        metrics1.circuit_open.set.assert_not_called()
+        assert list(self._collector.collect()) == []
+        mock_warning.assert_called_once_with(
+            'Query %s ... failed %d times in a row, suspended for %d seconds', 'query1', 2, 60)
+        metrics1.circuit_open.set.assert_called_once_with(1)
+        assert self._collector._breakers == {'query1': (2, 60)}
+
+        # The query is skipped while it is suspended
+        mock_monotonic.return_value = 59
+        assert list(self._collector.collect()) == []
+        assert self._mock_connector.query.call_count == 2
+        metrics1.suspended.inc.assert_called_once_with()
+
+        # A new failure doubles the suspension
+        mock_monotonic.return_value = 60
+        assert list(self._collector.collect()) == []
+        mock_warning.assert_called_with(
+            'Query %s ... failed %d times in a row, suspended for %d seconds', 'query1', 3, 120)
+        assert self._collector._breakers == {'query1': (3, 180)}
+
+        # The breaker is closed once the query succeeds
+        mock_monotonic.return_value = 180
+        assert list(self._collector.collect()) == ['gauge1']
+        assert self._collector._breakers == {}
+        metrics1.circuit_open.set.assert_called_with(0)
+
+    def test_query_failed_backoff(self):
+        self._collector._failure_threshold = 1
+        query1 = mock.Mock(query='query1')
+        with mock.patch('time.monotonic', return_value=0):
+            for _ in range(10):
+                self._collector._query_failed(query1, mock.Mock())
+        assert self._collector._breakers == {'query1': (10, prometheus_exporter.QUERY_BACKOFF_MAX)}
+
+        # Queries are never suspended without threshold
+        self._collector._failure_threshold = 0
+        self._collector._breakers = {}
+        self._collector._query_failed(query1, mock.Mock())
+        assert self._collector._breakers == {}
+
+    @mock.patch('hanadb_exporter.utils.stream_query')
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    @mock.patch('logging.Logger.error')
+    def test_collect_stream(self, mock_logger, mock_exporter_metrics, mock_stream_query):
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._batch_size = 2
+        close = mock.Mock()
+        mock_stream_query.return_value = prometheus_exporter.utils.QueryStream(
+            [('COLUMN', None)], [[('data1',), ('data2',)], [('data3',)]], close)
+        add_records1 = mock.Mock()
+        add_records2 = mock.Mock(side_effect=[None, ValueError('error')])
+        self._collector._gauge_builder = mock.Mock(
+            side_effect=[('gauge1', add_records1), ('gauge2', add_records2)])
+
+        metrics1 = mock.Mock(type='gauge')
+        metrics2 = mock.Mock(type='gauge')
+        query1 = mock.Mock(
+            enabled=True, query='query1', metrics=[metrics1, metrics2], interval=0,
+            timeout=None)
+        resolve_metrics(query1)
+        self._collector._metrics_config.queries = [query1]
 
-        mock_hana_range.side_effect = [True, True, True]
+        # The metric failing in a batch is skipped
+        assert list(self._collector.collect()) == ['gauge1']
+
+        mock_stream_query.assert_called_once_with(self._mock_connector, 'query1', 2)
+        query1.resolve_columns.assert_called_once_with(['COLUMN'])
+        add_records1.assert_has_calls([
+            mock.call([('data1',), ('data2',)]), mock.call([('data3',)])])
+        assert add_records2.call_count == 2
+        close.assert_called_once_with()
+        mock_logger.assert_called_once_with('error')
+        query_metrics = mock_exporter_metrics.query_metrics.return_value
+        query_metrics.rows.set.assert_called_once_with(3)
+        query_metrics.build_duration.observe.assert_called_once_with(mock.ANY)
+        assert self._collector._query_cache['query1'][1] == ['gauge1']
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.exporter_metrics')
+    def test_collect_stream_empty(self, mock_exporter_metrics):
+        self._collector.reconnect = mock.Mock(return_value=True)
+        self._collector._batch_size = 2
+        self._mock_connector.query.return_value = mock.Mock(
+            metadata=[('COLUMN', None)], records=[])
+        self._collector._gauge_builder = mock.Mock(return_value=('gauge1', mock.Mock()))
+        query1 = mock.Mock(
+            enabled=True, query='query1', metrics=[mock.Mock(type='gauge')], interval=0,
+            timeout=None)
+        resolve_metrics(query1)
+        self._collector._metrics_config.queries = [query1]
+
+        assert list(self._collector.collect()) == []
+        mock_exporter_metrics.query_metrics.return_value.empty.inc.assert_called_once_with()
+
+    @mock.patch('logging.Logger.warning')
+    def test_gauge_builder(self, mock_warning):
+        metric = mock.Mock(labels=['column1'], value='column2')
+        plan = prometheus_metrics.MetricPlan(metric, (0,), 1)
+        with mock.patch('hanadb_exporter.prometheus_exporter.core') as mock_core:
+            metric_obj, add_records = self._collector._gauge_builder(plan)
+            add_records([('label1', 1)])
+            add_records([('label2', 2), ('label3', None)])
+
+        assert metric_obj == mock_core.GaugeMetricFamily.return_value
+        metric_obj.add_metric.assert_has_calls([
+            mock.call(('prd', '00', 'db_name', 'label1'), 1),
+            mock.call(('prd', '00', 'db_name', 'label2'), 2)])
+        assert metric_obj.add_metric.call_count == 2
+        mock_warning.assert_called_once_with(
+            'Specified value in metrics.json for metric "%s": (%s) not found or it '
+            'is invalid (None) in the query result', metric.name, 'column2')
+
+    @mock.patch('logging.Logger.error')
+    def test_collect_query_timeout(self, mock_logger):
+
+        result2 = mock.Mock(metadata=[('COLUMN', None)], records=[('data',)])
+        self._collector.reconnect = mock.Mock()
+        self._collector._manage_gauge = mock.Mock(return_value='gauge2')
+        self._collector._query = mock.Mock(
+            side_effect=[prometheus_exporter.QueryTimeoutError('timeout'), result2])
+
+        query1 = mock.Mock(enabled=True, query='query1', metrics=[mock.Mock(type='gauge')])
+        resolve_metrics(query1)
+        query2 = mock.Mock(
+            enabled=True, query='query2', metrics=[mock.Mock(type='gauge')], interval=0)
+        resolve_metrics(query2)
+        self._collector._metrics_config.queries = [query1, query2]
+
+        assert list(self._collector.collect()) == ['gauge2']
+
+        self._collector._query.assert_has_calls(
+            [mock.call(query1, None), mock.call(query2, None)])
+        self._collector._manage_gauge.assert_called_once_with(
+            metric_plan(query2.metrics[0]), [('data',)])
+        mock_logger.assert_has_calls([
+            mock.call('Timeout in query: %s, skipping...', 'query1'),
+            mock.call('timeout')
+        ])
+
+    def test_collect_incorrect_type(self):
+
+        result1 = mock.Mock(metadata=[('COLUMN', None)], records=[('data1',)])
+        result2 = mock.Mock(metadata=[('COLUMN', None)], records=[('data2',)])
+        self._collector.reconnect = mock.Mock()
+        self._collector._manage_gauge = mock.Mock()
+
+        self._mock_connector.query.side_effect = [
+            result1, result2]
 
         self._collector._manage_gauge.side_effect = [
             'gauge1', 'gauge2', 'gauge3', 'gauge4', 'gauge5']
@@ -396,16 +1652,19 @@ FROM m_database m;"""
         metrics1_1 = mock.Mock(type='gauge')
         metrics1_2 = mock.Mock(type='gauge')
         metrics1 = [metrics1_1, metrics1_2]
-        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'])
+        query1 = mock.Mock(enabled=True, query='query1', metrics=metrics1, hana_version_range=['1.0'], timeout=None)
+        resolve_metrics(query1)
         metrics2_1 = mock.Mock(type='gauge')
         metrics2_2 = mock.Mock(type='gauge')
         metrics2 = [metrics2_1, metrics2_2]
-        query2 = mock.Mock(enabled=False, query='query2', metrics=metrics2, hana_version_range=['2.0'])
+        query2 = mock.Mock(enabled=False, query='query2', metrics=metrics2, hana_version_range=['2.0'], timeout=None)
+        resolve_metrics(query2)
         metrics3_1 = mock.Mock(type='gauge')
         metrics3_2 = mock.Mock(type='other')
         metrics3_3 = mock.Mock(type='gauge')
         metrics3 = [metrics3_1, metrics3_2, metrics3_3]
-        query3 = mock.Mock(enabled=True, query='query3', metrics=metrics3, hana_version_range=['3.0'])
+        query3 = mock.Mock(enabled=True, query='query3', metrics=metrics3, hana_version_range=['3.0'], timeout=None)
+        resolve_metrics(query3)
 
         self._collector._metrics_config.queries = [
             query1, query2, query3
@@ -422,34 +1681,25 @@ FROM m_database m;"""
             mock.call('query1'),
             mock.call('query3')])
 
-        mock_format_query.assert_has_calls([
-            mock.call('result1'),
-            mock.call('result2')
-        ])
-
-        mock_hana_range.assert_has_calls([
-            mock.call('2.0', ['1.0']),
-            mock.call('2.0', ['3.0'])
-        ])
+        query1.is_available.assert_called_once_with((2, 0))
+        query3.is_available.assert_called_once_with((2, 0))
 
         self._collector._manage_gauge.assert_has_calls([
-            mock.call(metrics1_1, 'form_result1'),
-            mock.call(metrics1_2, 'form_result1'),
-            mock.call(metrics3_1, 'form_result2')
+            mock.call(metric_plan(metrics1_1), [('data1',)]),
+            mock.call(metric_plan(metrics1_2), [('data1',)]),
+            mock.call(metric_plan(metrics3_1), [('data2',)])
         ])
 
-    @mock.patch('hanadb_exporter.utils.check_hana_range')
     @mock.patch('hanadb_exporter.prometheus_exporter.hdb_connector.connectors.base_connector')
     @mock.patch('logging.Logger.error')
-    def test_collect_incorrect_query(self, mock_logger, mock_base_connector, mock_hana_range):
+    def test_collect_incorrect_query(self, mock_logger, mock_base_connector):
 
         self._collector.reconnect = mock.Mock()
         mock_base_connector.QueryError = Exception
 
         self._mock_connector.query.side_effect = Exception('error')
-        mock_hana_range.return_value = True
 
-        query1 = mock.Mock(enabled=True, query='query1', hana_version_range=['1.0'])
+        query1 = mock.Mock(enabled=True, query='query1', hana_version_range=['1.0'], timeout=None)
 
         self._collector._metrics_config.queries = [query1]
 
@@ -459,10 +1709,207 @@ FROM m_database m;"""
         self._collector.reconnect.assert_called_once_with()
         self._mock_connector.query.assert_called_once_with('query1')
 
-        mock_hana_range.assert_has_calls([
-            mock.call('2.0', ['1.0']),
-        ])
+        query1.is_available.assert_called_once_with((2, 0))
 
         mock_logger.assert_has_calls([
             mock.call('Failure in query: %s, skipping...', 'query1'),
         ])
+
+
+class TestRecordsMapping(object):
+    """
+    Check the samples created mapping the raw query records by position
+    """
+
+    COLUMNS = ['HOST', 'Port', 'SERVICE_NAME', 'VALUE', 'NULL_VALUE']
+    RECORDS = [
+        ('host1', '30015', 'indexserver', 10, None),
+        ('host2', '30013', 'nameserver', 0, None),
+        ('host3', None, 'xsengine', 3.5, None)
+    ]
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.SapHanaCollector.retrieve_metadata')
+    def setup(self, mock_retrieve_metadata):
+        """
+        Test setUp.
+        """
+        self._collector = prometheus_exporter.SapHanaCollector(mock.Mock(), mock.Mock())
+        self._collector._sid = 'prd'
+        self._collector._insnr = '00'
+        self._collector._database_name = 'db_name'
+        self._collector._metadata_label_values = ('prd', '00', 'db_name')
+
+    def _samples(self, mock_core, labels, value):
+        """
+        Map the records with a metric using the given labels and value columns
+        """
+        query_data = {'metrics': [{
+            'name': 'metric', 'description': 'description', 'labels': labels, 'value': value,
+            'unit': 'mb', 'type': 'gauge'}]}
+        query = prometheus_metrics.Query.get_model('query', query_data)
+        metric_plan, = query.resolve_columns(self.COLUMNS)
+        mock_core.GaugeMetricFamily.reset_mock()
+        self._collector._manage_gauge(metric_plan, self.RECORDS)
+        return mock_core.GaugeMetricFamily.return_value.add_metric.call_args_list
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_samples(self, mock_core):
+        assert self._samples(mock_core, ['host', 'port', 'service_name'], 'VALUE') == [
+            mock.call(('prd', '00', 'db_name', 'host1', '30015', 'indexserver'), 10),
+            mock.call(('prd', '00', 'db_name', 'host2', '30013', 'nameserver'), 0),
+            mock.call(('prd', '00', 'db_name', 'host3', None, 'xsengine'), 3.5)
+        ]
+        mock_core.GaugeMetricFamily.assert_called_once_with(
+            'metric', 'description', None,
+            ['sid', 'insnr', 'database_name', 'host', 'port', 'service_name'], 'mb')
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_samples_mixed_case(self, mock_core):
+        # The columns are matched ignoring the case, in the order of the metric labels
+        assert self._samples(mock_core, ['Service_Name', 'HOST'], 'value') == [
+            mock.call(('prd', '00', 'db_name', 'indexserver', 'host1'), 10),
+            mock.call(('prd', '00', 'db_name', 'nameserver', 'host2'), 0),
+            mock.call(('prd', '00', 'db_name', 'xsengine', 'host3'), 3.5)
+        ]
+        assert self._samples(mock_core, ['PORT'], 'Value') == [
+            mock.call(('prd', '00', 'db_name', '30015'), 10),
+            mock.call(('prd', '00', 'db_name', '30013'), 0),
+            mock.call(('prd', '00', 'db_name', None), 3.5)
+        ]
+        assert self._samples(mock_core, [], 'VALUE') == [
+            mock.call(('prd', '00', 'db_name'), 10),
+            mock.call(('prd', '00', 'db_name'), 0),
+            mock.call(('prd', '00', 'db_name'), 3.5)
+        ]
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_samples_null_value(self, mock_core):
+        assert self._samples(mock_core, ['host'], 'NULL_VALUE') == []
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_samples_missing_value(self, mock_core):
+        assert self._samples(mock_core, ['host'], 'MISSING') == []
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.core')
+    def test_samples_missing_label(self, mock_core):
+        assert self._samples(mock_core, ['host', 'missing'], 'VALUE') == []
+
+
+class FakeGauge(object):
+    """
+    prometheus_client.core.GaugeMetricFamily replacement
+    """
+
+    def __init__(self, name, documentation, value, labels, unit):
+        self.name = '{}_{}'.format(name, unit)
+        self.documentation = documentation
+        self.labels = labels
+        self.samples = []
+
+    def add_metric(self, labels, value):
+        self.samples.append((dict(zip(self.labels, labels)), value))
+
+
+def fake_encoder(registry):
+    """
+    Text format encoder of the FakeGauge metric families
+    """
+    output = ''
+    for metric in registry.collect():
+        output += '# HELP {} {}\n# TYPE {} gauge\n'.format(
+            metric.name, metric.documentation, metric.name)
+        for labels, value in metric.samples:
+            labels = ','.join('{}="{}"'.format(
+                name, prometheus_exporter._escape_label(label))
+                for name, label in sorted(labels.items()))
+            output += '{}{{{}}} {}\n'.format(metric.name, labels, repr(float(value)))
+    return output.encode('utf-8')
+
+
+class TestDirectExposition(object):
+    """
+    Check that the rendered gauges are written as the encoders write the metric families
+    """
+
+    LABELS = ['sid', 'host', 'database_name', 'port']
+    SAMPLES = [
+        (('host1', '30015'), 10),
+        (('h{0}"\\\n', 30013), 0.5)
+    ]
+
+    def setup(self):
+        """
+        Test setUp.
+        """
+        self._patches = [
+            mock.patch('hanadb_exporter.prometheus_exporter.core.GaugeMetricFamily', FakeGauge),
+            mock.patch('hanadb_exporter.prometheus_exporter.exposition.generate_latest',
+                       fake_encoder),
+            mock.patch('hanadb_exporter.prometheus_exporter.exposition.CONTENT_TYPE_LATEST',
+                       'text/plain'),
+            mock.patch('hanadb_exporter.prometheus_exporter.client_utils.floatToGoString',
+                       lambda value: repr(float(value)))
+        ]
+        for patch in self._patches:
+            patch.start()
+        self._template = prometheus_exporter.GaugeTemplate(
+            'name', 'description', self.LABELS, 'mb', ('PRD', '{db}'))
+
+    def teardown(self):
+        """
+        Test tearDown.
+        """
+        for patch in self._patches:
+            patch.stop()
+
+    def _family(self):
+        family = FakeGauge('name', 'description', None, self.LABELS, 'mb')
+        for labels, value in self.SAMPLES:
+            family.add_metric(('PRD', '{db}') + labels, value)
+        return family
+
+    def _gauge(self):
+        gauge = prometheus_exporter.RenderedGauge(self._template)
+        for labels, value in self.SAMPLES:
+            gauge.add_metric(labels, value)
+        return gauge
+
+    def test_render(self):
+        gauge = self._gauge()
+        assert gauge.name == 'name_mb'
+        expected = fake_encoder(prometheus_exporter.exposition_server.CollectorView(
+            lambda: [self._family()]))
+        assert gauge.render(fake_encoder, 'text/plain') == expected
+
+        # Encoders writing the samples in other format are not used to render the gauges
+        other_encoder = lambda registry: fake_encoder(registry).replace(b'} ', b'}  ')
+        assert gauge.render(other_encoder, 'other') is None
+
+    @mock.patch('hanadb_exporter.prometheus_exporter.parser')
+    def test_samples(self, mock_parser):
+        mock_parser.text_string_to_metric_families.return_value = iter([mock.Mock(
+            samples='samples')])
+        gauge = self._gauge()
+        assert gauge.samples == 'samples'
+        mock_parser.text_string_to_metric_families.assert_called_once_with(
+            fake_encoder(prometheus_exporter.exposition_server.CollectorView(
+                lambda: [self._family()])).decode('utf-8'))
+
+    def test_direct_encoder(self):
+        metrics = [self._family(), self._gauge(), self._family(), self._family(), self._gauge()]
+        registry = prometheus_exporter.exposition_server.CollectorView(lambda: metrics)
+        expected = fake_encoder(prometheus_exporter.exposition_server.CollectorView(
+            lambda: [self._family() for _ in metrics]))
+
+        encoder = mock.Mock(side_effect=fake_encoder)
+        assert prometheus_exporter.direct_encoder(encoder, 'text/plain')(registry) == expected
+        # The metric families between the rendered gauges are encoded together
+        assert [len(list(call[0][0].collect())) for call in encoder.call_args_list] == [1, 2]
+
+        # The OpenMetrics EOF marker is only written at the end
+        openmetrics_encoder = lambda registry: fake_encoder(registry) + b'# EOF\n'
+        encode = prometheus_exporter.direct_encoder(
+            openmetrics_encoder, 'application/openmetrics-text')
+        assert encode(registry) == expected + b'# EOF\n'
+        assert encode(prometheus_exporter.exposition_server.CollectorView(
+            lambda: [])) == b'# EOF\n'
@@ -10,6 +10,7 @@ Unitary tests for exporters/prometheus_metrics.py.
 
 # pylint:disable=C0103,C0111,W0212,W0611
 
+import collections
 import os
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
@@ -133,7 +134,11 @@ class TestQuery(object):
         mocked_data1 = {'data1': 'value1'}
         mocked_data2 = {'data2': 'value2'}
         query_data = {'metrics': [mocked_data1, mocked_data2], 'enabled': False}
-        mock_metric.side_effect = ['modeled_data1', 'modeled_data2']
+        modeled_data1 = mock.Mock()
+        modeled_data1.name = 'metric1'
+        modeled_data2 = mock.Mock()
+        modeled_data2.name = 'metric2'
+        mock_metric.side_effect = [modeled_data1, modeled_data2]
 
         self._query.parse('query', query_data)
 
@@ -142,8 +147,66 @@ class TestQuery(object):
             mock.call(data2='value2')
         ])
         assert self._query.query == 'query'
+        assert self._query.id == 'metric1'
         assert self._query.enabled == False
-        assert self._query.metrics == ['modeled_data1', 'modeled_data2']
+        assert self._query.interval == 0
+        assert self._query.timeout == None
+        assert self._query.priority == 0
+        assert self._query.metrics == [modeled_data1, modeled_data2]
+
+    def test_is_available(self):
+        query_data = {'metrics': [], 'hana_version': ['1.0.0', '2.00.040']}
+        self._query.parse('query', query_data)
+
+        assert self._query.is_available((1, 0, 0)) == True
+        assert self._query.is_available((2, 0, 40)) == True
+        assert self._query.is_available((2, 0, 40, 0, 1553674765)) == False
+        assert self._query.is_available((0, 9)) == False
+        assert self._query.is_available((2, 0, 41)) == False
+
+    @mock.patch('hanadb_exporter.prometheus_metrics.Metric')
+    def test_parse_optional_data(self, mock_metric):
+        query_data = {
+            'metrics': [{'data1': 'value1'}], 'id': 'my_query', 'interval': 300, 'timeout': 10,
+            'priority': 5}
+        mock_metric.side_effect = ['modeled_data1']
+
+        self._query.parse('query', query_data)
+
+        assert self._query.id == 'my_query'
+        assert self._query.enabled == True
+        assert self._query.interval == 300
+        assert self._query.priority == 5
+        assert self._query.timeout == 10
+        assert self._query.metrics == ['modeled_data1']
+
+    def test_resolve_columns(self):
+        query_data = {'metrics': [
+            {'name': 'metric1', 'description': 'description', 'labels': ['HOST', 'Port'],
+             'value': 'value1', 'unit': 'mb', 'type': 'gauge'},
+            {'name': 'metric2', 'description': 'description', 'labels': ['HOST', 'OTHER'],
+             'value': 'VALUE2', 'unit': 'mb', 'type': 'gauge'},
+            {'name': 'metric3', 'description': 'description', 'labels': [],
+             'value': 'VALUE3', 'unit': 'mb', 'type': 'gauge'}
+        ]}
+        self._query.parse('query', query_data)
+
+        plans = self._query.resolve_columns(['VALUE2', 'PORT', 'HOST', 'VALUE1'])
+
+        assert plans == [
+            prometheus_metrics.MetricPlan(self._query.metrics[0], (2, 1), 3),
+            prometheus_metrics.MetricPlan(self._query.metrics[1], None, 0),
+            prometheus_metrics.MetricPlan(self._query.metrics[2], (), None)
+        ]
+        record = ('value2', 'port', 'host', 'value1')
+        assert plans[0].get_labels(record) == ('host', 'port')
+        assert plans[1].get_labels is None
+        assert plans[2].get_labels(record) == ()
+        single_label = prometheus_metrics.MetricPlan(self._query.metrics[0], (1,), 3)
+        assert single_label.get_labels(record) == ('port',)
+        # The plans are resolved only once for the same columns
+        assert self._query.resolve_columns(('VALUE2', 'PORT', 'HOST', 'VALUE1')) is plans
+        assert self._query.resolve_columns(['HOST', 'PORT', 'VALUE1']) is not plans
 
     @mock.patch('hanadb_exporter.prometheus_metrics.Query.__new__')
     def test_get_model(self, mock_query):
@@ -166,6 +229,30 @@ class TestPrometheusMetrics(object):
         mock_load.assert_called_once_with('metrics_file')
         assert metrics.queries == 'queries'
 
+    @mock.patch('hanadb_exporter.prometheus_metrics.PrometheusMetrics.load_metrics')
+    def test_merge(self, mock_load):
+        metric = {
+            'name': 'metric', 'description': 'description', 'labels': ['HOST'],
+            'value': 'VALUE', 'unit': 'mb', 'type': 'gauge'}
+        get_model = lambda query, **query_data: prometheus_metrics.Query.get_model(
+            query, dict({'metrics': [metric]}, **query_data))
+
+        mock_load.return_value = [
+            get_model('query1'), get_model('query2'), get_model('query3', interval=60)]
+        previous = prometheus_metrics.PrometheusMetrics('metrics_file')
+        mock_load.return_value = [
+            get_model('query4'), get_model('query3', interval=30), get_model('query1')]
+        metrics = prometheus_metrics.PrometheusMetrics('metrics_file')
+        query4, query3 = metrics.queries[:2]
+
+        added, removed, changed = metrics.merge(previous)
+
+        assert added == [query4]
+        assert removed == [previous.queries[1]]
+        assert changed == [previous.queries[2]]
+        # The unchanged queries are kept
+        assert metrics.queries == [query4, query3, previous.queries[0]]
+
     @mock.patch('hanadb_exporter.prometheus_metrics.Query.get_model')
     @mock.patch('json.load')
     @mock.patch('hanadb_exporter.prometheus_metrics.open')
@@ -174,7 +261,9 @@ class TestPrometheusMetrics(object):
         query2_data = mock.Mock()
         mock_json_load.return_value = {'query1': query1_data, 'query2': query2_data}
 
-        mock_get_model.side_effect = ['data1', 'data2']
+        data1 = mock.Mock(priority=0)
+        data2 = mock.Mock(priority=0)
+        mock_get_model.side_effect = [data1, data2]
 
         queries = prometheus_metrics.PrometheusMetrics.load_metrics('metrics.json')
         mock_open.assert_called_once_with('metrics.json', 'r')
@@ -184,7 +273,21 @@ class TestPrometheusMetrics(object):
             mock.call('query2', query2_data)
         ], any_order=True)
 
-        assert queries == ['data1', 'data2']
+        assert queries == [data1, data2]
+
+    @mock.patch('hanadb_exporter.prometheus_metrics.Query.get_model')
+    @mock.patch('json.load')
+    @mock.patch('hanadb_exporter.prometheus_metrics.open')
+    def test_load_metrics_priority(self, mock_open, mock_json_load, mock_get_model):
+        mock_json_load.return_value = collections.OrderedDict(
+            [('query1', {}), ('query2', {}), ('query3', {}), ('query4', {})])
+        data = [mock.Mock(priority=0), mock.Mock(priority=10), mock.Mock(priority=0),
+                mock.Mock(priority=5)]
+        mock_get_model.side_effect = data
+
+        queries = prometheus_metrics.PrometheusMetrics.load_metrics('metrics.json')
+
+        assert queries == [data[1], data[3], data[0], data[2]]
 
     @mock.patch('hanadb_exporter.prometheus_metrics.Query.get_model')
     @mock.patch('json.load')
@@ -15,6 +15,8 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import logging
+import threading
+import time
 
 try:
     from unittest import mock
@@ -34,6 +36,90 @@ class TestUtils(object):
     """
 
 
+    def test_single_flight(self):
+        single_flight = utils.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return ['result']
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.run(func)))
+        leader.start()
+        assert started.wait(1)
+        followers = [
+            threading.Thread(target=lambda: results.append(single_flight.run(func)))
+            for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        # Give some time to the followers to join the running call
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        assert len(calls) == 1
+        assert results == [['result']] * 4
+        assert all(result is results[0] for result in results)
+
+        # Once the call is finished, the next one runs the function again
+        assert single_flight.run(func) == ['result']
+        assert len(calls) == 2
+
+    def test_single_flight_error(self):
+        single_flight = utils.SingleFlight()
+        with pytest.raises(ValueError) as err:
+            single_flight.run(mock.Mock(side_effect=ValueError('error')))
+        assert 'error' in str(err.value)
+        assert single_flight.run(lambda: 'result') == 'result'
+
+    def test_intern_table(self):
+        table = utils.InternTable(2)
+        value = ''.join(['va', 'lue'])
+        assert table.intern(value) is value
+        assert table.intern(''.join(['val', 'ue'])) is value
+        assert table.intern_all(('other', ''.join(['va', 'lue']), 1)) == ('other', value, 1)
+        assert len(table) == 2
+
+        # Only strings are interned, the rest of values are returned as they are
+        assert table.intern(1.0) == 1.0 and len(table) == 2
+
+        # The table is emptied when it is full
+        table.intern('new')
+        assert len(table) == 1
+        assert table.intern(''.join(['va', 'lue'])) is not value
+
+        table = utils.InternTable(0)
+        assert table.intern(value) is value
+        assert table.intern(''.join(['va', 'lue'])) is not value
+        assert len(table) == 0
+
+    def test_intern_columns(self):
+        table = utils.InternTable(3)
+        value = ''.join(['va', 'lue'])
+        records = [(value, 1, None), (None, 1.0, 'other')]
+        assert table.intern_columns(records, [0, 1]) == records
+        # The columns without strings are not interned
+        assert len(table) == 2
+
+        records = table.intern_columns([(''.join(['val', 'ue']), 2, 'other')], [0, 1])
+        assert records == [('value', 2, 'other')]
+        assert records[0][0] is value
+
+        # The records are returned as they are if there is no string column
+        records = [(1, 2.0)]
+        assert table.intern_columns(records, [0, 1]) is records
+        assert table.intern_columns([], [0]) == []
+
+        # The table is emptied once it is full
+        table.intern_columns([('new1',), ('new2',)], [0])
+        assert len(table) == 0
+
     def test_format_query_result(self):
         query_results = mock.Mock()
         query_results.metadata = [
@@ -51,6 +137,120 @@ class TestUtils(object):
             {'column1':'data7', 'column2':'data8', 'column3':'data9'}
         ]
 
+    def test_cancel_query(self):
+        connector = mock.Mock()
+        connector._connection.cancel.return_value = True
+        assert utils.cancel_query(connector) == True
+        connector._connection.cancel.assert_called_once_with()
+
+        connector._connection.cancel.side_effect = Exception('error')
+        assert utils.cancel_query(connector) == False
+
+        connector = mock.Mock(_connection=object())
+        assert utils.cancel_query(connector) == False
+
+        # Connectors implementing cancel_query (connection pools) cancel their statements
+        pool = mock.Mock(spec=utils.PooledConnector)
+        pool.cancel_query.return_value = True
+        assert utils.cancel_query(pool, 'query1') == True
+        pool.cancel_query.assert_called_once_with('query1')
+
+    def test_pooled_connector(self):
+        connector = utils.PooledConnector()
+        with pytest.raises(NotImplementedError):
+            connector.size
+        with pytest.raises(NotImplementedError):
+            connector.stream_query('query1', 10)
+        with pytest.raises(NotImplementedError):
+            connector.cancel_query()
+
+    def test_dbapi_connection(self):
+        connector = mock.Mock()
+        assert utils.dbapi_connection(connector) == connector._connection
+        assert utils.dbapi_connection(object()) is None
+
+    def test_connection_count(self):
+        assert utils.connection_count(mock.Mock()) == 1
+        pool = mock.Mock(spec=utils.PooledConnector, size=3)
+        assert utils.connection_count(pool) == 3
+
+    def test_query_stream(self):
+        close1 = mock.Mock()
+        close2 = mock.Mock()
+        with utils.QueryStream('metadata', [['data1'], ['data2']], close1) as stream:
+            stream.on_close(close2)
+            assert stream.metadata == 'metadata'
+            assert list(stream.batches()) == [['data1'], ['data2']]
+        close1.assert_called_once_with()
+        close2.assert_called_once_with()
+
+        stream.close()
+        close1.assert_called_once_with()
+
+    def test_result_fingerprint(self):
+        result = mock.Mock(metadata=[('COLUMN', None)], records=[('data1', 1), ('data2', 2.0)])
+        fingerprint = utils.result_fingerprint(result)
+        assert fingerprint == utils.result_fingerprint(
+            mock.Mock(metadata=[('COLUMN', 'other')], records=[['data1', 1], ['data2', 2.0]]))
+        assert fingerprint != utils.result_fingerprint(
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1', 1), ('data2', 2.5)]))
+        assert fingerprint != utils.result_fingerprint(
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1', 1), ('data2', '2.0')]))
+        assert fingerprint != utils.result_fingerprint(
+            mock.Mock(metadata=[('COLUMN', None)], records=[('data1', 1)]))
+
+    def test_stream_query(self):
+        connector = mock.Mock(spec=['query'])
+        connector.query.return_value = mock.Mock(metadata='metadata', records=[('data1',)])
+        stream = utils.stream_query(connector, 'query1', 10)
+        assert stream.metadata == 'metadata'
+        assert list(stream.batches()) == [[('data1',)]]
+        connector.query.assert_called_once_with('query1')
+
+        connector.query.return_value = mock.Mock(metadata='metadata', records=[])
+        assert list(utils.stream_query(connector, 'query1', 10).batches()) == []
+
+        # Connection pools fetch the records in batches
+        pool = mock.Mock(spec=utils.PooledConnector)
+        pool.stream_query.return_value = 'stream'
+        assert utils.stream_query(pool, 'query1', 10) == 'stream'
+        pool.stream_query.assert_called_once_with('query1', 10)
+
+    def test_scrape_deadline(self):
+        assert utils.get_scrape_deadline() is None
+        with utils.scrape_deadline(10.0):
+            assert utils.get_scrape_deadline() == 10.0
+            with utils.scrape_deadline(5.0):
+                assert utils.get_scrape_deadline() == 5.0
+            assert utils.get_scrape_deadline() == 10.0
+
+            # The deadline is only set in the thread rendering the scrape
+            deadlines = []
+            thread = threading.Thread(
+                target=lambda: deadlines.append(utils.get_scrape_deadline()))
+            thread.start()
+            thread.join()
+            assert deadlines == [None]
+        assert utils.get_scrape_deadline() is None
+
+    def test_parse_version(self):
+        assert utils.parse_version('2.00.040.00.1553674765') == (2, 0, 40, 0, 1553674765)
+        assert utils.parse_version('1.0') == (1, 0)
+        assert utils.parse_version('2.0.1a') == (2, 0, 1, 'a')
+        assert utils.parse_version('1.0.0') < utils.parse_version('1.0.0.1')
+        assert utils.parse_version('2.00.037') < utils.parse_version('2.00.040')
+
+    def test_in_hana_range(self):
+        assert utils.in_hana_range((1, 0, 0), ((1, 0),)) == True
+        assert utils.in_hana_range((0, 9), ((1, 0),)) == False
+        assert utils.in_hana_range((2, 0), ((1, 0), (2, 0))) == True
+        assert utils.in_hana_range((2, 0, 1), ((1, 0), (2, 0))) == False
+
+        with pytest.raises(ValueError) as err:
+            utils.parse_hana_range(['1.0.0.0', '2.0.0.0', '3.0.0.0'])
+
+        assert 'provided availability range does not have the correct number of elements' in str(err.value)
+
     def test_check_hana_range(self):
 
         assert utils.check_hana_range('1.0.0.0', ['1.0.0.1']) == False